@@ -3,7 +3,10 @@ import os
 import sys
 #from subprocess import check_output, CalledProcessError
 import subprocess
+import json
 import logging
+import functools
+import pkg_resources
 import pandas as pd
 from textwrap import dedent
 
@@ -11,17 +14,49 @@ from textwrap import dedent
 from scripts.qiime2_helper.summarize_sample_counts import (
     load_qiime2_artifact,
     generate_sample_count,
-    get_sample_count
+    get_sample_count,
+    cached_sample_totals
+)
+from scripts.qiime2_helper.generate_combined_feature_table import (
+    combine_table,
+    subset_by_abundance
 )
-from scripts.qiime2_helper.generate_combined_feature_table import combine_table
 from scripts.qiime2_helper import artifact_helper
+from scripts.qiime2_helper import q2_backend
+from scripts.qiime2_helper.artifact_cache import (
+    ArtifactCache,
+    cache_key
+)
+from scripts.qiime2_helper import task_manifest
+from scripts.qiime2_helper import faprotax
+from scripts.qiime2_helper.classification_cache import classify_with_cache
 from scripts.qiime2_helper.generate_multiple_pcoa import (
-        generate_pdf,
-        generate_images,
+        pcoa_plot_specs,
         save_as_json
 )
+from scripts.qiime2_helper.generate_pcoa import convert_qiime2_2_skbio
+from scripts.qiime2_helper.plot_scheduler import render_plots
+from scripts.qiime2_helper.pcoa_ordination import (
+        METRIC_DIRS,
+        ORDINATION_FILE,
+        save_ordination
+)
+from scripts.qiime2_helper.metadata_helper import load_metadata
+from scripts.qiime2_helper.rarefaction import (
+    alpha_rarefaction,
+    curve_summary,
+    rarefaction_depths,
+    retention_depth,
+    select_sampling_depth,
+    suggest_sampling_depth
+)
+from scripts.qiime2_helper.taxa_collapse import (
+    TAXA_LEVELS,
+    collapse_taxa_all_levels
+)
 from scripts.qiime2_helper.split_manifest_file_by_run_ID import (
-    split_manifest
+    run_manifest_checksum,
+    write_run_manifest
 )
 
 # Define custom logger
@@ -48,16 +83,43 @@ qiime2_helper_dir = os.path.join(script_dir, "qiime2_helper")
 FAPROTAX = "FAPROTAX"
 
 def auto_sampling_depth(feature_table_artifact):
-    # Get the lowest sequence read in the samples
-    feature_table_df = load_qiime2_artifact(feature_table_artifact)
-    sample_count_df = generate_sample_count(feature_table_df)
+    """
+    Sampling depth used when sampling_depth is 0 (see Rarefaction).
+
+    Only 'curve' loads the table; other strategies are answered from the
+    cached sample totals.
+    """
+    totals = cached_sample_totals(feature_table_artifact)
+    config = Rarefaction()
+
+    if(config.auto_depth == 'curve'):
+        table = load_qiime2_artifact(feature_table_artifact, sparse=True)
+        max_depth = retention_depth(totals, config.retention)
+        curves = alpha_rarefaction(table,
+                rarefaction_depths(max_depth, config.steps),
+                int(config.iterations),
+                rarefaction_seed())
+
+        return str(suggest_sampling_depth(curves, totals, config.retention, config.saturation))
+
+    return str(select_sampling_depth(totals, config.auto_depth, config.retention))
+
+def split_core_budget(n_cores, n_parallel, n_jobs):
+    """
+    Divide a total core budget between concurrently running jobs.
 
-    # convert to int
-    sample_count_df['Count'] = sample_count_df['Count'].round(0).astype(int)
+    Input:
+        - n_cores: total number of cores available (str or int)
+        - n_parallel: maximum number of jobs expected to run at once
+        - n_jobs: total number of jobs
 
-    min_count = sample_count_df['Count'].min() if (sample_count_df['Count'].min() > 0) else 1
+    Returns:
+        - number of threads each job should use (str; at least 1)
+    """
+    n_concurrent = max(1, min(int(n_parallel), int(n_jobs)))
+    n_threads = max(1, int(n_cores) // n_concurrent)
 
-    return str(min_count)
+    return str(n_threads)
 
 def run_cmd(cmd, step):
     #try:
@@ -99,6 +161,26 @@ def run_cmd(cmd, step):
     else:
         return stdout
 
+def run_qiime(cmd, step):
+    """
+    Run qiime command with the backend selected in [Execution].
+
+    The in-process backend keeps plugins and loaded artifacts in the worker
+    process; commands it does not support are run through the CLI.
+    """
+    if(Execution().backend == 'inprocess' and q2_backend.is_supported(cmd)):
+        try:
+            return q2_backend.execute(cmd)
+        except Exception as err:
+            err_msg = "In {step}, the following command, : ".format(step=step) + \
+                    "{cmd}\n\n".format(cmd=cmd) + \
+                    "resulted in an error:\n{err}".format(err=err)
+
+            logger.error(err_msg)
+            raise ValueError("<-->" + str(err) + "<-->")
+
+    return run_cmd(cmd, step)
+
 def str2bool(v):
     if isinstance(v, bool):
         return v
@@ -113,6 +195,251 @@ def str2bool(v):
     #else:
     #    raise argparse.ArgumentTypeError('Boolean value expected.')
 
+class Execution(luigi.Config):
+    """
+    How QIIME2 steps are executed.
+        - backend: 'cli' runs each step as a new qiime process.
+            'inprocess' calls the plugin actions through the Artifact API
+            in the worker process.
+    """
+    backend = luigi.Parameter(default='cli')
+
+# Load plugins before luigi forks workers so that every worker inherits them
+if(Execution().backend == 'inprocess'):
+    q2_backend.get_plugin_manager()
+
+class Artifact_Cache(luigi.Config):
+    """
+    Cache of expensive step outputs, shared between runs and projects.
+        - cache_dir: cache location. Leave empty to disable the cache.
+        - max_size_gb: size cap; least recently used entries are evicted.
+        - link: how cached outputs are placed in the output directory
+            (hardlink, symlink or copy).
+    """
+    cache_dir = luigi.Parameter(default='')
+    max_size_gb = luigi.Parameter(default='100')
+    link = luigi.Parameter(default='hardlink')
+
+class Plot_Rendering(luigi.Config):
+    """
+    How plots are rendered.
+        - workers: number of processes rendering plots in parallel.
+        - pcoa_images: 'eager' renders an image of every PCoA plot for the
+            web server. 'lazy' only saves the ordination coordinates; images
+            are rendered on request by pcoa_image_service.
+    """
+    workers = luigi.Parameter(default='1')
+    pcoa_images = luigi.Parameter(default='eager')
+
+class Rarefaction(luigi.Config):
+    """
+    Rarefaction curves and automatic sampling depth.
+        - iterations: subsamples per sample and depth.
+        - steps: number of depths along a curve.
+        - seed: random seed; empty for a random draw.
+        - auto_depth: sampling depth used when sampling_depth is 0. 'min'
+            is the smallest sample total; 'retention' keeps at least
+            retention of the samples; 'max_reads' keeps the most reads
+            (depth x samples kept); 'curve' is suggested from rarefaction
+            curves.
+        - retention: share of samples to keep ('retention' and 'curve'
+            depths, and maximum depth of Rarefaction_Curves when its
+            sampling_depth is 0).
+        - saturation: share of observed features the median sample should
+            reach ('curve' depth).
+    """
+    iterations = luigi.Parameter(default='10')
+    steps = luigi.Parameter(default='10')
+    seed = luigi.Parameter(default='')
+    auto_depth = luigi.Parameter(default='min')
+    retention = luigi.Parameter(default='0.9')
+    saturation = luigi.Parameter(default='0.95')
+
+def rarefaction_seed():
+    seed = Rarefaction().seed
+
+    return int(seed) if seed != '' else None
+
+def rarefaction_settings():
+    """
+    Rarefaction configuration, as one string (for task fingerprints).
+    """
+    config = Rarefaction()
+    names = ("iterations", "steps", "seed", "auto_depth", "retention", "saturation")
+
+    return ";".join(name + "=" + str(getattr(config, name)) for name in names)
+
+def get_artifact_cache():
+    config = Artifact_Cache()
+
+    if not(config.cache_dir):
+        return None
+
+    max_size_bytes = int(float(config.max_size_gb) * 1024 ** 3)
+
+    return ArtifactCache(config.cache_dir, max_size_bytes, config.link)
+
+def qiime2_version():
+    try:
+        return pkg_resources.get_distribution('qiime2').version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
+def flatten_output_paths(struct, prefix=''):
+    """
+    Flatten (nested) task output into {name: path}.
+    """
+    if(isinstance(struct, dict)):
+        paths = {}
+        for key, value in struct.items():
+            paths.update(flatten_output_paths(value, prefix + str(key) + '/'))
+        return paths
+    elif(isinstance(struct, (list, tuple))):
+        paths = {}
+        for i, value in enumerate(struct):
+            paths.update(flatten_output_paths(value, prefix + str(i) + '/'))
+        return paths
+    else:
+        return {prefix.rstrip('/') or 'output': struct.path}
+
+def cache_outputs(run):
+    """
+    Decorator for Task.run. Restores outputs from the artifact cache when
+    the task was run before with the same inputs, parameters and QIIME2
+    version; otherwise runs the task and stores its outputs.
+
+    Tasks may define
+        - cache_inputs(): input paths to fingerprint (default: all inputs)
+        - ignore_params: parameters that do not affect the outputs
+    """
+    @functools.wraps(run)
+    def wrapper(self, *args, **kwargs):
+        outputs = flatten_output_paths(self.output())
+
+        # Outputs of an earlier run may be hard links into the cache; remove
+        # them so that the task writes new files instead of overwriting
+        # the cached ones
+        for path in outputs.values():
+            if(os.path.isfile(path)):
+                os.remove(path)
+
+        cache = get_artifact_cache()
+
+        if(cache is None):
+            return run(self, *args, **kwargs)
+
+        if(hasattr(self, 'cache_inputs')):
+            input_paths = self.cache_inputs()
+        else:
+            input_paths = [target.path for target in luigi.task.flatten(self.input())]
+
+        ignored = getattr(self, 'ignore_params', ())
+        params = {
+            name: value
+            for name, value in self.to_str_params(only_significant=True).items()
+            if name not in ignored
+        }
+
+        step = self.get_task_family()
+        key = cache_key(step, input_paths, params, qiime2_version())
+
+        if(cache.restore(key, outputs)):
+            logger.info("{step}: restored outputs from artifact cache ({key})".format(
+                step=str(self),
+                key=key))
+            return
+
+        run(self, *args, **kwargs)
+
+        cache.store(key, outputs, step)
+
+    return wrapper
+
+def task_description(task):
+    """
+    Parameters, configuration values and input files affecting the outputs
+    of a task, and the fingerprints of the tasks it requires.
+    """
+    ignored = getattr(task, 'ignore_params', ())
+    params = {
+        name: value
+        for name, value in task.to_str_params(only_significant=True).items()
+        if name not in ignored
+    }
+    for name in getattr(task, 'fingerprint_attrs', ()):
+        params[name] = getattr(task, name)
+
+    files = {name: getattr(task, name)
+            for name in getattr(task, 'fingerprint_files', ())}
+
+    upstream = [task_fingerprint(t) for t in luigi.task.flatten(task.requires())]
+
+    return task_manifest.describe(task.get_task_family(), params, files,
+            upstream)
+
+# {task_id: fingerprint}
+_task_fingerprints = {}
+
+def task_fingerprint(task):
+    """
+    Fingerprint of a task (see task_manifest); computed once per process.
+    """
+    if(task.task_id not in _task_fingerprints):
+        _task_fingerprints[task.task_id] = task_manifest.compute_fingerprint(
+                task_description(task))
+
+    return _task_fingerprints[task.task_id]
+
+class Fingerprinted_Task(luigi.Task):
+    """
+    Task that is complete only if its outputs exist and were produced with
+    the current parameters and upstream outputs. A manifest is written next
+    to the first output when the task succeeds.
+
+    Changing a parameter (e.g. trunc_len_f) re-runs the tasks using it and
+    the tasks downstream of them only.
+
+    Tasks may define
+        - ignore_params: parameters that do not affect the outputs
+        - fingerprint_attrs: attributes read from configuration that affect
+            the outputs (e.g. sampling_depth)
+        - fingerprint_files: parameters or attributes holding paths of input
+            files that are not produced by another task (e.g. metadata_file)
+    """
+    ignore_params = ()
+    fingerprint_attrs = ()
+    fingerprint_files = ()
+
+    def output_manifest_path(self):
+        outputs = flatten_output_paths(self.output())
+        first_output = outputs[sorted(outputs)[0]]
+
+        return task_manifest.manifest_path(first_output)
+
+    def complete(self):
+        outputs = luigi.task.flatten(self.output())
+
+        # Tasks without outputs (e.g. dummy tasks) keep luigi behaviour
+        if(len(outputs) == 0):
+            return super().complete()
+
+        return task_manifest.is_up_to_date(
+                [target.path for target in outputs],
+                self.output_manifest_path(),
+                task_fingerprint(self))
+
+    def write_output_manifest(self):
+        task_manifest.write_manifest(
+                self.output_manifest_path(),
+                task_fingerprint(self),
+                task_description(self),
+                flatten_output_paths(self.output()).values())
+
+@Fingerprinted_Task.event_handler(luigi.Event.SUCCESS)
+def write_output_manifest(task):
+    if(len(luigi.task.flatten(task.output())) > 0):
+        task.write_output_manifest()
+
 class Out_Prefix(luigi.Config):
     prefix = luigi.Parameter()
 
@@ -168,31 +495,40 @@ class Samples(luigi.Config):
         else:
             return set()
 
-class Split_Samples(luigi.Task):
+class Split_Samples_Run(Fingerprinted_Task):
     """
-    Split samples based on metadata
+    Manifest of a single sequencing run. Empty run_ID denotes the single run
+    case, where the manifest file is copied as is.
+
+    A run is identified by its own rows in the manifest file, so appending a
+    new run to the manifest leaves the existing runs (and everything
+    derived from them) up to date.
     """
+    run_ID = luigi.Parameter(default="")
+
     out_dir = Output_Dirs().manifest_dir
+    manifest_file = Samples().manifest_file
 
-    def output(self):
-        samples = Samples().get_samples()
-        is_multiple = str2bool(Samples().is_multiple)
+    fingerprint_attrs = ("run_checksum",)
 
-        # If multiple runs are specified in manifest file
-        if(is_multiple):
-            output = {}
-            for sample in samples:
-                manifest = "manifest_" + str(sample) + ".csv"
-                out_path = os.path.join(self.out_dir, manifest)
-
-                output[str(sample)] = luigi.LocalTarget(out_path)
+    @property
+    def run_checksum(self):
+        # Multiple run
+        if(self.run_ID):
+            return run_manifest_checksum(self.manifest_file, self.run_ID)
+        # Single run
+        else:
+            return task_manifest.input_file_fingerprint(self.manifest_file)
 
-            return output
-        # Single run case
+    def output(self):
+        # Multiple run
+        if(self.run_ID):
+            manifest = "manifest_" + str(self.run_ID) + ".csv"
+        # Single run
         else:
-            output = os.path.join(self.out_dir, "manifest.csv")
+            manifest = "manifest.csv"
 
-            return luigi.LocalTarget(output)
+        return luigi.LocalTarget(os.path.join(self.out_dir, manifest))
 
     def run(self):
         # Make output directory
@@ -201,49 +537,82 @@ class Split_Samples(luigi.Task):
                 self.out_dir],
                 self)
 
-        # Split manifest if multiple runs in manifest file
-        manifest_path = Samples().manifest_file
-        is_multiple = str2bool(Samples().is_multiple)
-
-        if(is_multiple):
-            split_manifest(manifest_path, self.out_dir)
+        if(self.run_ID):
+            write_run_manifest(self.manifest_file, self.run_ID,
+                    self.output().path)
         else:
             cmd = ['cp',
-                    manifest_path,
+                    self.manifest_file,
                     self.output().path]
 
             run_cmd(cmd, self)
 
-class Import_Data(luigi.Task):
+class Split_Samples(luigi.WrapperTask):
+    """
+    Split samples based on metadata; one Split_Samples_Run task per run_ID.
+    """
+    samples = Samples().get_samples()
+    is_multiple = str2bool(Samples().is_multiple)
+
+    def requires(self):
+        # If multiple runs are specified in manifest file
+        if(self.is_multiple):
+            return {
+                str(sample): Split_Samples_Run(run_ID=str(sample))
+                for sample in self.samples
+            }
+        # Single run case
+        else:
+            return Split_Samples_Run(run_ID="")
+
+    def output(self):
+        return luigi.task.getpaths(self.requires())
+
+class Import_Data_Run(Fingerprinted_Task):
+    """
+    Import demultiplexed sequences of a single sequencing run.
+
+    Empty run_ID denotes the single run case.
+    """
+    run_ID = luigi.Parameter(default="")
     # Options for qiime tools import
     sample_type = luigi.Parameter(
             default='SampleData[PairedEndSequencesWithQuality]')
     input_format = luigi.Parameter(default="PairedEndFastqManifestPhred33")
 
     out_dir = Output_Dirs().input_upload_dir
-    samples = Samples().get_samples()
-    is_multiple = str2bool(Samples().is_multiple)
 
     def requires(self):
-        return Split_Samples()
+        return Split_Samples_Run(run_ID=self.run_ID)
 
     def output(self):
         # Multiple run specified in the manifest file
-        if(self.is_multiple):
-            output = {}
-            for sample in self.samples:
-                prefix = str(sample) + "_paired_end_demux.qza"
-                paired_end_demux = os.path.join(self.out_dir, prefix)
-
-                output[str(sample)] = luigi.LocalTarget(paired_end_demux)
-
-            return output
+        if(self.run_ID):
+            prefix = str(self.run_ID) + "_paired_end_demux.qza"
         # Single  run case
         else:
-            paired_end_demux = os.path.join(self.out_dir, "paired_end_demux.qza")
+            prefix = "paired_end_demux.qza"
+
+        paired_end_demux = os.path.join(self.out_dir, prefix)
+
+        return luigi.LocalTarget(paired_end_demux)
+
+    def manifest_path(self):
+        return self.input().path
 
-            return luigi.LocalTarget(paired_end_demux)
+    def cache_inputs(self):
+        # Manifest of this run and the sequence files it refers to
+        manifest = self.manifest_path()
+        manifest_df = pd.read_csv(manifest, comment='#')
+        filepath_cols = [col for col in manifest_df.columns if 'filepath' in col]
 
+        sequence_files = []
+        for col in filepath_cols:
+            sequence_files.extend(os.path.expandvars(str(f)) for f in manifest_df[col])
+
+        return [manifest] + sequence_files
+
+    @cache_outputs
     def run(self):
         step = str(self)
         # Make output directory
@@ -252,323 +621,356 @@ class Import_Data(luigi.Task):
                 self.out_dir],
                 step)
 
-        #inputPath = Samples().manifest_file
-        #
-        ## Make sure input file actually exists
-        #try:
-        #    with open(inputPath, 'r') as fh:
-        #        fh.readlines()
-        #except FileNotFoundError:
-        #    logger.error("Input file for qiime tools import does not exist...")
-        #    raise
-        ## in case of unexpected errors
-        #except Exception as err:
-        #    logger.error(
-        #    "In Import_Data() following error occured\n" + str(err))
-        #    raise
+        inputPath = self.manifest_path()
+
+        cmd = ["qiime",
+                "tools",
+                "import",
+                "--type",
+                self.sample_type,
+                "--input-path",
+                inputPath,
+                "--output-path",
+                self.output().path,
+                "--input-format",
+                self.input_format]
 
+        run_qiime(cmd, self)
+
+class Import_Data(luigi.WrapperTask):
+    """
+    Fan out qiime tools import to one Import_Data_Run task per run_ID.
+
+    Completion is tracked per run, so a failed import resumes from the
+    failed run only.
+    """
+    # Options for qiime tools import
+    sample_type = luigi.Parameter(
+            default='SampleData[PairedEndSequencesWithQuality]')
+    input_format = luigi.Parameter(default="PairedEndFastqManifestPhred33")
+
+    samples = Samples().get_samples()
+    is_multiple = str2bool(Samples().is_multiple)
+
+    def import_run(self, run_ID):
+        return Import_Data_Run(
+                run_ID=run_ID,
+                sample_type=self.sample_type,
+                input_format=self.input_format)
+
+    def requires(self):
         # Multiple run
         if(self.is_multiple):
-            for sample in self.samples:
-                cmd = ["qiime",
-                        "tools",
-                        "import",
-                        "--type",
-                        self.sample_type,
-                        "--input-path",
-                        self.input()[str(sample)].path,
-                        "--output-path",
-                        self.output()[str(sample)].path,
-                        "--input-format",
-                        self.input_format]
-                run_cmd(cmd, self)
+            return {
+                str(sample): self.import_run(str(sample))
+                for sample in self.samples
+            }
         # Single run
         else:
-            inputPath = Samples().manifest_file
-            cmd = ["qiime",
-                    "tools",
-                    "import",
-                    "--type",
-                    self.sample_type,
-                    "--input-path",
-                    inputPath,
-                    "--output-path",
-                    self.output().path,
-                    "--input-format",
-                    self.input_format]
+            return self.import_run("")
 
-            run_cmd(cmd, self)
+    def output(self):
+        return luigi.task.getpaths(self.requires())
+
+class Summarize_Run(Fingerprinted_Task):
+    """
+    Summarize demultiplexed sequences of a single sequencing run.
+    """
+    run_ID = luigi.Parameter(default="")
 
-class Summarize(luigi.Task):
-    samples = Samples().get_samples()
-    is_multiple = str2bool(Samples().is_multiple)
     out_dir = Output_Dirs().input_upload_dir
 
     def requires(self):
-        return Import_Data()
+        return Import_Data().import_run(self.run_ID)
 
     def output(self):
         # Multiple run
-        if(self.is_multiple):
-            output = {}
-            for sample in self.samples:
-                prefix = str(sample) + "_paired_end_demux.qzv"
-                paired_end_demux = os.path.join(self.out_dir, prefix)
-
-                output[str(sample)] = luigi.LocalTarget(paired_end_demux)
-
-            return output
+        if(self.run_ID):
+            prefix = str(self.run_ID) + "_paired_end_demux.qzv"
         # Single run
         else:
-            summary_file = os.path.join(self.out_dir, "paired_end_demux.qzv")
+            prefix = "paired_end_demux.qzv"
+
+        summary_file = os.path.join(self.out_dir, prefix)
 
-            return luigi.LocalTarget(summary_file)
+        return luigi.LocalTarget(summary_file)
 
     def run(self):
         step = str(self)
         # Make output directory
         run_cmd(["mkdir",
                 "-p",
-                Output_Dirs().out_dir],
+                self.out_dir],
                 step)
 
+        # Generate summary file
+        cmd = ["qiime",
+                "demux",
+                "summarize",
+                "--i-data",
+                self.input().path,
+                "--o-visualization",
+                self.output().path]
+
+        run_qiime(cmd, self)
+
+class Summarize(luigi.WrapperTask):
+    samples = Samples().get_samples()
+    is_multiple = str2bool(Samples().is_multiple)
+
+    def requires(self):
         # Multiple run
         if(self.is_multiple):
-            for sample in self.samples:
-            # Generate summary file
-                cmd = ["qiime",
-                        "demux",
-                        "summarize",
-                        "--i-data",
-                        self.input()[str(sample)].path,
-                        "--o-visualization",
-                        self.output()[str(sample)].path]
-
-                run_cmd(cmd, self)
+            return {
+                str(sample): Summarize_Run(run_ID=str(sample))
+                for sample in self.samples
+            }
         # Single run
         else:
-            # Generate summary file
-            cmd = ["qiime",
-                    "demux",
-                    "summarize",
-                    "--i-data",
-                    self.input().path,
-                    "--o-visualization",
-                    self.output().path]
+            return Summarize_Run(run_ID="")
 
-            run_cmd(cmd, self)
+    def output(self):
+        return luigi.task.getpaths(self.requires())
 
-class Denoise(luigi.Task):
+class Denoise_Run(Fingerprinted_Task):
+    """
+    Run DADA2 on a single sequencing run.
+
+    One task is scheduled per run_ID so that independent runs can be denoised
+    concurrently (luigi --workers N). Empty run_ID denotes the single run case.
+    """
+    run_ID = luigi.Parameter(default="")
     trim_left_f = luigi.Parameter(default="19")
     trunc_len_f = luigi.Parameter(default="250")
     trim_left_r = luigi.Parameter(default="20")
     trunc_len_r = luigi.Parameter(default="250")
-    n_cores = luigi.Parameter(default="1")
+    n_threads = luigi.Parameter(default="1")
 
-    samples = Samples().get_samples()
-    is_multiple = str2bool(Samples().is_multiple)
     denoise_dir = Output_Dirs().denoise_dir
+    ignore_params = ("n_threads",)
 
     def requires(self):
-        return Import_Data()
+        return Import_Data().import_run(self.run_ID)
 
     def output(self):
         # Multiple runs
-        if(self.is_multiple):
-            output = {}
-            for sample in self.samples:
-                table_prefix = str(sample) + "_dada2_table.qza"
-                seq_prefix = str(sample) + "_dada2_rep_seqs.qza"
-                stats_prefix = str(sample) + "_stats_dada2.qza"
-                log_prefix = str(sample) + "_dada2_log.txt"
-
-                denoise_table = os.path.join(self.denoise_dir,
-                        str(sample), table_prefix)
-                rep_seqs = os.path.join(self.denoise_dir,
-                        str(sample), seq_prefix)
-                denoise_stats = os.path.join(self.denoise_dir,
-                        str(sample), stats_prefix)
-                dada2_log = os.path.join(self.denoise_dir,
-                        str(sample), log_prefix)
-
-                denoise_out = {
-                        "table": luigi.LocalTarget(denoise_table),
-                        "rep_seqs": luigi.LocalTarget(rep_seqs),
-                        "stats": luigi.LocalTarget(denoise_stats),
-                        "log": luigi.LocalTarget(dada2_log, format=luigi.format.Nop)
-                        }
-
-                output[str(sample)] = denoise_out
-            return output
+        if(self.run_ID):
+            sample = str(self.run_ID)
+            table_prefix = sample + "_dada2_table.qza"
+            seq_prefix = sample + "_dada2_rep_seqs.qza"
+            stats_prefix = sample + "_stats_dada2.qza"
+            log_prefix = sample + "_dada2_log.txt"
+
+            run_dir = os.path.join(self.denoise_dir, sample)
         # Single run
         else:
-            denoise_table = os.path.join(self.denoise_dir, "dada2_table.qza")
-            rep_seqs = os.path.join(self.denoise_dir, "dada2_rep_seqs.qza")
-            denoise_stats = os.path.join(self.denoise_dir, "stats_dada2.qza")
-            dada2_log = os.path.join(self.denoise_dir, "dada2_log.txt")
+            table_prefix = "dada2_table.qza"
+            seq_prefix = "dada2_rep_seqs.qza"
+            stats_prefix = "stats_dada2.qza"
+            log_prefix = "dada2_log.txt"
+
+            run_dir = self.denoise_dir
 
-            out = {
-                    "table": luigi.LocalTarget(denoise_table),
-                    "rep_seqs": luigi.LocalTarget(rep_seqs),
-                    "stats": luigi.LocalTarget(denoise_stats),
-                    "log": luigi.LocalTarget(dada2_log, format=luigi.format.Nop)
-                    }
+        out = {
+                "table": luigi.LocalTarget(os.path.join(run_dir, table_prefix)),
+                "rep_seqs": luigi.LocalTarget(os.path.join(run_dir, seq_prefix)),
+                "stats": luigi.LocalTarget(os.path.join(run_dir, stats_prefix)),
+                "log": luigi.LocalTarget(os.path.join(run_dir, log_prefix),
+                    format=luigi.format.Nop)
+                }
 
-            return out
+        return out
 
+    @cache_outputs
     def run(self):
+        demux = self.input()
+
         # Make output directory
         run_cmd(["mkdir",
                 "-p",
-                self.denoise_dir],
+                os.path.dirname(self.output()["table"].path)],
                 self)
 
-        if(self.is_multiple):
-            # Get cutoff for each sample
-            #trim_left_f_list = self.trim_left_f.split(',')
-            #trunc_len_f_list = self.trunc_len_f.split(',')
-            #trim_left_r_list = self.trim_left_r.split(',')
-            #trunc_len_r_list = self.trunc_len_r.split(',')
-
-            #trim_left_f_dict = {}
-            #trunc_len_f_dict = {}
-            #trim_left_r_dict = {}
-            #trunc_len_r_dict = {}
-
-            #for trim_f in trim_left_f_list:
-            #    sample_id = trim_f.split(':')[0].strip()
-            #    cutoff = trim_f.split(':')[1].strip()
+        # Run dada2
+        cmd = ["qiime",
+                "dada2",
+                "denoise-paired",
+                "--i-demultiplexed-seqs",
+                demux.path,
+                "--p-trim-left-f",
+                self.trim_left_f,
+                "--p-trunc-len-f",
+                self.trunc_len_f,
+                "--p-trim-left-r",
+                self.trim_left_r,
+                "--p-trunc-len-r",
+                self.trunc_len_r,
+                "--p-n-threads",
+                self.n_threads,
+                "--o-table",
+                self.output()["table"].path,
+                "--o-representative-sequences",
+                self.output()["rep_seqs"].path,
+                "--o-denoising-stats",
+                self.output()["stats"].path,
+                "--verbose"]
 
-            #    trim_left_f_dict[sample_id] = cutoff
+        output = run_qiime(cmd, self)
 
-            #for trunc_f in trunc_len_f_list:
-            #    sample_id = trunc_f.split(':')[0].strip()
-            #    cutoff = trunc_f.split(':')[1].strip()
+        # Write a log file
+        with self.output()["log"].open('wb') as fh:
+            fh.write(output)
 
-            #    trunc_len_f_dict[sample_id] = cutoff
+class Denoise(luigi.WrapperTask):
+    """
+    Fan out DADA2 denoising to one Denoise_Run task per run_ID.
 
-            #for trim_r in trim_left_r_list:
-            #    sample_id = trim_r.split(':')[0].strip()
-            #    cutoff = trim_r.split(':')[1].strip()
+    n_cores is the total core budget; it is divided evenly between the
+    runs that may be denoised at the same time (n_parallel_runs).
+    """
+    trim_left_f = luigi.Parameter(default="19")
+    trunc_len_f = luigi.Parameter(default="250")
+    trim_left_r = luigi.Parameter(default="20")
+    trunc_len_r = luigi.Parameter(default="250")
+    n_cores = luigi.Parameter(default="1")
+    n_parallel_runs = luigi.Parameter(default="1")
 
-            #    trim_left_r_dict[sample_id] = cutoff
+    samples = Samples().get_samples()
+    is_multiple = str2bool(Samples().is_multiple)
 
-            #for trunc_r in trunc_len_r_list:
-            #    sample_id = trunc_r.split(':')[0].strip()
-            #    cutoff = trunc_r.split(':')[1].strip()
+    # Thread counts do not change the denoised outputs
+    ignore_params = ("n_cores", "n_parallel_runs")
 
-            #    trunc_len_r_dict[sample_id] = cutoff
+    def _denoise_run(self, run_ID, n_threads):
+        return Denoise_Run(
+                run_ID=run_ID,
+                trim_left_f=self.trim_left_f,
+                trunc_len_f=self.trunc_len_f,
+                trim_left_r=self.trim_left_r,
+                trunc_len_r=self.trunc_len_r,
+                n_threads=n_threads)
 
-            # Run dada2 for each sample
-            for sample in self.samples:
-                # Run dada2
-                #cmd = ["qiime",
-                #        "dada2",
-                #        "denoise-paired",
-                #        "--i-demultiplexed-seqs",
-                #        self.input()[str(sample)].path,
-                #        "--p-trim-left-f",
-                #        trim_left_f_dict[str(sample)],
-                #        "--p-trunc-len-f",
-                #        trunc_len_f_dict[str(sample)],
-                #        "--p-trim-left-r",
-                #        trim_left_r_dict[str(sample)],
-                #        "--p-trunc-len-r",
-                #        trunc_len_r_dict[str(sample)],
-                #        "--p-n-threads",
-                #        self.n_threads,
-                #        "--o-table",
-                #        self.output()[str(sample)]["table"].path,
-                #        "--o-representative-sequences",
-                #        self.output()[str(sample)]["rep_seqs"].path,
-                #        "--o-denoising-stats",
-                #        self.output()[str(sample)]["stats"].path,
-                #        "--verbose"]
-
-                # Make output directory
-                run_cmd(['mkdir',
-                        '-p',
-                        os.path.join(self.denoise_dir, str(sample))],
-                        self)
+    def requires(self):
+        # Multiple runs
+        if(self.is_multiple):
+            n_threads = split_core_budget(self.n_cores, self.n_parallel_runs,
+                    len(self.samples))
 
-                cmd = ["qiime",
-                        "dada2",
-                        "denoise-paired",
-                        "--i-demultiplexed-seqs",
-                        self.input()[str(sample)].path,
-                        "--p-trim-left-f",
-                        self.trim_left_f,
-                        "--p-trunc-len-f",
-                        self.trunc_len_f,
-                        "--p-trim-left-r",
-                        self.trim_left_r,
-                        "--p-trunc-len-r",
-                        self.trunc_len_r,
-                        "--p-n-threads",
-                        self.n_cores,
-                        "--o-table",
-                        self.output()[str(sample)]["table"].path,
-                        "--o-representative-sequences",
-                        self.output()[str(sample)]["rep_seqs"].path,
-                        "--o-denoising-stats",
-                        self.output()[str(sample)]["stats"].path,
-                        "--verbose"]
-
-                output = run_cmd(cmd, self)
-
-                # Write a log file
-                with self.output()[str(sample)]["log"].open('wb') as fh:
-                    fh.write(output)
+            return {
+                str(sample): self._denoise_run(str(sample), n_threads)
+                for sample in self.samples
+            }
+        # Single run
         else:
-            # Run dada2
-            cmd = ["qiime",
-                    "dada2",
-                    "denoise-paired",
-                    "--i-demultiplexed-seqs",
-                    self.input().path,
-                    "--p-trim-left-f",
-                    self.trim_left_f,
-                    "--p-trunc-len-f",
-                    self.trunc_len_f,
-                    "--p-trim-left-r",
-                    self.trim_left_r,
-                    "--p-trunc-len-r",
-                    self.trunc_len_r,
-                    "--p-n-threads",
-                    self.n_cores,
-                    "--o-table",
-                    self.output()["table"].path,
-                    "--o-representative-sequences",
-                    self.output()["rep_seqs"].path,
-                    "--o-denoising-stats",
-                    self.output()["stats"].path,
-                    "--verbose"]
+            return self._denoise_run("", self.n_cores)
+
+    def output(self):
+        # Same structure as before; downstream tasks read it via input()
+        return luigi.task.getpaths(self.requires())
 
-            output = run_cmd(cmd, self)
+class Merge_Denoise(Fingerprinted_Task):
+    """
+    Merge feature tables and representative sequences of all runs.
 
-            # Write a log file
-            with self.output()["log"].open('wb') as fh:
-                fh.write(output)
+    The denoised runs included in the merged artifacts are recorded in
+    merged_runs.json. In incremental mode, runs added to the manifest since
+    the last merge are folded into the existing merged artifacts instead of
+    merging every run again; if a merged run changed or was removed, all
+    runs are merged.
+    """
+    # Fold new runs into the existing merged artifacts
+    incremental = luigi.Parameter(default='n')
 
-class Merge_Denoise(luigi.Task):
     samples = Samples().get_samples()
     is_multiple = str2bool(Samples().is_multiple)
     out_dir = Output_Dirs().denoise_dir
 
+    # Same merged artifacts either way
+    ignore_params = ("incremental",)
+
     def requires(self):
         return Denoise()
 
     def output(self):
         merged_table = os.path.join(self.out_dir, "merged_table.qza")
         merged_seqs = os.path.join(self.out_dir, "merged_rep_seqs.qza")
+        merged_runs = os.path.join(self.out_dir, "merged_runs.json")
 
         output = {
                 'table': luigi.LocalTarget(merged_table),
-                'rep_seqs': luigi.LocalTarget(merged_seqs)
+                'rep_seqs': luigi.LocalTarget(merged_seqs),
+                'runs': luigi.LocalTarget(merged_runs)
                 }
 
         return output
 
+    def run_fingerprints(self):
+        """
+        Fingerprint of each denoised run (see Fingerprinted_Task).
+        """
+        runs = self.requires().requires()
+
+        # Single run
+        if not(isinstance(runs, dict)):
+            runs = {"": runs}
+
+        return {run_ID: task_fingerprint(task) for run_ID, task in runs.items()}
+
+    def set_aside_outputs(self):
+        """
+        Move merged artifacts of the previous merge out of the way.
+
+        They may be hard links into the artifact cache, so they are moved
+        (not overwritten) and can still be read for an incremental merge.
+
+        Returns:
+            - dictionary of output name to the moved file
+        """
+        previous = {}
+        for name, path in flatten_output_paths(self.output()).items():
+            if(os.path.isfile(path)):
+                moved = os.path.join(os.path.dirname(path),
+                        ".previous_" + os.path.basename(path))
+                os.replace(path, moved)
+                previous[name] = moved
+
+        return previous
+
+    def restore_outputs(self, previous):
+        """
+        Move the set aside artifacts back (see set_aside_outputs),
+        replacing partial outputs of a failed merge.
+        """
+        outputs = flatten_output_paths(self.output())
+        for name, moved in previous.items():
+            if(os.path.exists(moved)):
+                os.replace(moved, outputs[name])
+
+    def runs_to_merge(self, previous):
+        """
+        Runs to merge and whether they are merged into the previous merged
+        artifacts.
+
+        Returns:
+            - list of run IDs
+            - True if the runs are folded into the previous merge
+        """
+        runs = self.run_fingerprints()
+
+        if not(str2bool(self.incremental) and
+                set(previous) == set(self.output())):
+            return sorted(runs), False
+
+        with open(previous['runs'], 'r') as fh:
+            merged_runs = json.load(fh)
+
+        # Merged runs must be unchanged
+        if(any(runs.get(run_ID) != fingerprint
+                for run_ID, fingerprint in merged_runs.items())):
+            return sorted(runs), False
+
+        return sorted(set(runs).difference(merged_runs)), True
+
     def run(self):
         # Make output directory
         run_cmd(['mkdir',
@@ -576,6 +978,30 @@ class Merge_Denoise(luigi.Task):
                 self.out_dir],
                 self)
 
+        previous = self.set_aside_outputs()
+
+        try:
+            self.merge(previous)
+        except BaseException:
+            # Keep the last good merge for the next (incremental) merge
+            self.restore_outputs(previous)
+            raise
+
+        for path in previous.values():
+            if(os.path.exists(path)):
+                os.remove(path)
+
+    @cache_outputs
+    def merge(self, previous):
+        run_IDs, fold = self.runs_to_merge(previous)
+
+        # Nothing new since the previous merge
+        if(fold and len(run_IDs) == 0):
+            for name, path in previous.items():
+                os.replace(path, self.output()[name].path)
+
+            return
+
         # Multiple runs
         if(self.is_multiple):
             table_cmd = ['qiime',
@@ -590,15 +1016,26 @@ class Merge_Denoise(luigi.Task):
                         '--o-merged-data',
                         self.output()['rep_seqs'].path]
 
-            for sample in self.samples:
+            if(fold):
+                logger.info("{step}: merging run(s) {runs} into the existing merged artifacts".format(
+                    step=str(self),
+                    runs=", ".join(run_IDs)))
+
+                table_cmd.append('--i-tables')
+                table_cmd.append(previous['table'])
+
+                seqs_cmd.append('--i-data')
+                seqs_cmd.append(previous['rep_seqs'])
+
+            for sample in run_IDs:
                 table_cmd.append('--i-tables')
                 table_cmd.append(self.input()[str(sample)]['table'].path)
 
                 seqs_cmd.append('--i-data')
                 seqs_cmd.append(self.input()[str(sample)]['rep_seqs'].path)
 
-            run_cmd(table_cmd, self)
-            run_cmd(seqs_cmd, self)
+            run_qiime(table_cmd, self)
+            run_qiime(seqs_cmd, self)
         # Single run
         else:
             run_cmd(['cp',
@@ -611,7 +1048,10 @@ class Merge_Denoise(luigi.Task):
                     self.output()['rep_seqs'].path],
                     self)
 
-class Merge_Denoise_Stats(luigi.Task):
+        with self.output()['runs'].open('w') as fh:
+            json.dump(self.run_fingerprints(), fh, indent=2, sort_keys=True)
+
+class Merge_Denoise_Stats(Fingerprinted_Task):
     dada2_dir = Output_Dirs().denoise_dir
     out_dir = Output_Dirs().denoise_dir
 
@@ -641,7 +1081,7 @@ class Merge_Denoise_Stats(luigi.Task):
         stats_df.to_json(self.output()["json"].path, orient='index')
         stats_artifact.save(self.output()["qza"].path)
 
-class Sample_Count_Summary(luigi.Task):
+class Sample_Count_Summary(Fingerprinted_Task):
     out_dir = Output_Dirs().denoise_dir
 
     def requires(self):
@@ -671,15 +1111,30 @@ class Sample_Count_Summary(luigi.Task):
                 self.output()["tsv"].path,
                 self.output()["json"].path)
 
-class Taxonomic_Classification(luigi.Task):
+class Taxonomic_Classification(Fingerprinted_Task):
+    """
+    Classify representative sequences with classify-sklearn.
+
+    If cache_path is set, classifications are kept in a SQLite cache keyed
+    by classifier and sequence, and only sequences not seen before with
+    the same classifier are classified (batch_size sequences at a time).
+    """
     classifier = luigi.Parameter()
     n_cores = luigi.Parameter(default="1")
+    cache_path = luigi.Parameter(default="")
+    batch_size = luigi.Parameter(default="10000")
 
     out_dir = Output_Dirs().taxonomy_dir
+    # Classifier is identified by its content, not its path
+    ignore_params = ("n_cores", "classifier", "cache_path", "batch_size")
+    fingerprint_files = ("classifier",)
 
     def requires(self):
         return Merge_Denoise()
 
+    def cache_inputs(self):
+        return [self.input()["rep_seqs"].path, self.classifier]
+
     def output(self):
         classified_taxonomy = os.path.join(self.out_dir, "taxonomy.qza")
 
@@ -689,6 +1144,7 @@ class Taxonomic_Classification(luigi.Task):
 
         return output
 
+    @cache_outputs
     def run(self):
         # Make output directory
         run_cmd(["mkdir",
@@ -696,6 +1152,17 @@ class Taxonomic_Classification(luigi.Task):
                 self.out_dir],
                 self)
 
+        if(self.cache_path):
+            classify_with_cache(
+                    self.input()["rep_seqs"].path,
+                    self.classifier,
+                    self.output()["taxonomy"].path,
+                    self.cache_path,
+                    batch_size=self.batch_size,
+                    n_jobs=self.n_cores)
+
+            return
+
         # Run qiime classifier
         cmd = ["qiime",
                 "feature-classifier",
@@ -710,9 +1177,9 @@ class Taxonomic_Classification(luigi.Task):
                 self.n_cores,
                 "--verbose"]
 
-        output = run_cmd(cmd, self)
+        output = run_qiime(cmd, self)
 
-class Export_Feature_Table(luigi.Task):
+class Export_Feature_Table(Fingerprinted_Task):
     export_dir = Output_Dirs().export_dir
 
     def requires(self):
@@ -739,9 +1206,9 @@ class Export_Feature_Table(luigi.Task):
                 "--output-path",
                 os.path.dirname(self.output().path)]
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
-class Export_Taxonomy(luigi.Task):
+class Export_Taxonomy(Fingerprinted_Task):
     out_dir = Output_Dirs().taxonomy_dir
 
     def requires(self):
@@ -769,9 +1236,9 @@ class Export_Taxonomy(luigi.Task):
                 "--output-path",
                 os.path.dirname(self.output().path)]
 
-        run_cmd(cmd, step)
+        run_qiime(cmd, step)
 
-class Export_Representative_Seqs(luigi.Task):
+class Export_Representative_Seqs(Fingerprinted_Task):
     out_dir = Output_Dirs().analysis_dir
 
     def requires(self):
@@ -798,9 +1265,9 @@ class Export_Representative_Seqs(luigi.Task):
                 "--output-path",
                 os.path.dirname(self.output().path)]
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
-class Convert_Feature_Table_to_TSV(luigi.Task):
+class Convert_Feature_Table_to_TSV(Fingerprinted_Task):
     out_dir = Output_Dirs().denoise_dir
 
     def requires(self):
@@ -829,7 +1296,16 @@ class Convert_Feature_Table_to_TSV(luigi.Task):
             index_label="SampleID"
         ) 
 
-class Generate_Combined_Feature_Table(luigi.Task):
+class Generate_Combined_Feature_Table(Fingerprinted_Task):
+    # Write the table row by row instead of building it in memory
+    streaming = luigi.Parameter(default='n')
+    # Also write ASV_abundance_filtered.tsv (Subset_ASV_By_Abundance) from
+    # the same loaded inputs
+    write_abundance_subset = luigi.Parameter(default='n')
+
+    # Same output either way
+    ignore_params = ("streaming", "write_abundance_subset")
+
     out_dir = Output_Dirs().analysis_dir
 
     def requires(self):
@@ -858,22 +1334,42 @@ class Generate_Combined_Feature_Table(luigi.Task):
                 self.out_dir],
                 self)
 
+        abundance_subset = None
+        if(str2bool(self.write_abundance_subset)):
+            subset_task = Subset_ASV_By_Abundance()
+            run_cmd(["mkdir",
+                    "-p",
+                    subset_task.export_dir],
+                    self)
+            abundance_subset = (float(subset_task.threshold), subset_task.output().path)
+
         combine_table(self.input()["Merge_Denoise"]["table"].path,
                     self.input()["Export_Representative_Seqs"].path,
                     self.input()["Taxonomic_Classification"]["taxonomy"].path,
-                    self.output()["table"].path)
+                    self.output()["table"].path,
+                    streaming=str2bool(self.streaming),
+                    abundance_subset=abundance_subset)
+
+        # Subset_ASV_By_Abundance is complete; it will not redo the work
+        if(abundance_subset is not None):
+            subset_task.write_output_manifest()
 
         # Write log files
         #with self.output()["log"].open('w') as fh:
         #    fh.write(logged_pre_rarefied)
 
-class Phylogeny_Tree(luigi.Task):
+class Phylogeny_Tree(Fingerprinted_Task):
     out_dir = Output_Dirs().phylogeny_dir
     n_cores = luigi.Parameter(default="1")
 
+    ignore_params = ("n_cores",)
+
     def requires(self):
         return Merge_Denoise()
 
+    def cache_inputs(self):
+        return [self.input()["rep_seqs"].path]
+
     def output(self):
         alignment = os.path.join(self.out_dir,
                 "aligned_rep_seqs.qza")
@@ -893,6 +1389,7 @@ class Phylogeny_Tree(luigi.Task):
 
         return out
 
+    @cache_outputs
     def run(self):
         # Create output directory
         run_cmd(['mkdir',
@@ -917,9 +1414,24 @@ class Phylogeny_Tree(luigi.Task):
                 self.output()['rooted_tree'].path
         ]
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
+
+def taxa_collapse_targets(out_dir):
+    """
+    Collapsed table targets (.qza and .tsv) for each taxonomic level.
+    """
+    output = {}
+    for taxa in TAXA_LEVELS:
+        prefix = os.path.join(out_dir, taxa + "_collapsed_table")
+
+        output[taxa] = {
+            "qza": luigi.LocalTarget(prefix + ".qza"),
+            "tsv": luigi.LocalTarget(prefix + ".tsv")
+        }
 
-class Taxa_Collapse(luigi.Task):
+    return output
+
+class Taxa_Collapse(Fingerprinted_Task):
     out_dir = Output_Dirs().taxonomy_dir
 
     def requires(self):
@@ -928,32 +1440,7 @@ class Taxa_Collapse(luigi.Task):
                 }
 
     def output(self):
-        domain_collapsed_table = os.path.join(self.out_dir,
-                "domain_collapsed_table.qza")
-        phylum_collapsed_table = os.path.join(self.out_dir,
-                "phylum_collapsed_table.qza")
-        class_collapsed_table = os.path.join(self.out_dir,
-                "class_collapsed_table.qza")
-        order_collapsed_table = os.path.join(self.out_dir,
-                "order_collapsed_table.qza")
-        family_collapsed_table = os.path.join(self.out_dir,
-                "family_collapsed_table.qza")
-        genus_collapsed_table = os.path.join(self.out_dir,
-                "genus_collapsed_table.qza")
-        species_collapsed_table = os.path.join(self.out_dir,
-                "species_collapsed_table.qza")
-
-        output = {
-            "domain": luigi.LocalTarget(domain_collapsed_table),
-            "phylum": luigi.LocalTarget(phylum_collapsed_table),
-            "class": luigi.LocalTarget(class_collapsed_table),
-            "order": luigi.LocalTarget(order_collapsed_table),
-            "family": luigi.LocalTarget(family_collapsed_table),
-            "genus": luigi.LocalTarget(genus_collapsed_table),
-            "species": luigi.LocalTarget(species_collapsed_table)
-        }
-
-        return output
+        return taxa_collapse_targets(self.out_dir)
 
     def run(self):
         # Make output directory
@@ -962,82 +1449,28 @@ class Taxa_Collapse(luigi.Task):
                 self.out_dir],
                 self)
 
-        # Taxa collapse
-        taxa_keys = ["domain", "phylum", "class", "order", "family", "genus",
-                "species"]
-
-        # Taxa level; 1=domain, 7=species
-        level = 1
-        for taxa in taxa_keys:
-            cmd = ["qiime",
-                    "taxa",
-                    "collapse",
-                    "--i-table",
-                    self.input()["Merge_Denoise"]["table"].path,
-                    "--i-taxonomy",
-                    self.input()["Taxonomic_Classification"]["taxonomy"].path,
-                    "--p-level",
-                    str(level),
-                    "--o-collapsed-table",
-                    self.output()[taxa].path]
-
-            level = level + 1
+        # Collapse to all levels at once; writes both .qza and .tsv
+        output_paths = {
+            taxa: {key: target.path for key, target in targets.items()}
+            for taxa, targets in self.output().items()
+        }
 
-            run_cmd(cmd, self)
-
-class Export_Taxa_Collapse(luigi.Task):
-    out_dir = Output_Dirs().taxonomy_dir
+        collapse_taxa_all_levels(
+                self.input()["Merge_Denoise"]["table"].path,
+                self.input()["Taxonomic_Classification"]["taxonomy"].path,
+                output_paths)
 
+class Export_Taxa_Collapse(luigi.WrapperTask):
+    """
+    Collapsed tables as .tsv; written together with the .qza by Taxa_Collapse.
+    """
     def requires(self):
         return Taxa_Collapse()
 
     def output(self):
-        exported_domain_collapsed_table = os.path.join(self.out_dir,
-                "domain_collapsed_table.tsv")
-        exported_phylum_collapsed_table = os.path.join(self.out_dir,
-                "phylum_collapsed_table.tsv")
-        exported_class_collapsed_table = os.path.join(self.out_dir,
-                "class_collapsed_table.tsv")
-        exported_order_collapsed_table = os.path.join(self.out_dir,
-                "order_collapsed_table.tsv")
-        exported_family_collapsed_table = os.path.join(self.out_dir,
-                "family_collapsed_table.tsv")
-        exported_genus_collapsed_table = os.path.join(self.out_dir,
-                "genus_collapsed_table.tsv")
-        exported_species_collapsed_table = os.path.join(self.out_dir,
-                "species_collapsed_table.tsv")
+        return {taxa: targets["tsv"] for taxa, targets in self.input().items()}
 
-        output = {
-            "domain": luigi.LocalTarget(exported_domain_collapsed_table),
-            "phylum": luigi.LocalTarget(exported_phylum_collapsed_table),
-            "class": luigi.LocalTarget(exported_class_collapsed_table),
-            "order": luigi.LocalTarget(exported_order_collapsed_table),
-            "family": luigi.LocalTarget(exported_family_collapsed_table),
-            "genus": luigi.LocalTarget(exported_genus_collapsed_table),
-            "species": luigi.LocalTarget(exported_species_collapsed_table)
-        }
-
-        return output
-
-    def run(self):
-        # Make output dir
-        run_cmd(["mkdir",
-                "-p",
-                self.out_dir],
-                self)
-
-        # Taxa collapse
-        taxa_keys = ["domain", "phylum", "class", "order", "family", "genus",
-                "species"]
-
-        for taxa in taxa_keys:
-            output = artifact_helper.convert(self.input()[taxa].path)
-            collapsed_df = output["feature_table"]
-
-            collapsed_df.to_csv(self.output()[taxa].path, sep="\t",
-                    index_label="SampleID")
-
-class Filtered_Taxa_Collapse(luigi.Task):
+class Filtered_Taxa_Collapse(Fingerprinted_Task):
     filtered_taxonomy_dir = Output_Dirs().filtered_taxonomy_dir
 
     def requires(self):
@@ -1046,32 +1479,7 @@ class Filtered_Taxa_Collapse(luigi.Task):
                 }
 
     def output(self):
-        domain_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "domain_collapsed_table.qza")
-        phylum_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "phylum_collapsed_table.qza")
-        class_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "class_collapsed_table.qza")
-        order_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "order_collapsed_table.qza")
-        family_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "family_collapsed_table.qza")
-        genus_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "genus_collapsed_table.qza")
-        species_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "species_collapsed_table.qza")
-
-        output = {
-            "domain": luigi.LocalTarget(domain_collapsed_table),
-            "phylum": luigi.LocalTarget(phylum_collapsed_table),
-            "class": luigi.LocalTarget(class_collapsed_table),
-            "order": luigi.LocalTarget(order_collapsed_table),
-            "family": luigi.LocalTarget(family_collapsed_table),
-            "genus": luigi.LocalTarget(genus_collapsed_table),
-            "species": luigi.LocalTarget(species_collapsed_table)
-        }
-
-        return output
+        return taxa_collapse_targets(self.filtered_taxonomy_dir)
 
     def run(self):
         # Make output directory
@@ -1080,87 +1488,35 @@ class Filtered_Taxa_Collapse(luigi.Task):
                 self.filtered_taxonomy_dir],
                 self)
 
-        # Taxa collapse
-        taxa_keys = ["domain", "phylum", "class", "order", "family", "genus",
-                "species"]
-
-        # Taxa level; 1=domain, 7=species
-        level = 1
-        for taxa in taxa_keys:
-            cmd = ["qiime",
-                    "taxa",
-                    "collapse",
-                    "--i-table",
-                    self.input()["Filter_Feature_Table"].path,
-                    "--i-taxonomy",
-                    self.input()["Taxonomic_Classification"]["taxonomy"].path,
-                    "--p-level",
-                    str(level),
-                    "--o-collapsed-table",
-                    self.output()[taxa].path]
-
-            level = level + 1
-
-            run_cmd(cmd, self)
+        # Collapse to all levels at once; writes both .qza and .tsv
+        output_paths = {
+            taxa: {key: target.path for key, target in targets.items()}
+            for taxa, targets in self.output().items()
+        }
 
-class Export_Filtered_Taxa_Collapse(luigi.Task):
-    filtered_taxonomy_dir = Output_Dirs().filtered_taxonomy_dir
+        collapse_taxa_all_levels(
+                self.input()["Filter_Feature_Table"].path,
+                self.input()["Taxonomic_Classification"]["taxonomy"].path,
+                output_paths)
 
+class Export_Filtered_Taxa_Collapse(luigi.WrapperTask):
+    """
+    Filtered collapsed tables as .tsv; written by Filtered_Taxa_Collapse.
+    """
     def requires(self):
         return Filtered_Taxa_Collapse()
 
     def output(self):
-        exported_domain_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "domain_collapsed_table.tsv")
-        exported_phylum_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "phylum_collapsed_table.tsv")
-        exported_class_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "class_collapsed_table.tsv")
-        exported_order_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "order_collapsed_table.tsv")
-        exported_family_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "family_collapsed_table.tsv")
-        exported_genus_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "genus_collapsed_table.tsv")
-        exported_species_collapsed_table = os.path.join(self.filtered_taxonomy_dir,
-                "species_collapsed_table.tsv")
-
-        output = {
-            "domain": luigi.LocalTarget(exported_domain_collapsed_table),
-            "phylum": luigi.LocalTarget(exported_phylum_collapsed_table),
-            "class": luigi.LocalTarget(exported_class_collapsed_table),
-            "order": luigi.LocalTarget(exported_order_collapsed_table),
-            "family": luigi.LocalTarget(exported_family_collapsed_table),
-            "genus": luigi.LocalTarget(exported_genus_collapsed_table),
-            "species": luigi.LocalTarget(exported_species_collapsed_table)
-        }
-
-        return output
-
-    def run(self):
-        # Make output dir
-        run_cmd(["mkdir",
-                "-p",
-                self.collapse_dir],
-                self)
-
-        # Taxa collapse
-        taxa_keys = ["domain", "phylum", "class", "order", "family", "genus",
-                "species"]
-
-        for taxa in taxa_keys:
-            output = artifact_helper.convert(self.input()[taxa].path)
-            collapsed_df = output["feature_table"]
-
-            collapsed_df.to_csv(self.output()[taxa].path, sep="\t",
-                    index_label="SampleID")
+        return {taxa: targets["tsv"] for taxa, targets in self.input().items()}
 
 # Post Analysis
 # Filter sample by metadata
-class Filter_Feature_Table(luigi.Task):
+class Filter_Feature_Table(Fingerprinted_Task):
     metadata_file = Samples().metadata_file
     out_dir = Output_Dirs().analysis_dir
 
+    fingerprint_files = ("metadata_file",)
+
     def requires(self):
         return Merge_Denoise()
 
@@ -1187,9 +1543,9 @@ class Filter_Feature_Table(luigi.Task):
                 "--o-filtered-table",
                 self.output().path]
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
-class Summarize_Filtered_Table(luigi.Task):
+class Summarize_Filtered_Table(Fingerprinted_Task):
     filtered_dir = Output_Dirs().filtered_dir
 
     def requires(self):
@@ -1219,7 +1575,7 @@ class Summarize_Filtered_Table(luigi.Task):
                 self.output()["tsv"].path,
                 self.output()["json"].path)
 
-class Export_Filtered_Table(luigi.Task):
+class Export_Filtered_Table(Fingerprinted_Task):
     filtered_dir = Output_Dirs().filtered_dir
 
     def requires(self):
@@ -1243,7 +1599,7 @@ class Export_Filtered_Table(luigi.Task):
         collapsed_df.T.to_csv(self.output().path, sep="\t",
                 index_label="SampleID")
 
-class Generate_Combined_Filtered_Feature_Table(luigi.Task):
+class Generate_Combined_Filtered_Feature_Table(Fingerprinted_Task):
     filtered_dir = Output_Dirs().filtered_dir
 
     def requires(self):
@@ -1278,10 +1634,14 @@ class Generate_Combined_Filtered_Feature_Table(luigi.Task):
                     self.output()["table"].path)
 
 # Most of these require rarefaction depth as a user parameter
-class Core_Metrics_Phylogeny(luigi.Task):
+class Core_Metrics_Phylogeny(Fingerprinted_Task):
     sampling_depth = Samples().sampling_depth
     metadata_file = Samples().metadata_file
     out_dir = Output_Dirs().core_metric_dir
+    rarefaction = rarefaction_settings()
+
+    fingerprint_attrs = ("sampling_depth", "rarefaction")
+    fingerprint_files = ("metadata_file",)
 
     def requires(self):
         return {
@@ -1419,12 +1779,15 @@ class Core_Metrics_Phylogeny(luigi.Task):
             cmd.append('--m-metadata-file')
             cmd.append(metadata)
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
-class Rarefy(luigi.Task):
+class Rarefy(Fingerprinted_Task):
     sampling_depth = luigi.Parameter(default="10000")
 
     rarefy_dir = Output_Dirs().rarefy_dir
+    rarefaction = rarefaction_settings()
+
+    fingerprint_attrs = ("rarefaction",)
 
     def requires(self):
         return Merge_Denoise()
@@ -1444,7 +1807,7 @@ class Rarefy(luigi.Task):
 
         # If sampling depth is 0, automatically determine sampling depth
         if(self.sampling_depth == '0'):
-            sampling_depth = auto_sampling_depth(self.input()['Merge_Denoise'].path)
+            sampling_depth = auto_sampling_depth(self.input()['table'].path)
         else:
             sampling_depth = self.sampling_depth
 
@@ -1459,9 +1822,9 @@ class Rarefy(luigi.Task):
                 "--o-rarefied-table",
                 self.output().path
                 ]
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
-class Export_Rarefy_Feature_Table(luigi.Task):
+class Export_Rarefy_Feature_Table(Fingerprinted_Task):
 
     def requires(self):
         return Rarefy()
@@ -1488,9 +1851,9 @@ class Export_Rarefy_Feature_Table(luigi.Task):
                 "--output-path",
                 os.path.dirname(self.output().path)]
 
-        run_cmd(cmd, step)
+        run_qiime(cmd, step)
 
-class Convert_Rarefy_Table_to_TSV(luigi.Task):
+class Convert_Rarefy_Table_to_TSV(Fingerprinted_Task):
 
     def requires(self):
         return Rarefy()
@@ -1520,7 +1883,7 @@ class Convert_Rarefy_Table_to_TSV(luigi.Task):
 
         run_cmd(cmd, step)
 
-class Generate_Combined_Rarefied_Feature_Table(luigi.Task):
+class Generate_Combined_Rarefied_Feature_Table(Fingerprinted_Task):
     rarefy_export_dir = Output_Dirs().rarefy_export_dir
 
     def requires(self):
@@ -1556,7 +1919,7 @@ class Generate_Combined_Rarefied_Feature_Table(luigi.Task):
                     self.input()["Export_Taxonomy"].path,
                     self.output()["rarefied_table"].path)
 
-class Subset_ASV_By_Abundance(luigi.Task):
+class Subset_ASV_By_Abundance(Fingerprinted_Task):
     """
     Subsets ASV table by % abundance
     """
@@ -1579,26 +1942,31 @@ class Subset_ASV_By_Abundance(luigi.Task):
                 self.export_dir],
                 self)
 
-        # Run abundance subset script
-        abundance_subset_script = os.path.join(qiime2_helper_dir,
-                "filter_by_abundance.py")
+        # Already written together with the combined table
+        # (Generate_Combined_Feature_Table write_abundance_subset)
+        if(self.complete()):
+            return
 
-        abundance_subset_cmd = ["python",
-                                abundance_subset_script,
-                                "--asv",
-                                self.input()["table"].path,
-                                "--threshold",
-                                self.threshold,
-                                "--output",
-                                self.output().path]
+        # Filter the feature table artifact in process; same output as
+        # filter_by_abundance.py on the combined table
+        combined_inputs = self.requires().input()
 
-        run_cmd(abundance_subset_cmd, self)
+        subset_by_abundance(combined_inputs["Merge_Denoise"]["table"].path,
+                combined_inputs["Export_Representative_Seqs"].path,
+                combined_inputs["Taxonomic_Classification"]["taxonomy"].path,
+                self.output().path,
+                float(self.threshold))
 
-class Faprotax(luigi.Task):
+class Faprotax(Fingerprinted_Task):
     """
     Runs FAPROTAX (current version 1.2.1)
     """
     faprotax_dir = Output_Dirs().faprotax_dir
+    # Directory to keep the parsed FAPROTAX database and lineage memo; empty
+    # to disable
+    cache_dir = luigi.Parameter(default="")
+
+    ignore_params = ("cache_dir",)
 
     def requires(self):
         return Subset_ASV_By_Abundance()
@@ -1628,35 +1996,23 @@ class Faprotax(luigi.Task):
         # Path to faprotax database
         faprotax_db = os.path.join(FAPROTAX, "FAPROTAX.txt")
 
-        faprotax_cmd = ["python2",
-                        faprotax_script,
-                        '-i',
-                        self.input().path,
-                        '-o',
-                        self.output()['table'].path,
-                        '-g',
-                        faprotax_db,
-                        '-c',
-                        "#",
-                        '-d',
-                        "Consensus.Lineage",
-                        '--omit_columns',
-                        "0,1",
-                        '-r',
-                        self.output()["report"].path,
-                        '-n',
-                        "columns_after_collapsing",
-                        '--omit_samples',
-                        "ReprSequence",
-                        '--force',
-                        '-v']
-
-        faprotax_log = run_cmd(faprotax_cmd, self)
+        # Same outputs as running collapse_table.py (python2); the report
+        # records the equivalent command
+        faprotax_log = faprotax.collapse_table(self.input().path,
+                faprotax_db,
+                self.output()['table'].path,
+                self.output()["report"].path,
+                command=faprotax.collapse_table_command(faprotax_script,
+                    self.input().path,
+                    faprotax_db,
+                    self.output()['table'].path,
+                    self.output()["report"].path),
+                cache_dir=self.cache_dir)
 
         with self.output()["log"].open('w') as fh:
-            fh.write(faprotax_log)
+            fh.write(faprotax_log.encode())
 
-class Picrust(luigi.Task):
+class Picrust(Fingerprinted_Task):
     """
     Run PICRUST2 (installed as QIIME2 plugin)
     """
@@ -1667,6 +2023,8 @@ class Picrust(luigi.Task):
     p_hsp_method = luigi.Parameter(default='mp')
     max_nsti = luigi.Parameter(default='2')
 
+    ignore_params = ("threads",)
+
     def requires(self):
         return Merge_Denoise()
 
@@ -1714,12 +2072,12 @@ class Picrust(luigi.Task):
                         self.max_nsti,
                         '--verbose']
 
-        log_output = run_cmd(picrust_cmd, self)
+        log_output = run_qiime(picrust_cmd, self)
 
         #with self.output['log'].open('w') as fh:
         #    fh.write(log_output)
 
-class Export_Picrust(luigi.Task):
+class Export_Picrust(Fingerprinted_Task):
     picrust_dir = Output_Dirs().picrust_dir
     def requires(self):
         return Picrust()
@@ -1770,7 +2128,7 @@ class Export_Picrust(luigi.Task):
         run_cmd(ko_command, self)
 
 # Visualizations
-class Denoise_Tabulate(luigi.Task):
+class Denoise_Tabulate(Fingerprinted_Task):
     samples = Samples().get_samples()
     is_multiple = str2bool(Samples().is_multiple)
     out_dir = Output_Dirs().denoise_dir
@@ -1818,7 +2176,7 @@ class Denoise_Tabulate(luigi.Task):
                         "--o-visualization",
                         self.output()[str(sample)].path]
 
-                run_cmd(cmd, self)
+                run_qiime(cmd, self)
         else:
             # Run qiime metadata tabulate
             cmd = ["qiime",
@@ -1829,9 +2187,9 @@ class Denoise_Tabulate(luigi.Task):
                     "--o-visualization",
                     self.output().path]
 
-            run_cmd(cmd, self)
+            run_qiime(cmd, self)
 
-class Merge_Denoise_Tabulate(luigi.Task):
+class Merge_Denoise_Tabulate(Fingerprinted_Task):
     out_dir = Output_Dirs().denoise_dir
 
     def requires(self):
@@ -1857,10 +2215,10 @@ class Merge_Denoise_Tabulate(luigi.Task):
                 "--o-visualization",
                 self.output().path]
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
 
-class Sequence_Tabulate(luigi.Task):
+class Sequence_Tabulate(Fingerprinted_Task):
     out_dir = Output_Dirs().denoise_dir
 
     def requires(self):
@@ -1887,9 +2245,9 @@ class Sequence_Tabulate(luigi.Task):
                 "--o-visualization",
                 self.output().path]
 
-        run_cmd(cmd, self)
+        run_qiime(cmd, self)
 
-class Taxonomy_Tabulate(luigi.Task):
+class Taxonomy_Tabulate(Fingerprinted_Task):
     out_dir = Output_Dirs().taxonomy_dir
 
     def requires(self):
@@ -1918,11 +2276,24 @@ class Taxonomy_Tabulate(luigi.Task):
                 "--o-visualization",
                 self.output().path]
 
-        run_cmd(cmd, step)
+        run_qiime(cmd, step)
 
-class Rarefaction_Curves(luigi.Task):
+class Rarefaction_Curves(Fingerprinted_Task):
+    """
+    Alpha rarefaction curves (observed features and Shannon) of the
+    denoised feature table, and the sampling depth they suggest (see
+    Rarefaction). Curves go up to sampling_depth; with 0, up to the depth
+    keeping Rarefaction.retention of the samples.
+
+    engine 'qiime' also makes the QIIME2 visualization ('qiime diversity
+    alpha-rarefaction', which includes Faith's PD).
+    """
     sampling_depth = luigi.Parameter(default="10000")
+    engine = luigi.Parameter(default="native")
     out_dir = Output_Dirs().visualization_dir
+    rarefaction = rarefaction_settings()
+
+    fingerprint_attrs = ("rarefaction",)
 
     def requires(self):
         return {
@@ -1931,10 +2302,19 @@ class Rarefaction_Curves(luigi.Task):
                 }
 
     def output(self):
-        alpha_rarefaction = os.path.join(self.out_dir,
-                "alpha_rarefaction_" + self.max_depth + ".qzv")
+        prefix = os.path.join(self.out_dir,
+                "alpha_rarefaction_" + self.sampling_depth)
+
+        output = {
+            'curves': luigi.LocalTarget(prefix + ".tsv"),
+            'summary': luigi.LocalTarget(prefix + "_summary.tsv"),
+            'suggested_depth': luigi.LocalTarget(prefix + "_suggested_depth.json")
+        }
+
+        if(self.engine == 'qiime'):
+            output['visualization'] = luigi.LocalTarget(prefix + ".qzv")
 
-        return luigi.LocalTarget(alpha_rarefaction)
+        return output
 
     def run(self):
         # Make directory
@@ -1943,33 +2323,61 @@ class Rarefaction_Curves(luigi.Task):
                 self.out_dir],
                 self)
 
-        # If sampling depth is 0, automatically determine sampling depth
+        table_path = self.input()['Merge_Denoise']['table'].path
+        table = load_qiime2_artifact(table_path, sparse=True)
+        totals = cached_sample_totals(table_path)
+        config = Rarefaction()
+
+        # If sampling depth is 0, automatically determine maximum depth
         if(self.sampling_depth == '0'):
-            sampling_depth = auto_sampling_depth(self.input()['Merge_Denoise'].path)
+            max_depth = retention_depth(totals, config.retention)
         else:
-            sampling_depth = self.sampling_depth
+            max_depth = int(self.sampling_depth)
+
+        curves = alpha_rarefaction(table,
+                rarefaction_depths(max_depth, config.steps),
+                int(config.iterations),
+                rarefaction_seed())
+        curves.to_csv(self.output()['curves'].path, sep='\t', index=False)
+        curve_summary(curves).to_csv(self.output()['summary'].path, sep='\t')
+
+        suggested_depth = suggest_sampling_depth(curves, totals,
+                config.retention, config.saturation)
+        suggestion = {
+            'sampling_depth': suggested_depth,
+            'max_depth': max_depth,
+            'retention': float(config.retention),
+            'saturation': float(config.saturation),
+            'samples': int(len(totals)),
+            'samples_kept': int((totals >= suggested_depth).sum())
+        }
+        with open(self.output()['suggested_depth'].path, 'w') as fh:
+            json.dump(suggestion, fh, indent=2)
 
-        # Make alpha rarefaction curve
-        cmd = [
-                'qiime',
-                'diversity',
-                'alpha-rarefaction',
-                '--i-table',
-                self.input()['Merge_Denoise']['table'].path,
-                '--i-phylogeny',
-                self.input()['Phylogeny_Tree']['rooted_tree'].path,
-                '--p-max-depth',
-                sampling_depth,
-                '--o-visualization',
-                self.output().path
-                ]
+        if(self.engine == 'qiime'):
+            # Make alpha rarefaction curve
+            cmd = [
+                    'qiime',
+                    'diversity',
+                    'alpha-rarefaction',
+                    '--i-table',
+                    table_path,
+                    '--i-phylogeny',
+                    self.input()['Phylogeny_Tree']['rooted_tree'].path,
+                    '--p-max-depth',
+                    str(max_depth),
+                    '--o-visualization',
+                    self.output()['visualization'].path
+                    ]
 
-        run_cmd(cmd, self)
+            run_qiime(cmd, self)
 
-class Alpha_Group_Significance(luigi.Task):
+class Alpha_Group_Significance(Fingerprinted_Task):
     out_dir = Output_Dirs().analysis_dir
     metadata_file = Samples().metadata_file
 
+    fingerprint_files = ("metadata_file",)
+
     def requires(self):
         return Core_Metrics_Phylogeny()
 
@@ -2026,11 +2434,25 @@ class Alpha_Group_Significance(luigi.Task):
                     '--o-visualization',
                     self.output()[output_key].path]
 
-            run_cmd(cmd, self)
+            run_qiime(cmd, self)
+
+def lazy_pcoa_images():
+    return Plot_Rendering().pcoa_images == 'lazy'
+
+class PCoA_Plots(Fingerprinted_Task):
+    """
+    PCoA plots of each distance metric, coloured by each metadata column.
 
-class PCoA_Plots(luigi.Task):
+    Each plot is made once and saved both as a page of the metric's pdf
+    file and as an image in the metric's directory (for the web server).
+    With lazy PCoA images, only the pdf files are made.
+    """
     out_dir = Output_Dirs().pcoa_dir
     metadata_file = Samples().metadata_file
+    lazy_images = lazy_pcoa_images()
+
+    fingerprint_attrs = ("lazy_images",)
+    fingerprint_files = ("metadata_file",)
 
     def requires(self):
         return Core_Metrics_Phylogeny()
@@ -2044,6 +2466,8 @@ class PCoA_Plots(luigi.Task):
                 "bray_curtis_pcoa_plots.pdf")
         jaccard_pcoa = os.path.join(self.out_dir,
                 "jaccard_pcoa_plots.pdf")
+        json_summary = os.path.join(self.out_dir,
+                "pcoa_columns.json")
 
         output = {
                 'unweighted_unifrac_pcoa':
@@ -2054,6 +2478,10 @@ class PCoA_Plots(luigi.Task):
                 'jaccard_pcoa': luigi.LocalTarget(jaccard_pcoa)
                 }
 
+        # Made by PCoA_Image_Index with lazy images
+        if not(self.lazy_images):
+            output['pcoa_columns'] = luigi.LocalTarget(json_summary)
+
         return output
 
     def run(self):
@@ -2066,91 +2494,93 @@ class PCoA_Plots(luigi.Task):
 
             raise FileNotFoundError(msg)
 
-        # Make output directory
+        # Input PCoA artifacts to loop through, and their image directories
+        # (Keys are identical to output keys!)
+        metrics_outdir_map = {
+            metric: os.path.join(self.out_dir, metric_dir)
+            for metric, metric_dir in METRIC_DIRS.items()
+        }
+
+        # Make output directories
         run_cmd(['mkdir',
                 '-p',
-                self.out_dir],
+                self.out_dir] + list(metrics_outdir_map.values()),
                 self)
 
-        # Input PCoA artifacts to loop through
-        # (It's identical to output keys!)
-        metrics = ['unweighted_unifrac_pcoa', 'weighted_unifrac_pcoa',
-                'jaccard_pcoa', 'bray_curtis_pcoa']
+        # Load metadata once for all plots
+        metadata_df = load_metadata(self.metadata_file)
+
+        # Make PCoA plots for each distance metric; all plots are rendered
+        # together so that the rendering processes are kept busy
+        specs = []
+        for metric, outdir in metrics_outdir_map.items():
+            specs.extend(pcoa_plot_specs(
+                    convert_qiime2_2_skbio(self.input()[metric].path),
+                    metadata_df,
+                    self.output()[metric].path,
+                    None if self.lazy_images else outdir
+            ))
 
-        # Make PCoA plots for each distance metric
-        pcoa_plot_script = os.path.join(script_dir, "generate_multiple_pcoa.py")
-        for metric in metrics:
-            outdir = os.path.dirname(self.output()[metric].path)
-            filename = os.path.basename(self.output()[metric].path)
+        render_plots(specs, Plot_Rendering().workers)
 
-            generate_pdf(self.input()[metric].path,
-                        self.metadata_file,
-                        filename,
-                        outdir)
+        if not(self.lazy_images):
+            save_as_json(metadata_df, self.output()['pcoa_columns'].path)
 
-class PCoA_Plots_jpeg(luigi.Task):
+class PCoA_Image_Index(Fingerprinted_Task):
+    """
+    Summary of the PCoA images (pcoa_columns.json) and the ordination
+    coordinates of each distance metric, for images rendered on request
+    (lazy PCoA images).
+    """
     out_dir = Output_Dirs().pcoa_dir
     metadata_file = Samples().metadata_file
 
-    unweighted_unifrac_dir = os.path.join(out_dir, "unweighted_unifrac")
-    weighted_unifrac_dir = os.path.join(out_dir, "weighted_unifrac")
-    bray_curtis_dir = os.path.join(out_dir, "bray_curtis")
-    jaccard_dir = os.path.join(out_dir, "jaccard")
+    fingerprint_files = ("metadata_file",)
 
     def requires(self):
         return Core_Metrics_Phylogeny()
 
     def output(self):
-        json_summary = os.path.join(self.out_dir,
-                "pcoa_columns.json")
+        output = {
+            metric: luigi.LocalTarget(os.path.join(self.out_dir, metric_dir, ORDINATION_FILE))
+            for metric, metric_dir in METRIC_DIRS.items()
+        }
+        output['pcoa_columns'] = luigi.LocalTarget(
+                os.path.join(self.out_dir, "pcoa_columns.json"))
 
-        return luigi.LocalTarget(json_summary)
+        return output
 
     def run(self):
-        # Make sure Metadata file is provided and exists
-        if not(os.path.isfile(self.metadata_file)):
-            msg = dedent("""
-                    Metadata file is not provided or the provided Metadata file
-                    does not exist!
-                    """)
-
-            raise FileNotFoundError(msg)
-
-        # Make output directory
+        # Make output directories
         run_cmd(['mkdir',
                 '-p',
-                self.out_dir],
+                self.out_dir] + [os.path.dirname(self.output()[metric].path) for metric in METRIC_DIRS],
                 self)
 
-        # Input PCoA artifacts to loop through
-        # (It's identical to output keys!)
-        metrics_outdir_map = {
-            'unweighted_unifrac_pcoa': self.unweighted_unifrac_dir,
-            'weighted_unifrac_pcoa': self.weighted_unifrac_dir,
-            'jaccard_pcoa': self.jaccard_dir,
-            'bray_curtis_pcoa': self.bray_curtis_dir,
-        }
+        for metric in METRIC_DIRS:
+            save_ordination(convert_qiime2_2_skbio(self.input()[metric].path),
+                    self.output()[metric].path)
 
-        # Make PCoA plots for each distance metric
-        for metric in metrics_outdir_map:
-            outdir = metrics_outdir_map[metric]
+        save_as_json(load_metadata(self.metadata_file),
+                self.output()['pcoa_columns'].path)
 
-            # Make sub-output directory
-            run_cmd(['mkdir',
-                    '-p',
-                    outdir],
-                    self)
+class PCoA_Plots_jpeg(luigi.WrapperTask):
+    """
+    Per-column PCoA images and their summary (pcoa_columns.json); made by
+    PCoA_Plots together with the pdf files, or rendered on request (lazy
+    PCoA images).
+    """
+    def requires(self):
+        if(lazy_pcoa_images()):
+            return PCoA_Image_Index()
 
-            generate_images(
-                    self.input()[metric].path,
-                    self.metadata_file,
-                    outdir
-            )
+        return PCoA_Plots()
 
-        save_as_json(self.metadata_file, self.output().path)
+    def output(self):
+        return self.requires().output()['pcoa_columns']
 
 # Get software version info
-class Get_Version_Info(luigi.Task):
+class Get_Version_Info(Fingerprinted_Task):
     out_dir = Output_Dirs().out_dir
 
     def output(self):
@@ -2179,7 +2609,7 @@ class Get_Version_Info(luigi.Task):
             fh.write(classifier_path)
 
 # Dummy Class to run multiple tasks
-class Core_Analysis(luigi.Task):
+class Core_Analysis(Fingerprinted_Task):
     out_dir = Output_Dirs().out_dir
 
     def requires(self):
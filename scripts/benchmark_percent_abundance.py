@@ -0,0 +1,106 @@
+"""
+Benchmark percent abundance calculation: the previous DataFrame.apply
+implementation against the vectorized kernel (qiime2_helper/abundance.py).
+
+The default table is 5,000 features x 50,000 samples. A dense float64 copy
+of it takes 2 GB and the comparison keeps several copies, so it needs about
+8 GB of memory (use --rows and --cols for a smaller table).
+
+    python -m scripts.benchmark_percent_abundance --rows 5000 --cols 50000
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from scripts.qiime2_helper.abundance import proportions
+
+def args_parse():
+    """
+    Parse command line arguments into Python
+    """
+    parser = ArgumentParser(description = "Benchmark percent abundance calculation")
+
+    parser.add_argument('--rows', help="Number of features (rows)",
+            type=int,
+            default=5000)
+
+    parser.add_argument('--cols', help="Number of samples (columns)",
+            type=int,
+            default=50000)
+
+    parser.add_argument('--density', help="Fraction of non-zero counts",
+            type=float,
+            default=0.05)
+
+    parser.add_argument('--seed', help="Random seed",
+            type=int,
+            default=0)
+
+    parser.add_argument('--skip-apply', help="Do not run the apply-based version (slow)",
+            action='store_true')
+
+    return parser
+
+def apply_percent_value(df, axis=0):
+    """
+    Previous implementation (one pandas call per column).
+    """
+    def percent_value_operation(x):
+        series_length = x.size
+        series_sum = x.sum()
+
+        # percent value should be zero if sum is 0
+        all_zeros = np.zeros(series_length)
+        percent_values = x / series_sum if series_sum != 0 else pd.Series(all_zeros)
+
+        return percent_values
+
+    return df.apply(lambda x: percent_value_operation(x), axis=axis)
+
+def make_table(rows, cols, density, seed):
+    # scipy < 1.4 takes a RandomState, not a Generator
+    rng = np.random.RandomState(seed)
+    counts = sparse.random(rows, cols, density=density, format='csc',
+            random_state=rng,
+            data_rvs=lambda n: rng.randint(1, 1000, size=n).astype(float))
+
+    return counts
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+
+    print("{label:<32} {elapsed:>10.3f} s".format(label=label, elapsed=elapsed))
+    sys.stdout.flush()
+
+    return result
+
+if __name__ == "__main__":
+    args = args_parse().parse_args()
+
+    print("Table: {rows} x {cols}, density {density}".format(
+        rows=args.rows,
+        cols=args.cols,
+        density=args.density))
+
+    counts = make_table(args.rows, args.cols, args.density, args.seed)
+    df = pd.DataFrame(counts.toarray())
+
+    expected = timed("kernel (DataFrame, float64)", lambda: proportions(df))
+    timed("kernel (DataFrame, float32)", lambda: proportions(df, dtype=np.float32))
+    timed("kernel (ndarray, float64)", lambda: proportions(df.values))
+    sparse_result = timed("kernel (sparse, float64)", lambda: proportions(counts))
+
+    if not(np.array_equal(sparse_result.toarray(), expected.values)):
+        print("WARNING: sparse and dense results differ")
+
+    if not(args.skip_apply):
+        observed = timed("DataFrame.apply (previous)", lambda: apply_percent_value(df))
+
+        if not(np.array_equal(observed.values, expected.values)):
+            print("WARNING: apply and kernel results differ")
@@ -0,0 +1,104 @@
+"""
+Relative abundance (proportion) kernel shared by the table helpers.
+
+Each value is divided by its column (or row) sum in a single broadcast
+divide over the whole matrix, instead of one pandas call per column.
+Dense (pandas dataframe, numpy array) and scipy sparse matrices are
+supported. Columns (rows) that sum to zero stay at zero.
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Column proportions (value / column sum), as in DataFrame.apply(axis=0)
+COLUMN_AXIS = 0
+# Row proportions (value / row sum)
+ROW_AXIS = 1
+
+def _check_axis(axis):
+    if(axis not in (COLUMN_AXIS, ROW_AXIS)):
+        raise ValueError("axis must be 0 (columns) or 1 (rows), not '{}'".format(axis))
+
+def _divide(values, sums, dtype):
+    """
+    values / sums with zero sums giving zero; sums are broadcast against
+    values.
+    """
+    sums = np.asarray(sums).astype(dtype, copy=False)
+    result = np.zeros(np.broadcast(values, sums).shape, dtype=dtype)
+    np.divide(values, sums, out=result, where=(sums != 0))
+
+    return result
+
+def dense_proportions(values, axis=COLUMN_AXIS, dtype=np.float64):
+    """
+    Proportions of a dense 2D array.
+
+    Input:
+        - values: numpy array
+        - axis: 0 to divide by column sums, 1 to divide by row sums
+        - dtype: result type (np.float64 or np.float32)
+
+    Returns:
+        - numpy array of proportions (0 to 1)
+    """
+    _check_axis(axis)
+
+    values = np.asarray(values).astype(dtype, copy=False)
+    # Sums are accumulated in double precision; missing values are skipped
+    sums = np.nansum(values, axis=axis, dtype=np.float64, keepdims=True)
+
+    return _divide(values, sums, dtype)
+
+def sparse_proportions(matrix, axis=COLUMN_AXIS, dtype=np.float64):
+    """
+    Proportions of a scipy sparse matrix; only the stored values are
+    divided.
+
+    Returns:
+        - scipy CSR (axis=0) or CSC (axis=1) matrix of proportions
+    """
+    _check_axis(axis)
+
+    # Index of the column (row) of each stored value
+    if(axis == COLUMN_AXIS):
+        matrix = sparse.csr_matrix(matrix, dtype=dtype, copy=True)
+    else:
+        matrix = sparse.csc_matrix(matrix, dtype=dtype, copy=True)
+
+    matrix.sum_duplicates()
+    sums = np.asarray(matrix.sum(axis=axis, dtype=np.float64)).ravel()
+
+    matrix.data = _divide(matrix.data, sums[matrix.indices], dtype)
+
+    return matrix
+
+def proportions(table, axis=COLUMN_AXIS, dtype=np.float64):
+    """
+    Relative abundance of each value (value / column (row) sum).
+
+    Input:
+        - table: pandas dataframe, numpy array or scipy sparse matrix
+        - axis: 0 to divide by column sums, 1 to divide by row sums
+        - dtype: result type; np.float32 halves memory use on large tables
+
+    Returns:
+        - proportions (0 to 1) of the same kind as the input; dataframes keep
+            their index and columns
+    """
+    if(isinstance(table, pd.DataFrame)):
+        return pd.DataFrame(dense_proportions(table.values, axis, dtype),
+                index=table.index, columns=table.columns)
+
+    if(sparse.issparse(table)):
+        return sparse_proportions(table, axis, dtype)
+
+    return dense_proportions(table, axis, dtype)
+
+def series_proportions(series, dtype=np.float64):
+    """
+    Proportions of a single pandas series (value / series sum).
+    """
+    values = dense_proportions(series.values.reshape(-1, 1), COLUMN_AXIS, dtype)
+
+    return pd.Series(values.ravel(), index=series.index, name=series.name)
@@ -0,0 +1,271 @@
+"""
+Content-addressed cache for pipeline step outputs.
+
+A step is identified by a key computed from
+    - the step name,
+    - fingerprints of its inputs (QIIME2 artifact UUID for .qza/.qzv,
+      checksum for other files),
+    - its parameters and
+    - the tool version.
+Outputs of a step are stored under that key. When the same key is seen
+again (e.g. re-running a study under a new output prefix, or another
+project on the same server), the stored outputs are hard-linked (or
+symlinked/copied) into the new output location instead of recomputed.
+
+The cache is capped in size; least recently used entries are evicted.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Entry metadata file; its mtime marks last use for LRU eviction
+ENTRY_FILE = "entry.json"
+
+# Files larger than this are fingerprinted by size and mtime instead of
+# checksum (e.g. raw fastq files referenced by a manifest)
+FULL_HASH_LIMIT = 256 * 1024 * 1024
+
+LINK_MODES = ("hardlink", "symlink", "copy")
+
+# {(abs path, mtime, size): fingerprint}
+_fingerprints = {}
+
+def artifact_uuid(path):
+    """
+    UUID of QIIME2 artifact (.qza/.qzv); the top level directory of the zip.
+
+    Returns None if the file is not a QIIME2 archive.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+    if(len(names) == 0):
+        return None
+
+    return names[0].split('/')[0]
+
+def file_checksum(path, block_size=1024 * 1024):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+def file_fingerprint(path):
+    """
+    Fingerprint of an input file or directory.
+    """
+    abs_path = os.path.abspath(path)
+
+    if(os.path.isdir(abs_path)):
+        children = sorted(os.listdir(abs_path))
+        fingerprints = [name + "=" + file_fingerprint(os.path.join(abs_path, name))
+                for name in children]
+        return "dir:" + hashlib.sha256("\n".join(fingerprints).encode()).hexdigest()
+
+    stat = os.stat(abs_path)
+    memo_key = (abs_path, stat.st_mtime, stat.st_size)
+    if(memo_key in _fingerprints):
+        return _fingerprints[memo_key]
+
+    uuid = artifact_uuid(abs_path) if abs_path.endswith(('.qza', '.qzv')) else None
+    if(uuid is not None):
+        fingerprint = "uuid:" + uuid
+    elif(stat.st_size <= FULL_HASH_LIMIT):
+        fingerprint = "sha256:" + file_checksum(abs_path)
+    else:
+        fingerprint = "stat:{path}:{size}:{mtime}".format(
+                path=abs_path,
+                size=stat.st_size,
+                mtime=int(stat.st_mtime))
+
+    _fingerprints[memo_key] = fingerprint
+
+    return fingerprint
+
+def cache_key(step, input_paths, params, tool_version):
+    """
+    Key of a step execution.
+
+    Input:
+        - step: step (task) name
+        - input_paths: list of input file paths
+        - params: dictionary of parameters affecting the outputs
+        - tool_version: version of the tool producing the outputs
+    """
+    description = {
+        "step": step,
+        "inputs": sorted(file_fingerprint(path) for path in input_paths),
+        "params": {str(k): str(v) for k, v in params.items()},
+        "tool_version": tool_version
+    }
+    encoded = json.dumps(description, sort_keys=True).encode('utf-8')
+
+    return hashlib.sha256(encoded).hexdigest()
+
+def _place(src, dst, link):
+    """
+    Put src at dst using the link mode, falling back to copy.
+    """
+    if(os.path.lexists(dst)):
+        os.remove(dst)
+
+    parent = os.path.dirname(dst)
+    if(parent):
+        os.makedirs(parent, exist_ok=True)
+
+    if(link == "hardlink"):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif(link == "symlink"):
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+
+class ArtifactCache(object):
+    """
+    Outputs stored as <cache_dir>/<key[:2]>/<key>/<output name>.
+    """
+    def __init__(self, cache_dir, max_size_bytes, link="hardlink"):
+        if(link not in LINK_MODES):
+            raise ValueError("Unknown link mode '{}'".format(link))
+
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.link = link
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, outputs):
+        """
+        Place cached outputs at the requested paths.
+
+        Input:
+            - key: cache key
+            - outputs: dictionary of output name to destination path
+
+        Returns:
+            - True if all outputs were restored from the cache
+        """
+        entry_dir = self._entry_dir(key)
+        entry_file = os.path.join(entry_dir, ENTRY_FILE)
+
+        if not(os.path.isfile(entry_file)):
+            return False
+
+        with open(entry_file, 'r') as fh:
+            entry = json.load(fh)
+
+        stored = entry["outputs"]
+        if(set(stored) != set(outputs)):
+            return False
+
+        sources = {name: os.path.join(entry_dir, stored[name]) for name in outputs}
+        if not(all(os.path.exists(src) for src in sources.values())):
+            return False
+
+        for name, dst in outputs.items():
+            _place(sources[name], dst, self.link)
+
+        # Mark as recently used
+        os.utime(entry_file, None)
+
+        return True
+
+    def store(self, key, outputs, step=""):
+        """
+        Add outputs of a finished step to the cache.
+
+        Input:
+            - key: cache key
+            - outputs: dictionary of output name to file path
+            - step: step name (informative only)
+        """
+        entry_dir = self._entry_dir(key)
+        if(os.path.isfile(os.path.join(entry_dir, ENTRY_FILE))):
+            return
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entry_dir))
+
+        stored = {}
+        for i, (name, path) in enumerate(sorted(outputs.items())):
+            filename = "{i}_{base}".format(i=i, base=os.path.basename(path))
+            # Hard link where possible so that storing costs no space
+            _place(path, os.path.join(tmp_dir, filename),
+                    "hardlink" if self.link != "copy" else "copy")
+            stored[name] = filename
+
+        entry = {
+            "step": step,
+            "created": time.time(),
+            "outputs": stored
+        }
+        with open(os.path.join(tmp_dir, ENTRY_FILE), 'w') as fh:
+            json.dump(entry, fh, indent=2)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored concurrently by another worker
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        """
+        List of (last used time, size in bytes, entry directory).
+        """
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if(prefix.startswith('.') or not os.path.isdir(prefix_dir)):
+                continue
+
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                entry_file = os.path.join(entry_dir, ENTRY_FILE)
+                if not(os.path.isfile(entry_file)):
+                    continue
+
+                size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                        for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_file), size, entry_dir))
+
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its size cap.
+        """
+        entries = sorted(self.entries())
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, entry_dir in entries:
+            if(total_size <= self.max_size_bytes):
+                break
+
+            logger.info("Evicting " + entry_dir + " from artifact cache")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size = total_size - size
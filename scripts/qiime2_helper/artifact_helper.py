@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+import biom
 import re
 import sys
 import logging
@@ -13,6 +14,7 @@ from skbio.stats import ordination
 # Custom exception
 from exceptions.exception import AXIOME3Error
 from scripts.qiime2_helper.q2_artifact_types import ARTIFACT_TYPES
+from scripts.qiime2_helper.abundance import proportions
 
 # Define constants
 # Taxa collapse valid levels
@@ -48,13 +50,14 @@ def args_parse():
 
     return parser
 
-def convert(artifact_path):
+def convert(artifact_path, sparse=False):
     """
     Converts QIIME2 artifact to tsv if applicabl if applicable
 
     Input:
         - artifact_path: path to QIIME2 artifact (.qza)
-        - output_path: path to save output as
+        - sparse: return feature tables as biom table instead of dense
+            pandas dataframe
     Returns:
         - Dictionary with pandas series or dataframe as values
     """
@@ -63,10 +66,10 @@ def convert(artifact_path):
 
     if(artifact_type == "FeatureTable[Frequency]" or
         artifact_type == "FeatureTable[RelativeFrequency]"):
-        df = artifact.view(pd.DataFrame)
+        table = artifact.view(biom.Table) if sparse else artifact.view(pd.DataFrame)
 
         output = {
-                "feature_table": df
+                "feature_table": table
                 }
 
         return output
@@ -167,7 +170,7 @@ def filter_by_abundance(df, abundance_threshold=0.1, percent_axis=0, filter_axis
     percent_df = calculate_percent_value(df, percent_axis)
 
     # keep taxa/ASVs if at least one of the samples has % abundance >= threshold
-    to_keep = (percent_df >= abundance_threshold).any(filter_axis)
+    to_keep = (percent_df >= abundance_threshold).any(axis=filter_axis)
 
     # Raise error if no entries after filtering?
     if(to_keep.any() == False):
@@ -184,27 +187,7 @@ def calculate_percent_value(df, axis=0):
     (value / column (row) sum)
     Column by default.
     """
-
-    def percent_value_operation(x):
-        """
-        Custom function to be applied on pandas dataframe.
-
-        Input:
-                x: pandas series; numerical data
-        """
-        series_length = x.size
-        series_sum = x.sum()
-
-        # percent value should be zero if sum is 0
-        all_zeros = np.zeros(series_length)
-        percent_values = x / series_sum if series_sum != 0 else pd.Series(all_zeros)
-
-        return percent_values
-
-    # Calculate % value
-    percent_val_df = df.apply(lambda x: percent_value_operation(x), axis=axis)
-
-    return percent_val_df
+    return proportions(df, axis)
 
 def combine_dada2_stats_as_df(dada2_dir):
     """
@@ -1,13 +1,17 @@
 from qiime2 import Artifact
 from qiime2.plugins.taxa.methods import collapse
 
+import os
 import pandas as pd
 import numpy as np
 import re
 from plotnine import *
 
-from scripts.qiime2_helper.metadata_helper import (
-	load_metadata
+from scripts.qiime2_helper.session_cache import (
+	cached_metadata,
+	file_key,
+	load_artifact,
+	shared_cache
 )
 
 from scripts.qiime2_helper.artifact_helper import (
@@ -23,6 +27,12 @@ from scripts.qiime2_helper.plotnine_helper import (
 	add_fill_colours_discrete
 )
 
+from scripts.qiime2_helper.plot_scheduler import (
+	PlotSpec,
+	figure_size,
+	render_plots
+)
+
 # Custom exception
 from exceptions.exception import AXIOME3Error
 
@@ -189,9 +199,13 @@ def alphabetical_sort_df(df, cols):
 
 def prep_bubbleplot(feature_table_artifact_path, taxonomy_artifact_path,
 	metadata_path=None, level="asv", groupby_taxa="phylum", abundance_threshold=0.1, keyword=None):
-	feature_table_artifact = check_artifact_type(feature_table_artifact_path, "feature_table")
-	taxonomy_artifact = check_artifact_type(taxonomy_artifact_path, "taxonomy")
-	collapsed_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, level)
+	# Artifacts, collapsed table and metadata are kept in the session
+	# cache for repeated requests
+	feature_table_artifact = load_artifact(feature_table_artifact_path, "feature_table")
+	taxonomy_artifact = load_artifact(taxonomy_artifact_path, "taxonomy")
+	key = ("bubbleplot_collapsed", level) + file_key(feature_table_artifact_path) + file_key(taxonomy_artifact_path)
+	collapsed_df = shared_cache.get(key,
+		lambda: collapse_taxa(feature_table_artifact, taxonomy_artifact, level)).copy()
 
 	original_taxa = pd.Series(collapsed_df["Taxon"])
 	row_id = pd.Series(collapsed_df.index)
@@ -215,7 +229,7 @@ def prep_bubbleplot(feature_table_artifact_path, taxonomy_artifact_path,
 	sorted_df['SpeciesName'] = pd.Categorical(sorted_df['SpeciesName'], categories=sorted_df['SpeciesName'].unique(), ordered=True)
 	# Join metadata with bubbleplot df
 	if(metadata_path is not None):
-		metadata_df = load_metadata(metadata_path)
+		metadata_df = cached_metadata(metadata_path)
 		merged_df = sorted_df.merge(metadata_df, how="inner", left_on="SampleName", right_index=True)
 
 		return merged_df
@@ -289,6 +303,32 @@ def save_plot(plot, filename="plot", output_dir='.',
 		units=units
 	)
 
+def save_plots(plot_kwargs, filenames, output_dir='.',
+	file_format='pdf', width=200, height=200, units='mm', workers=1):
+	"""
+	Make and save several bubble plots (see save_plot), in parallel worker
+	processes.
+
+	Input:
+		- plot_kwargs: list of make_bubbleplot keyword arguments, one per plot
+		- filenames: list of file names (without extension), one per plot
+		- workers: number of rendering processes
+	"""
+	if(len(plot_kwargs) != len(filenames)):
+		raise AXIOME3Error("Number of plots and file names must be equal!")
+
+	specs = [
+		PlotSpec(
+			make_bubbleplot,
+			kwargs=kwargs,
+			images=[(os.path.join(output_dir, filename + "." + file_format), file_format)],
+			size=figure_size(width, height, units)
+		)
+		for kwargs, filename in zip(plot_kwargs, filenames)
+	]
+
+	render_plots(specs, workers)
+
 #feature_table_artifact_path = "/data/output/dada2/dada2_table.qza"
 #taxonomy_artifact_path = "/data/output/taxonomy/taxonomy.qza"
 #metadata_path = "/data/metadata_MaCoTe.tsv"
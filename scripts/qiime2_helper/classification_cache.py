@@ -0,0 +1,160 @@
+"""
+Taxonomy classification with a persistent per-sequence cache.
+
+Classifications are stored in a SQLite database keyed by
+    - the classifier (QIIME2 artifact UUID, or checksum) and
+    - the SHA-256 hash of the exact sequence.
+Representative sequences already classified with the same classifier (e.g.
+ASVs shared between projects) are taken from the cache; only the unseen
+sequences are sent to classify-sklearn, in batches. The cache is updated
+after each batch, so an interrupted classification resumes where it
+stopped.
+
+Classifications are assumed to come from classify-sklearn with its default
+settings, which is how the pipeline runs it.
+"""
+import hashlib
+import logging
+
+import pandas as pd
+
+from scripts.qiime2_helper.artifact_cache import file_fingerprint
+from scripts.qiime2_helper.sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+TAXONOMY_COLUMNS = ["Taxon", "Confidence"]
+
+def sequence_hash(sequence):
+    return hashlib.sha256(str(sequence).upper().encode('utf-8')).hexdigest()
+
+class ClassificationCache(SQLiteStore):
+    """
+    SQLite store of (classifier, sequence hash) -> (taxon, confidence).
+    """
+    def __init__(self, db_path):
+        super().__init__(db_path, "classification",
+                ("classifier", "sequence_hash"), ("taxon", "confidence"))
+
+    def lookup(self, classifier_id, hashes):
+        """
+        Stored classifications of the sequence hashes.
+
+        Returns:
+            - dictionary of sequence hash to (taxon, confidence); unseen
+                hashes are left out
+        """
+        return super().lookup(classifier_id, hashes)
+
+    def store(self, classifier_id, classifications):
+        """
+        Add classifications.
+
+        Input:
+            - classifier_id: classifier identifier
+            - classifications: dictionary of sequence hash to
+                (taxon, confidence)
+        """
+        super().store(classifier_id, {
+            seq_hash: (str(taxon), str(confidence))
+            for seq_hash, (taxon, confidence) in classifications.items()
+        })
+
+def classify_sequences(sequences, classifier_id, cache, classify, batch_size=10000):
+    """
+    Classify sequences, taking known sequences from the cache.
+
+    Input:
+        - sequences: pandas series; sequence strings indexed by feature ID
+        - classifier_id: classifier identifier
+        - cache: ClassificationCache
+        - classify: function classifying a series of sequences (indexed by
+            feature ID); returns dataframe with 'Taxon' and 'Confidence'
+            columns indexed by feature ID
+        - batch_size: maximum number of sequences per classify call
+
+    Returns:
+        - dataframe with 'Taxon' and 'Confidence' columns indexed by
+            feature ID, in the order of the sequences
+    """
+    batch_size = max(1, int(batch_size))
+    hashes = pd.Series([sequence_hash(s) for s in sequences],
+            index=sequences.index)
+
+    known = cache.lookup(classifier_id, set(hashes))
+    is_known = hashes.isin(set(known))
+
+    # One representative feature per unseen sequence
+    unseen = hashes[~is_known].drop_duplicates()
+
+    logger.info("{n_known} of {n_total} sequences found in classification cache; classifying {n_unseen}".format(
+        n_known=int(is_known.sum()),
+        n_total=len(hashes),
+        n_unseen=len(unseen)))
+
+    for i in range(0, len(unseen), batch_size):
+        batch = unseen.iloc[i:i+batch_size]
+        classified = classify(sequences[batch.index])
+
+        new = {
+            batch[feature_id]: (classified.loc[feature_id, "Taxon"],
+                classified.loc[feature_id, "Confidence"])
+            for feature_id in batch.index
+        }
+        cache.store(classifier_id, new)
+        known.update(new)
+
+    taxonomy = pd.DataFrame([known[h] for h in hashes],
+            index=sequences.index, columns=TAXONOMY_COLUMNS)
+    taxonomy.index.name = "Feature ID"
+
+    return taxonomy
+
+def classify_with_cache(rep_seqs_path, classifier_path, output_path, cache_path,
+        batch_size=10000, n_jobs=1):
+    """
+    Classify representative sequences with classify-sklearn, reusing cached
+    classifications, and save the FeatureData[Taxonomy] artifact.
+
+    Input:
+        - rep_seqs_path: path to FeatureData[Sequence] artifact
+        - classifier_path: path to TaxonomicClassifier artifact
+        - output_path: path to save FeatureData[Taxonomy] artifact
+        - cache_path: path to SQLite cache
+        - batch_size: maximum number of sequences per classify-sklearn call
+        - n_jobs: number of jobs for classify-sklearn
+    """
+    from qiime2 import Artifact
+    from scripts.qiime2_helper.artifact_helper import check_artifact_type
+
+    rep_seqs = check_artifact_type(rep_seqs_path, "rep_seqs")
+    sequences = rep_seqs.view(pd.Series).astype(str)
+
+    classifier_id = file_fingerprint(classifier_path)
+    classifier = None
+
+    def classify(batch):
+        # Load the classifier only if there is something to classify
+        nonlocal classifier
+        if(classifier is None):
+            classifier = check_artifact_type(classifier_path, "classifier")
+
+        from qiime2.plugins.feature_classifier.methods import classify_sklearn
+        from skbio import DNA
+
+        reads = Artifact.import_data("FeatureData[Sequence]",
+                pd.Series([DNA(s) for s in batch], index=batch.index))
+        classification, = classify_sklearn(reads=reads, classifier=classifier,
+                n_jobs=int(n_jobs))
+
+        return classification.view(pd.DataFrame)
+
+    cache = ClassificationCache(cache_path)
+    try:
+        taxonomy = classify_sequences(sequences, classifier_id, cache,
+                classify, batch_size)
+    finally:
+        cache.close()
+
+    taxonomy_artifact = Artifact.import_data("FeatureData[Taxonomy]", taxonomy)
+    taxonomy_artifact.save(output_path)
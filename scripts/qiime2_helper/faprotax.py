@@ -0,0 +1,777 @@
+"""
+FAPROTAX functional table without the python2 collapse_table.py script.
+
+Re-implements what the pipeline runs:
+
+    collapse_table.py -i <table> -o <functional table> -g FAPROTAX.txt
+        -c "#" -d "Consensus.Lineage" --omit_columns "0,1" -r <report>
+        -n columns_after_collapsing --omit_samples ReprSequence --force -v
+
+The abundance table is parsed once into a numpy matrix, group membership is
+compiled into a sparse group x record indicator matrix, and the functional
+table is one matrix product followed by column normalization. The
+functional table and report are the same bytes collapse_table.py (v1.2)
+writes.
+
+collapse_table.py works on python2 byte strings; files are read as latin-1
+and compared with ASCII rules (lower case, white space, word characters) to
+give the same matches.
+
+The parsed database (with member expressions split into words and tokens)
+can be kept in a cache directory, keyed by the database checksum. Records
+are matched once per unique lineage, and the lineage labels are indexed by
+token, so each member expression is only checked against the labels
+containing all of its tokens. The groups of each lineage are kept in a
+SQLite memo in the same cache directory, keyed by database version, so
+lineages seen in earlier projects are not matched again.
+"""
+import os
+import re
+import time
+import pickle
+import string
+import logging
+
+import numpy as np
+from scipy import sparse
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.artifact_cache import file_checksum
+from scripts.qiime2_helper.sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+ENCODING = "latin-1"
+COMMENT_PREFIX = "#"
+DELIMITER = "\t"
+
+# Group set operations in the groups file (add, subtract, intersect)
+SET_OPERATIONS = ["add_group:", "subtract_group:", "intersect_group:"]
+ADD_GROUP = 0
+SUBTRACT_GROUP = 1
+INTERSECT_GROUP = 2
+
+# Non alphanumeric characters that are part of a word in member names
+VALID_WORD_SYMBOLS = "-"
+# Value of non numeric columns that differ between records of a group
+MISSING_ENTRY = "NA"
+GROUP_TITLE = "group"
+
+ASCII_WHITESPACE = " \t\n\r\x0b\x0c"
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_ASCII_ALNUM = frozenset(string.ascii_letters + string.digits)
+_NAN_STRINGS = ("nan", "na", "null")
+# Maximal runs of word characters; a complete word match is always made of
+# whole tokens
+_WORD_TOKEN = re.compile("[A-Za-z0-9" + re.escape(VALID_WORD_SYMBOLS) + "]+")
+
+# Bump when the layout of cached FaprotaxGroups changes
+GROUPS_CACHE_VERSION = 1
+# Bump when matching rules change (stored lineage groups become invalid)
+LINEAGE_MEMO_VERSION = 1
+LINEAGE_MEMO_NAME = "faprotax_lineages.sqlite"
+
+def _lower(text):
+    return text.translate(_ASCII_LOWER)
+
+def _strip(text):
+    return text.strip(ASCII_WHITESPACE)
+
+def _is_ascii(text):
+    # str.isascii() is Python 3.7+
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+
+    return True
+
+def _to_float(text):
+    """
+    float() as python2 parses byte strings (no '_' digit separators, no
+    non-ASCII white space or digits).
+    """
+    if("_" in text or not _is_ascii(text)):
+        raise ValueError("could not convert string to float: '{}'".format(text))
+
+    return float(text)
+
+def _is_number_or_nan(text):
+    if(_lower(text) in _NAN_STRINGS):
+        return True
+    try:
+        _to_float(text)
+        return True
+    except ValueError:
+        return False
+
+def _float_or_nan(text):
+    try:
+        return _to_float(text)
+    except ValueError:
+        return np.nan
+
+def shell_command(arguments):
+    """
+    Command line as collapse_table.py records it in the report.
+    """
+    quoted = []
+    for arg in arguments:
+        if(arg == "" or re.search(r"[ \t\n\r\f\v*#:;]", arg)):
+            quoted.append("'" + arg + "'")
+        elif(arg == "\\t"):
+            quoted.append("'\\\\t'")
+        else:
+            quoted.append(arg)
+
+    return " ".join(quoted)
+
+def collapse_table_command(script_path, table_path, groups_path, output_path,
+        report_path, row_names_column="Consensus.Lineage"):
+    """
+    collapse_table.py command equivalent to collapse_table() (for the
+    report).
+    """
+    return shell_command([script_path,
+            "-i", table_path,
+            "-o", output_path,
+            "-g", groups_path,
+            "-c", COMMENT_PREFIX,
+            "-d", row_names_column,
+            "--omit_columns", "0,1",
+            "-r", report_path,
+            "-n", "columns_after_collapsing",
+            "--omit_samples", "ReprSequence",
+            "--force",
+            "-v"])
+
+class RecordTable(object):
+    """
+    Abundance table split into records (rows) and data columns.
+
+    Attributes:
+        - record_names: row names (taxonomy), as in the file
+        - data_names: names of the data columns
+        - columns: list of data columns; each is a list of cell strings
+        - summary: description of the table for the report
+        - n_lines: number of lines in the file
+    """
+    def __init__(self, record_names, data_names, columns, summary, n_lines):
+        self.record_names = record_names
+        self.data_names = data_names
+        self.columns = columns
+        self.summary = summary
+        self.n_lines = n_lines
+
+def read_table(table_path, row_names_column="Consensus.Lineage", omit_columns=(0, 1)):
+    """
+    Read tab separated table; the first non comment line is the header.
+
+    Input:
+        - table_path: path to table (e.g. ASV_abundance_filtered.tsv)
+        - row_names_column: name of the column with row names (case
+            insensitive)
+        - omit_columns: indices of other columns to leave out
+
+    Returns:
+        - RecordTable
+    """
+    all_column_names = None
+    keep_columns = None
+    name_index = None
+    n_needed = 0
+    record_names = []
+    rows = []
+    n_lines = 0
+
+    with open(table_path, encoding=ENCODING) as fh:
+        for line in fh:
+            n_lines += 1
+            if(line.endswith("\n")):
+                line = line[:-1]
+
+            # Ignore comments
+            pos = line.find(COMMENT_PREFIX)
+            if(pos >= 0):
+                line = line[:pos]
+            if(line == ""):
+                continue
+
+            if(all_column_names is None):
+                all_column_names = [_strip(name) for name in line.split(DELIMITER)]
+
+                target = _lower(row_names_column)
+                name_index = next((c for c, name in enumerate(all_column_names)
+                        if _lower(name) == target), -1)
+                if(name_index < 0):
+                    raise AXIOME3Error("Unknown column '{}' specified for row names".format(row_names_column))
+
+                omitted = set([name_index] + list(omit_columns))
+                keep_columns = [c for c in range(len(all_column_names)) if c not in omitted]
+                n_needed = max(keep_columns + [name_index]) + 1
+                continue
+
+            parts = line.split(DELIMITER)
+            if(len(parts) < n_needed):
+                raise AXIOME3Error("Number of columns ({n}) in line {line} is inconsistent with the header".format(
+                    n=len(parts),
+                    line=n_lines))
+
+            record_names.append(parts[name_index])
+            rows.append([parts[c] for c in keep_columns])
+
+    if(all_column_names is None or len(rows) == 0):
+        raise AXIOME3Error("Input table '{}' is empty".format(table_path))
+
+    data_names = [all_column_names[c] for c in keep_columns]
+    columns = [list(column) for column in zip(*rows)]
+
+    summary = ("Original classical table contained {rows} rows and {n_all} columns\n"
+            "After filtering rows & columns based on indices, obtained a table containing {rows} rows & {n_data} columns\n"
+            "After (potentially) filtering out records based on name, obtained a table comprising {rows} records & {n_data} data entries per record").format(
+                    rows=len(rows),
+                    n_all=len(all_column_names),
+                    n_data=len(data_names))
+
+    return RecordTable(record_names, data_names, columns, summary, n_lines)
+
+class FaprotaxGroups(object):
+    """
+    Groups (functions) defined in a FAPROTAX database file.
+
+    Attributes:
+        - names: group names
+        - members: members of each group; each member is either an index into
+            member_names or an (operation, group index) set operation
+        - member_names: all member names (taxon expressions) in file order
+        - n_lines: number of lines in the file
+        - expressions: (words, tokens) of each member name, lower case
+        - checksum: SHA-256 of the database file (set by load_groups)
+    """
+    def __init__(self, names, members, member_names, n_lines):
+        self.names = names
+        self.members = members
+        self.member_names = member_names
+        self.n_lines = n_lines
+        self.expressions = [compile_expression(name) for name in member_names]
+        self.checksum = None
+
+    @property
+    def n_unique_members(self):
+        return len(set(self.member_names))
+
+def _set_operation(line):
+    for operation, prefix in enumerate(SET_OPERATIONS):
+        if(line.startswith(prefix)):
+            return operation, line[len(prefix):]
+
+    return -1, line
+
+def read_groups(groups_path):
+    """
+    Read FAPROTAX database.
+
+    Groups are separated by blank lines; the first line of a group is its
+    name (followed by optional metadata) and each following line is a member
+    or a set operation on a previously defined group.
+
+    Returns:
+        - FaprotaxGroups
+    """
+    names = []
+    members = []
+    member_names = []
+    group_name = None
+    n_lines = 0
+
+    with open(groups_path, encoding=ENCODING) as fh:
+        for original_line in fh:
+            n_lines += 1
+            # Blank line ends the group
+            if(_strip(original_line) == ""):
+                group_name = None
+                continue
+
+            line = _strip(original_line.rstrip("\n").split(COMMENT_PREFIX)[0])
+            # Members may be quoted
+            if(len(line) > 0 and line[0] in "\"'" and line[-1] in "\"'"):
+                line = line[1:-1]
+            if(line == ""):
+                continue
+
+            if(group_name is None):
+                group_name = re.split(r"[ \t\n\r\x0b\x0c]", line, maxsplit=1)[0]
+                names.append(group_name)
+                members.append([])
+                continue
+
+            operation, target = _set_operation(line)
+            if(operation >= 0):
+                if(target not in names):
+                    raise AXIOME3Error("Unknown group '{target}', referenced by set operation in group '{group}'".format(
+                        target=target,
+                        group=group_name))
+                referenced = names.index(target)
+                if(referenced == len(names) - 1):
+                    raise AXIOME3Error("Self-operation encountered in group '{}'".format(group_name))
+
+                members[-1].append((operation, referenced))
+            else:
+                member_names.append(line)
+                members[-1].append(len(member_names) - 1)
+
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if(len(duplicates) > 0):
+        raise AXIOME3Error("Duplicate group names: {}".format(", ".join(duplicates)))
+
+    return FaprotaxGroups(names, members, member_names, n_lines)
+
+def load_groups(groups_path, cache_dir=""):
+    """
+    Read FAPROTAX database, from the cache directory if it was parsed before.
+
+    Input:
+        - groups_path: FAPROTAX database (FAPROTAX.txt)
+        - cache_dir: directory to keep parsed databases; empty to disable
+
+    Returns:
+        - FaprotaxGroups
+    """
+    checksum = file_checksum(groups_path)
+
+    cache_path = None
+    if(cache_dir):
+        cache_path = os.path.join(cache_dir, "faprotax_groups_v{version}_{checksum}.pickle".format(
+            version=GROUPS_CACHE_VERSION,
+            checksum=checksum))
+
+        if(os.path.exists(cache_path)):
+            try:
+                with open(cache_path, 'rb') as fh:
+                    return pickle.load(fh)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError) as err:
+                logger.warning("Ignoring unreadable FAPROTAX cache {path}: {err}".format(
+                    path=cache_path,
+                    err=err))
+
+    groups = read_groups(groups_path)
+    groups.checksum = checksum
+
+    if(cache_path is not None):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + ".{}.tmp".format(os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            pickle.dump(groups, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    return groups
+
+def compile_expression(expression):
+    """
+    Words and word tokens of a member expression (e.g. '*Nitrosomonas*').
+
+    Returns:
+        - (list of lower case words, set of tokens in the words)
+    """
+    words = [word for word in _lower(expression).split("*") if len(word) > 0]
+    tokens = set(token for word in words for token in _WORD_TOKEN.findall(word))
+
+    return words, tokens
+
+def _match_words(words, label, valid_word_symbols=VALID_WORD_SYMBOLS):
+    """
+    True if the words appear in label, in order, as complete words.
+    """
+    def is_word_character(character):
+        return character in _ASCII_ALNUM or character in valid_word_symbols
+
+    length = len(label)
+    next_start = 0
+    for word in words:
+        found_word = False
+        while(True):
+            pos = label.find(word, next_start)
+            if(pos < 0):
+                break
+            next_start = pos + len(word)
+            # Only complete words
+            if(pos > 0 and is_word_character(label[pos-1])):
+                continue
+            if(next_start < length and is_word_character(label[next_start])):
+                continue
+            found_word = True
+            break
+        if not(found_word):
+            return False
+
+    return True
+
+def find_word_matches(expression, labels, valid_word_symbols=VALID_WORD_SYMBOLS):
+    """
+    Labels containing the words of expression, in order, as complete words.
+
+    Input:
+        - expression: words separated by '*' (e.g. '*Nitrosomonas*europaea*')
+        - labels: lower case, stripped record labels
+        - valid_word_symbols: non alphanumeric characters allowed in words
+
+    Returns:
+        - list of indices of the matching labels
+    """
+    words = [word for word in expression.split("*") if len(word) > 0]
+
+    return [i for i, label in enumerate(labels)
+            if _match_words(words, label, valid_word_symbols)]
+
+class LabelIndex(object):
+    """
+    Record labels indexed by word token (token -> set of label indices).
+    """
+    def __init__(self, labels):
+        self.labels = labels
+        self.index = {}
+        for i, label in enumerate(labels):
+            for token in set(_WORD_TOKEN.findall(label)):
+                self.index.setdefault(token, set()).add(i)
+
+    def candidates(self, tokens):
+        """
+        Indices of the labels containing all tokens, in order.
+        """
+        if(len(tokens) == 0):
+            return range(len(self.labels))
+
+        postings = sorted((self.index.get(token, set()) for token in tokens), key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            found &= posting
+            if(len(found) == 0):
+                break
+
+        return sorted(found)
+
+    def match(self, words, tokens):
+        """
+        Indices of the labels matching a compiled member expression (see
+        compile_expression).
+        """
+        return [i for i in self.candidates(tokens)
+                if _match_words(words, self.labels[i])]
+
+def assign_labels_to_groups(groups, labels):
+    """
+    Labels belonging to each group.
+
+    Input:
+        - groups: FaprotaxGroups
+        - labels: lower case, stripped labels
+
+    Returns:
+        - list of sets of label indices, one per group
+    """
+    index = LabelIndex(labels)
+
+    group_to_labels = []
+    for group_members in groups.members:
+        matched = set()
+        for member in group_members:
+            if(isinstance(member, int)):
+                words, tokens = groups.expressions[member]
+                matched.update(index.match(words, tokens))
+            else:
+                operation, referenced = member
+                if(operation == ADD_GROUP):
+                    matched.update(group_to_labels[referenced])
+                elif(operation == SUBTRACT_GROUP):
+                    matched.difference_update(group_to_labels[referenced])
+                else:
+                    matched.intersection_update(group_to_labels[referenced])
+        group_to_labels.append(matched)
+
+    return group_to_labels
+
+def database_version(groups):
+    """
+    Identifier of the database (and matching rules) for LineageMemo.
+    """
+    return "v{version}_{checksum}".format(
+        version=LINEAGE_MEMO_VERSION,
+        checksum=groups.checksum)
+
+class LineageMemo(SQLiteStore):
+    """
+    SQLite store of (database version, lineage) -> group indices.
+
+    Lineages are the lower case, stripped labels. Membership of a lineage
+    only depends on the lineage and the database, so it carries over
+    between projects.
+    """
+    def __init__(self, db_path):
+        super().__init__(db_path, "lineage_groups",
+                ("database", "lineage"), ("groups",))
+
+    def lookup(self, database, lineages):
+        """
+        Stored group memberships of the lineages.
+
+        Returns:
+            - dictionary of lineage to list of group indices; unseen
+                lineages are left out
+        """
+        return {
+            lineage: [int(g) for g in group_indices.split(",") if g != ""]
+            for lineage, (group_indices,) in super().lookup(database, lineages).items()
+        }
+
+    def store(self, database, memberships):
+        """
+        Add group memberships.
+
+        Input:
+            - database: database identifier (see database_version)
+            - memberships: dictionary of lineage to list of group indices
+        """
+        super().store(database, {
+            lineage: (",".join(str(g) for g in group_indices),)
+            for lineage, group_indices in memberships.items()
+        })
+
+def assign_records_to_groups(groups, record_labels, memo=None):
+    """
+    Records (e.g. taxonomy strings) belonging to each group.
+
+    Records with the same lineage share their groups, so only the unique
+    lineages are matched (and only those not already in the memo).
+
+    Input:
+        - groups: FaprotaxGroups
+        - record_labels: record labels
+        - memo: LineageMemo; None to match all lineages
+
+    Returns:
+        - list of sets of record indices, one per group
+    """
+    labels = [_strip(_lower(label)) for label in record_labels]
+    lineages = list(dict.fromkeys(labels))
+
+    known = {}
+    if(memo is not None):
+        known = memo.lookup(database_version(groups), lineages)
+
+    unseen = [lineage for lineage in lineages if lineage not in known]
+    if(len(unseen) > 0):
+        new = {lineage: [] for lineage in unseen}
+        for g, matched in enumerate(assign_labels_to_groups(groups, unseen)):
+            for i in sorted(matched):
+                new[unseen[i]].append(g)
+        if(memo is not None):
+            memo.store(database_version(groups), new)
+        known.update(new)
+
+    logger.info("{n_known} of {n_unique} unique lineages found in FAPROTAX memo".format(
+        n_known=len(lineages) - len(unseen),
+        n_unique=len(lineages)))
+
+    group_to_records = [set() for _ in groups.names]
+    for r, label in enumerate(labels):
+        for g in known[label]:
+            group_to_records[g].add(r)
+
+    return group_to_records
+
+def indicator_matrix(group_to_records, n_records):
+    """
+    Sparse group x record matrix; 1 if the record belongs to the group.
+    """
+    rows = [g for g, records in enumerate(group_to_records) for _ in records]
+    cols = [r for records in group_to_records for r in sorted(records)]
+
+    return sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(len(group_to_records), n_records))
+
+def _numeric_column(column):
+    """
+    Column values as floats (NaN for non numbers) and a mask of the cells
+    that are neither numbers nor NaN.
+    """
+    joined = "".join(column)
+    if("_" not in joined and _is_ascii(joined)):
+        try:
+            return np.array(column, dtype=np.float64), np.zeros(len(column), dtype=bool)
+        except ValueError:
+            pass
+
+    values = np.array([_float_or_nan(cell) for cell in column], dtype=np.float64)
+    non_numeric = np.array([not _is_number_or_nan(cell) for cell in column], dtype=bool)
+
+    return values, non_numeric
+
+def collapse(table, group_to_records):
+    """
+    Functional table: sum of the records of each group, normalized by column.
+
+    A data column is numeric unless a grouped record has a non numeric value
+    in it (e.g. ReprSequence); non numeric columns keep the value shared by
+    all records of the group, or MISSING_ENTRY.
+
+    Input:
+        - table: RecordTable
+        - group_to_records: list of sets of record indices, one per group
+
+    Returns:
+        - list of columns; numeric columns are numpy arrays (one value per
+            group), non numeric columns are lists of strings
+    """
+    n_records = len(table.record_names)
+    indicator = indicator_matrix(group_to_records, n_records)
+
+    numeric_names = []
+    numeric_values = []
+    columns = [None] * len(table.data_names)
+
+    for d, column in enumerate(table.columns):
+        values, non_numeric = _numeric_column(column)
+
+        if(non_numeric.any() and (indicator @ non_numeric.astype(np.float64)).any()):
+            columns[d] = [
+                _consolidate([column[r] for r in records])
+                for records in group_to_records
+            ]
+        else:
+            numeric_names.append(d)
+            numeric_values.append(values)
+
+    if(len(numeric_names) > 0):
+        # Missing values (NaN) are skipped in the sums
+        values = np.column_stack(numeric_values)
+        values[np.isnan(values)] = 0
+        collapsed = np.asarray(indicator @ values)
+
+        # Normalize columns after collapsing
+        sums = np.nansum(collapsed, axis=0)
+        sums[sums == 0] = 1.0
+        collapsed = collapsed / sums
+
+        for i, d in enumerate(numeric_names):
+            columns[d] = collapsed[:, i]
+
+    return columns
+
+def _consolidate(values):
+    if(len(set(values)) == 1):
+        return values[0]
+
+    return MISSING_ENTRY
+
+def write_functional_table(output_path, group_names, data_names, columns):
+    with open(output_path, "w", encoding=ENCODING, newline="") as fh:
+        fh.write(GROUP_TITLE + DELIMITER + DELIMITER.join(data_names) + "\n")
+
+        for g, name in enumerate(group_names):
+            cells = [("%.10g" % column[g]) if isinstance(column, np.ndarray) else column[g]
+                    for column in columns]
+            fh.write(name + "".join(DELIMITER + cell for cell in cells) + "\n")
+
+def write_report(report_path, output_path, table_path, table, groups,
+        group_to_records, command, date):
+    """
+    Report of the records assigned to each group (collapse_table.py -r).
+    """
+    n_records = len(table.record_names)
+    assigned = set().union(*group_to_records) if group_to_records else set()
+    n_leftovers = n_records - len(assigned)
+    n_annotations = sum(len(records) for records in group_to_records)
+    n_represented = sum(1 for records in group_to_records if len(records) > 0)
+    labels = [_lower(name) for name in table.record_names]
+
+    with open(report_path, "w", encoding=ENCODING, newline="") as fh:
+        fh.write("# Report for collapsed table: %s\n# Collapsed table generated on: %s\n# Original table: %s\n# Details:\n#  %s\n# Used command:\n#   %s\n" % (
+            output_path, date, table_path, table.summary.replace("\n", "\n#  "), command))
+        fh.write("#\n# Summary of group assignments:\n")
+        for name, records in zip(groups.names, group_to_records):
+            fh.write("#   %s: %d records\n" % (name, len(records)))
+        fh.write("#\n# Loaded %d groups comprising %d members (%d unique members)\n# Established %d assignments of records to groups\n# %d out of %d records (%g %%) were assigned to at least one group\n# %d out of %d records (%g %%) could not be assigned to any group (%s)\n# %d groups were represented (i.e. associated with at least one record)\n# Detailed group assignments are listed below\n" % (
+            len(groups.names), len(groups.member_names), groups.n_unique_members,
+            n_annotations,
+            n_records - n_leftovers, n_records, (n_records - n_leftovers) / (0.01 * n_records),
+            n_leftovers, n_records, n_leftovers / (0.01 * n_records), "leftovers",
+            n_represented))
+        fh.write("\n")
+
+        for name, records in zip(groups.names, group_to_records):
+            # Alphabetical (case insensitive) order
+            fh.write("# %s (%d records):\n" % (name, len(records)))
+            for r in sorted(records, key=lambda r: labels[r]):
+                fh.write("    %s\n" % table.record_names[r])
+            fh.write("\n\n")
+
+def collapse_table(table_path, groups_path, output_path, report_path,
+        row_names_column="Consensus.Lineage", command=None, date=None,
+        cache_dir=""):
+    """
+    Generate FAPROTAX functional table and report.
+
+    Input:
+        - table_path: abundance table with rowID and Feature ID as the
+            first two columns (ASV_abundance_filtered.tsv)
+        - groups_path: FAPROTAX database (FAPROTAX.txt)
+        - output_path: path to save functional table
+        - report_path: path to save report
+        - row_names_column: column with taxonomy
+        - command: command line recorded in the report; defaults to the
+            equivalent collapse_table.py command
+        - date: time stamp recorded in the report; defaults to now
+        - cache_dir: directory to keep the parsed database and the lineage
+            memo; empty to disable
+
+    Returns:
+        - log messages (str)
+    """
+    log = []
+
+    if(command is None):
+        command = collapse_table_command("collapse_table.py", table_path,
+                groups_path, output_path, report_path, row_names_column)
+    if(date is None):
+        date = time.strftime("%Y.%m.%d") + " " + time.strftime("%H:%M:%S")
+
+    table = read_table(table_path, row_names_column)
+    log.append("Loaded {n} rows amongst {lines} lines, and {cols} columns, from file '{path}'".format(
+        n=len(table.record_names),
+        lines=table.n_lines,
+        cols=len(table.data_names),
+        path=table_path))
+
+    groups = load_groups(groups_path, cache_dir)
+    log.append("Read {lines} lines from file '{path}', found {n} groups with {members} members ({unique} unique members)".format(
+        lines=groups.n_lines,
+        path=groups_path,
+        n=len(groups.names),
+        members=len(groups.member_names),
+        unique=groups.n_unique_members))
+
+    memo = None
+    if(cache_dir):
+        memo = LineageMemo(os.path.join(cache_dir, LINEAGE_MEMO_NAME))
+    try:
+        group_to_records = assign_records_to_groups(groups, table.record_names, memo)
+    finally:
+        if(memo is not None):
+            memo.close()
+    n_assigned = len(set().union(*group_to_records)) if group_to_records else 0
+    log.append("Assigned {n} records to groups, {leftovers} records were leftovers".format(
+        n=n_assigned,
+        leftovers=len(table.record_names) - n_assigned))
+
+    columns = collapse(table, group_to_records)
+
+    write_functional_table(output_path, groups.names, table.data_names, columns)
+    log.append("Wrote collapsed table '{}'".format(output_path))
+
+    write_report(report_path, output_path, table_path, table, groups,
+            group_to_records, command, date)
+    log.append("Wrote report '{}'".format(report_path))
+
+    return "".join("  " + line + "\n" for line in log)
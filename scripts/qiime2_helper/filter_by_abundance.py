@@ -7,6 +7,8 @@ from argparse import ArgumentParser
 import sys
 import re
 
+from scripts.qiime2_helper.abundance import proportions, series_proportions
+
 def args_parse():
     """
     Parse command line arguments into Python
@@ -81,25 +83,18 @@ def calculate_percent_value(df):
         df: pandas dataframe.
     """
     # Calculate % value
-    percent_val_df = df.apply(lambda x: percent_value_operation(x), axis=0)
+    percent_val_df = proportions(df, axis=0)
 
     return percent_val_df
 
 def percent_value_operation(x):
     """
-    Custom function to be applied on pandas dataframe.
+    % value of a single column; percent value is zero if the sum is 0.
 
     Input:
         x: pandas series; numerical data
     """
-    series_length = x.size
-    series_sum = x.sum()
-
-    # percent value should be zero if sum is 0
-    all_zeros = np.zeros(series_length)
-    percent_values = x / series_sum if series_sum != 0 else pd.Series(all_zeros)
-
-    return percent_values
+    return series_proportions(x)
 
 def subset_df(df, cols):
     """
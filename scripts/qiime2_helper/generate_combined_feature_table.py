@@ -10,9 +10,12 @@ import time
 import logging
 import argparse
 import re
+import csv
 
 from scripts.qiime2_helper.fasta_parser import get_id_and_seq
+from scripts.qiime2_helper.sparse_table import abundant_features
 import pandas as pd
+import biom
 import qiime2
 from qiime2 import Artifact
 
@@ -34,10 +37,11 @@ def import_qiime2_feature_table(feature_table_filepath):
     if(artifact_type == "FeatureTable[Frequency]" or
         artifact_type == "FeatureTable[RelativeFrequency]"):
 
-        feature_table_df = artifact.view(pd.DataFrame)
+        feature_table = artifact.view(biom.Table)
 
-        # return transposed version for better view
-        transposed = feature_table_df.T
+        # features as rows for better view; built directly from the sparse
+        # table instead of transposing a dense copy
+        transposed = feature_table.to_dataframe(dense=True).astype(float)
         transposed.index.name = "SampleID"
 
         return transposed.reset_index()
@@ -237,8 +241,153 @@ def add_row_id(feature_table):
 
     return feature_table
 
+def load_taxonomy_lookup(taxonomy_filepath):
+    """
+    Taxonomy of each feature as a dictionary keyed by Feature ID
+    """
+    taxonomy_table = import_qiime2_taxonomy(taxonomy_filepath)
+
+    if taxonomy_table['Feature ID'].duplicated().any():
+        raise ValueError("Duplicate Feature IDs in taxonomy!")
+
+    return dict(zip(taxonomy_table['Feature ID'], taxonomy_table['Taxon']))
+
+def load_rep_seqs_lookup(rep_seq_filepath):
+    """
+    Representative sequence of each feature as a dictionary keyed by Feature ID
+    """
+    rep_seqs = {}
+    for _id, seq in get_id_and_seq(rep_seq_filepath):
+        if _id in rep_seqs:
+            raise ValueError("Duplicate Feature ID '{}' in representative sequences!".format(_id))
+        rep_seqs[_id] = seq
+
+    return rep_seqs
+
+def format_count(value):
+    """
+    Format a count the same way pandas writes float64 values
+    """
+    return repr(float(value))
+
+def write_combined_table(feature_table, taxonomy, rep_seqs, fh, keep=None):
+    """
+    Write combined feature table one feature at a time.
+
+    :param feature_table: biom table (features as observations)
+    :param taxonomy: dictionary of Feature ID to taxonomy
+    :param rep_seqs: dictionary of Feature ID to representative sequence
+    :param fh: file handle to write to
+    :param keep: optional boolean array (one value per feature); only features
+        marked True are written. rowIDs still refer to the full table.
+    """
+    writer = csv.writer(fh, delimiter='\t', lineterminator='\n')
+
+    sample_ids = list(feature_table.ids(axis='sample'))
+    writer.writerow(['rowID', 'Feature ID'] + sample_ids +
+            ['Consensus.Lineage', 'ReprSequence'])
+
+    rows = feature_table.iter(axis='observation', dense=True)
+    for row_id, (values, feature_id, _) in enumerate(rows):
+        if keep is not None and not keep[row_id]:
+            continue
+
+        writer.writerow([row_id, feature_id] +
+                [format_count(value) for value in values] +
+                [taxonomy.get(feature_id, ''), rep_seqs.get(feature_id, '')])
+
+def write_abundance_subset(feature_table, taxonomy, rep_seqs, threshold, fh):
+    """
+    Write the features with % abundance >= threshold in at least one sample.
+
+    Output is identical to running filter_by_abundance.py on the combined
+    table, without writing and parsing the combined table first.
+
+    :param feature_table: biom table (features as observations)
+    :param taxonomy: dictionary of Feature ID to taxonomy
+    :param rep_seqs: dictionary of Feature ID to representative sequence
+    :param threshold: % abundance threshold (0: 0% cutoff, 1: 100% cutoff)
+    :param fh: file handle to write to
+    """
+    keep = abundant_features(feature_table, threshold)
+
+    write_combined_table(feature_table, taxonomy, rep_seqs, fh, keep=keep)
+
+def load_combined_inputs(feature_table_filepath, rep_seq_filepath, taxonomy_filepath):
+    """
+    Load feature table (biom), taxonomy and representative sequences lookups.
+    """
+    artifact = Artifact.load(feature_table_filepath)
+    artifact_type = str(artifact.type)
+
+    if not(artifact_type == "FeatureTable[Frequency]" or
+        artifact_type == "FeatureTable[RelativeFrequency]"):
+        raise ValueError("Input artifact is not of type FeatureTable[Frequency] or FeatureTable[RelativeFrequency]!")
+
+    feature_table = artifact.view(biom.Table)
+
+    logger.info('Loading taxonomy file')
+    taxonomy = load_taxonomy_lookup(taxonomy_filepath)
+
+    logger.info('Loading representative sequences FastA file')
+    rep_seqs = load_rep_seqs_lookup(rep_seq_filepath)
+
+    return feature_table, taxonomy, rep_seqs
+
+def combine_table_streaming(feature_table_filepath, rep_seq_filepath,
+        taxonomy_filepath, output_filepath, abundance_subset=None):
+    """
+    Generates combined feature table without building it in memory.
+
+    Output is identical to combine_table, but taxonomy and sequences are
+    looked up from dictionaries and rows are written as the sparse feature
+    table is iterated, so memory use stays close to the size of the table.
+
+    Input:
+        - feature_table_filepath: feature table artifact (.qza)
+        - rep_seq_filepath: representative sequence file (.fasta)
+        - taxonomy_filepath: taxonomy classification artifact (.qza)
+        - output_filepath: Path to save output
+        - abundance_subset: optional (threshold, path) tuple; also writes
+            the abundance filtered table from the same loaded inputs
+    """
+    feature_table, taxonomy, rep_seqs = load_combined_inputs(
+            feature_table_filepath, rep_seq_filepath, taxonomy_filepath)
+
+    logger.info('Writing merged table to ' + output_filepath)
+    with open(output_filepath, 'w', newline='') as fh:
+        write_combined_table(feature_table, taxonomy, rep_seqs, fh)
+
+    if abundance_subset is not None:
+        threshold, subset_filepath = abundance_subset
+
+        logger.info('Writing abundance filtered table to ' + subset_filepath)
+        with open(subset_filepath, 'w', newline='') as fh:
+            write_abundance_subset(feature_table, taxonomy, rep_seqs,
+                    threshold, fh)
+
+def subset_by_abundance(feature_table_filepath, rep_seq_filepath,
+        taxonomy_filepath, output_filepath, threshold=0.01):
+    """
+    Generates abundance filtered feature table (same format as the combined
+    table) directly from the artifacts.
+
+    Input:
+        - feature_table_filepath: feature table artifact (.qza)
+        - rep_seq_filepath: representative sequence file (.fasta)
+        - taxonomy_filepath: taxonomy classification artifact (.qza)
+        - output_filepath: Path to save output
+        - threshold: % abundance threshold (0: 0% cutoff, 1: 100% cutoff)
+    """
+    feature_table, taxonomy, rep_seqs = load_combined_inputs(
+            feature_table_filepath, rep_seq_filepath, taxonomy_filepath)
+
+    logger.info('Writing abundance filtered table to ' + output_filepath)
+    with open(output_filepath, 'w', newline='') as fh:
+        write_abundance_subset(feature_table, taxonomy, rep_seqs, threshold, fh)
+
 def combine_table(feature_table_filepath, rep_seq_filepath, taxonomy_filepath,
-        output_filepath):
+        output_filepath, streaming=False, abundance_subset=None):
     """
     Generates combined feature table.
 
@@ -247,7 +396,13 @@ def combine_table(feature_table_filepath, rep_seq_filepath, taxonomy_filepath,
         - rep_seq_filepath: representative sequence file (.fasta)
         - taxonomy_filepath: taxonomy classification file (.tsv)
         - output_filepath: Path to save output
+        - streaming: write the table row by row (see combine_table_streaming)
+        - abundance_subset: optional (threshold, path) tuple; also writes
+            the abundance filtered table (always streamed)
     """
+    if(streaming or abundance_subset is not None):
+        return combine_table_streaming(feature_table_filepath, rep_seq_filepath,
+                taxonomy_filepath, output_filepath, abundance_subset)
 
     feature_table = read_feature_table(feature_table_filepath)
 
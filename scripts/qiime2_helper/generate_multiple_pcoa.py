@@ -9,7 +9,12 @@ from scripts.qiime2_helper.generate_pcoa import (
     generate_pcoa_plot
 )
 
-from plotnine.ggplot import save_as_pdf_pages
+from scripts.qiime2_helper.plot_scheduler import (
+    PlotSpec,
+    render_plots
+)
+
+import os
 import json
 
 # Colour formatters
@@ -54,26 +59,53 @@ def args_parse():
             """,
             default='.')
 
+    parser.add_argument('--workers', help="""
+            Number of processes rendering plots. Default 1
+            """,
+            type=int,
+            default=1)
+
     return parser
 
-def run_multiple(pcoa, metadata, point_size):
-    """
-    Save multiple PCoA plots in a single pdf file
+def pcoa_plot_specs(pcoa, metadata_df, pdf_path=None, image_dir=None,
+        point_size=6, image_format='png'):
     """
-    # Load metadata into pandas dataframe
-    metadata_df = load_metadata(metadata)
+    Plot specifications (see plot_scheduler) of one PCoA plot per metadata
+    column.
 
-    cols = metadata_df.columns
+    Input:
+        - pcoa: skbio OrdinationResults
+        - metadata_df: metadata loaded with load_metadata()
+        - pdf_path: pdf file to save all plots in; None for no pdf
+        - image_dir: directory to save each plot in
+            (<column>.<image_format>); None for no images
+        - point_size: ggplot point size. Default=6
+        - image_format: image file format. Default='png'
 
-    for column in cols:
-        yield generate_pcoa_plot(
-                pcoa=pcoa,
-                metadata=metadata,
-                colouring_variable=str(column),
-                shape_variable=None,
-                point_size=point_size)
-
-def generate_pdf(pcoa_qza, metadata, file_name, output_dir, point_size=6):
+    Returns:
+        - list of PlotSpec, in column order
+    """
+    specs = []
+    for column in metadata_df.columns:
+        images = []
+        if(image_dir is not None):
+            images.append((os.path.join(image_dir, column + "." + image_format), image_format))
+
+        specs.append(PlotSpec(
+            generate_pcoa_plot,
+            kwargs={
+                'pcoa': pcoa,
+                'metadata': metadata_df,
+                'colouring_variable': str(column),
+                'shape_variable': None,
+                'point_size': point_size
+            },
+            images=images,
+            pdf_path=pdf_path))
+
+    return specs
+
+def generate_pdf(pcoa_qza, metadata, file_name, output_dir, point_size=6, workers=1):
     """
     Generates a single pdf file with multiple PCoA plots
 
@@ -83,47 +115,70 @@ def generate_pdf(pcoa_qza, metadata, file_name, output_dir, point_size=6):
         - file_name: name of the output file
         - output_dir: directory to save output file in
         - point_size: ggplot point size. Default=6
+        - workers: number of rendering processes. Default=1
     """
     pcoa = convert_qiime2_2_skbio(pcoa_qza)
 
-    #generate_pcoa_plot(pcoa, metadata_df, args.target_primary)
-    output_name = "PCoA_plots_all.pdf"
-    save_as_pdf_pages(
-            run_multiple(pcoa, metadata, point_size),
-            filename=file_name,
-            path=output_dir)
+    render_plots(
+            pcoa_plot_specs(pcoa, load_metadata(metadata),
+                pdf_path=os.path.join(output_dir, file_name),
+                point_size=point_size),
+            workers)
 
-def generate_images(pcoa_qza, metadata, output_dir, point_size=6, image_format='png'):
+def generate_images(pcoa_qza, metadata, output_dir, point_size=6, image_format='png',
+        workers=1):
     """
     Generate and save each plot in png file.
     """
     pcoa = convert_qiime2_2_skbio(pcoa_qza)
 
-    # Load metadata into pandas dataframe
-    metadata_df = load_metadata(metadata)
+    render_plots(
+            pcoa_plot_specs(pcoa, load_metadata(metadata),
+                image_dir=output_dir,
+                point_size=point_size,
+                image_format=image_format),
+            workers)
 
-    cols = metadata_df.columns
+def render_pcoa_plots(pcoa_qza, metadata_df, pdf_path, image_dir, point_size=6,
+        image_format='png', workers=1):
+    """
+    Make one PCoA plot per metadata column, and save all plots in a single
+    pdf file and each plot in its own image file.
 
-    for column in cols:
-        filename = column + "." + image_format
-        plot = generate_pcoa_plot(
-                    pcoa=pcoa,
-                    metadata=metadata,
-                    colouring_variable=str(column),
-                    shape_variable=None,
-                    point_size=point_size
-                )
+    Each plot is drawn once; the pdf page and the image are saved from the
+    same figure.
+
+    Input:
+        - pcoa_qza: PCoA QIIME2 Artifact
+        - metadata_df: metadata loaded with load_metadata()
+        - pdf_path: path to save pdf file
+        - image_dir: directory to save images in (<column>.<image_format>)
+        - point_size: ggplot point size. Default=6
+        - image_format: image file format. Default='png'
+        - workers: number of rendering processes. Default=1
+    """
+    pcoa = convert_qiime2_2_skbio(pcoa_qza)
 
-        plot.save(filename=filename, format=image_format, path=output_dir)
+    render_plots(
+            pcoa_plot_specs(pcoa, metadata_df, pdf_path, image_dir,
+                point_size, image_format),
+            workers)
 
 def save_as_json(metadata, output_path, image_format='png'):
     """
     Save metadata columns as json for web server to use
+
+    Input:
+        - metadata: path to metadata file, or metadata loaded with
+            load_metadata()
+        - output_path: path to save json file
+        - image_format: image file format of the plots
     """
     # Load metadata into pandas dataframe
-    metadata_df = load_metadata(metadata)
+    if(isinstance(metadata, str)):
+        metadata = load_metadata(metadata)
 
-    cols = metadata_df.columns
+    cols = metadata.columns
 
     data = {}
 
@@ -144,14 +199,5 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    pcoa = convert_qiime2_2_skbio(args.pcoa_qza)
-
-    # Load metadata into pandas dataframe
-    metadata_df = load_metadata(args.metadata)
-
-    #generate_pcoa_plot(pcoa, metadata_df, args.target_primary)
-    output_name = "PCoA_plots_all.pdf"
-    save_as_pdf_pages(
-            run_multiple(pcoa, args.metadata, args.point_size),
-            filename=args.file_name,
-            path=args.output_dir)
+    generate_pdf(args.pcoa_qza, args.metadata, args.file_name, args.output_dir,
+            args.point_size, args.workers)
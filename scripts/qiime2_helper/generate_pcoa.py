@@ -24,6 +24,11 @@ from scripts.qiime2_helper.plotnine_helper import (
     add_fill_colours_from_users
 )
 
+from scripts.qiime2_helper.session_cache import (
+    file_key,
+    shared_cache
+)
+
 # Custom exception
 from exceptions.exception import AXIOME3Error
 
@@ -110,6 +115,17 @@ def convert_qiime2_2_skbio(pcoa_artifact):
     ** Will throw errors if the artifact type is NOT PCoAResults **
     You may check Artifact type by checking the "type" property of the Artifact
     object after loading the artifact via 'Artifact.load(artifact)'
+
+    Results are kept in the session cache (keyed by file and artifact
+    UUID), so callers share the returned object; do not modify it.
+    """
+    key = ("pcoa_ordination",) + file_key(pcoa_artifact)
+
+    return shared_cache.get(key, lambda: load_pcoa_as_skbio(pcoa_artifact))
+
+def load_pcoa_as_skbio(pcoa_artifact):
+    """
+    convert_qiime2_2_skbio() without the cache.
     """
     try:
         pcoa_artifact = Artifact.load(pcoa_artifact)
@@ -187,9 +203,12 @@ def generate_pcoa_plot(
     if(PC_axis1 == PC_axis2):
         raise AXIOME3Error("PC axis one and PC axis two cannot be equal!")
 
-    # Load metadata file
-    metadata_df = load_metadata(metadata)
-    
+    # Load metadata file (unless already loaded)
+    if(isinstance(metadata, pd.DataFrame)):
+        metadata_df = metadata
+    else:
+        metadata_df = load_metadata(metadata)
+
     # Inner join metadata file with ordinations
     pcoa_coords = pcoa.samples
     pcoa_data_samples = pd.merge(
@@ -0,0 +1,395 @@
+"""
+On-demand PCoA images for the web server.
+
+Instead of rendering an image for every metadata column of every distance
+metric, the pipeline (lazy mode) only writes
+    - pcoa_columns.json (metadata column -> image file name) and
+    - the ordination coordinates of each metric
+      (<metric dir>/ordination.pickle).
+The first request for a (metric, column) image renders it from the stored
+coordinates and the metadata, and keeps it in a size-capped on-disk cache;
+least recently used images are evicted.
+
+make_server() serves the images over HTTP, e.g. as a local stand-in for the
+web server:
+
+    python -m scripts.qiime2_helper.pcoa_image_service
+        --pcoa-dir <output>/analysis/pcoa_plots --metadata metadata.tsv
+        --cache-dir /tmp/pcoa_images
+"""
+from argparse import ArgumentParser
+import os
+import sys
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import socketserver
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from scripts.qiime2_helper.artifact_cache import file_fingerprint
+from scripts.qiime2_helper.pcoa_ordination import (
+    METRIC_DIRS,
+    ORDINATION_FILE,
+    load_ordination
+)
+from scripts.qiime2_helper.plot_scheduler import (
+    PlotSpec,
+    render_spec
+)
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "pcoa_columns.json"
+
+# Renders of an image evicted (by other requests) before it could be sent
+IMAGE_READ_ATTEMPTS = 2
+
+IMAGE_CONTENT_TYPES = {
+    'png': "image/png",
+    'jpg': "image/jpeg",
+    'jpeg': "image/jpeg",
+    'svg': "image/svg+xml",
+    'pdf': "application/pdf"
+}
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    http.server.ThreadingHTTPServer (Python 3.7+)
+    """
+    daemon_threads = True
+
+def args_parse():
+    """
+    Parse command line arguments into Python
+    """
+    parser = ArgumentParser(description = "Serve PCoA images, rendered on request")
+
+    parser.add_argument('--pcoa-dir', help="""
+            PCoA output directory (with pcoa_columns.json)
+            """,
+            required=True)
+
+    parser.add_argument('--metadata', help="""
+            Metadata file used for QIIME2
+            """,
+            required=True)
+
+    parser.add_argument('--cache-dir', help="""
+            Directory to keep rendered images in
+            """,
+            required=True)
+
+    parser.add_argument('--max-size-mb', help="""
+            Size cap of the image cache in MB. Default 500
+            """,
+            type=float,
+            default=500)
+
+    parser.add_argument('--host', help="Default 127.0.0.1",
+            default="127.0.0.1")
+
+    parser.add_argument('--port', help="Default 8000",
+            type=int,
+            default=8000)
+
+    return parser
+
+class ImageCache(object):
+    """
+    Images stored as <cache_dir>/<key>.<format>; file mtime marks last use.
+    """
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key, image_format):
+        return os.path.join(self.cache_dir, key + "." + image_format)
+
+    def get(self, key, image_format):
+        """
+        Path of the cached image; None if not cached.
+        """
+        path = self.path(key, image_format)
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, key, image_format, src):
+        """
+        Move a rendered image into the cache.
+
+        Returns:
+            - path of the cached image
+        """
+        path = self.path(key, image_format)
+        os.replace(src, path)
+        self.evict(keep=path)
+
+        return path
+
+    def entries(self):
+        """
+        List of (last used time, size in bytes, path).
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if(name.startswith('.') or not os.path.isfile(path)):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used images until the cache fits its size cap.
+        """
+        entries = sorted(self.entries())
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, path in entries:
+            if(total_size <= self.max_size_bytes):
+                break
+            if(path == keep):
+                continue
+
+            logger.info("Evicting " + path + " from PCoA image cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size = total_size - size
+
+class PCoAImageService(object):
+    """
+    PCoA images of (metric, metadata column), rendered on first request.
+
+    Input:
+        - pcoa_dir: PCoA output directory (with pcoa_columns.json and the
+            ordination coordinates of each metric)
+        - metadata_path: metadata file
+        - cache: ImageCache
+        - point_size: ggplot point size. Default=6
+        - image_format: image file format. Default='png'
+    """
+    def __init__(self, pcoa_dir, metadata_path, cache, point_size=6, image_format='png'):
+        self.pcoa_dir = pcoa_dir
+        self.metadata_path = metadata_path
+        self.cache = cache
+        self.point_size = point_size
+        self.image_format = image_format
+
+        # path -> (fingerprint, loaded object)
+        self._loaded = {}
+        # matplotlib is not thread safe
+        self._render_lock = threading.Lock()
+
+    def index_path(self):
+        return os.path.join(self.pcoa_dir, INDEX_FILE)
+
+    def columns(self):
+        """
+        Metadata column -> image file name (pcoa_columns.json).
+        """
+        with open(self.index_path(), 'r') as fh:
+            return json.load(fh)
+
+    def ordination_path(self, metric):
+        return os.path.join(self.pcoa_dir, metric, ORDINATION_FILE)
+
+    def fingerprints(self, metric):
+        """
+        Fingerprints of the ordination and metadata files of a metric.
+        """
+        return (file_fingerprint(self.ordination_path(metric)),
+                file_fingerprint(self.metadata_path))
+
+    def image_key(self, metric, column, fingerprints=None):
+        """
+        Cache key of an image; changes if the ordination or metadata change.
+        """
+        if(fingerprints is None):
+            fingerprints = self.fingerprints(metric)
+
+        parts = list(fingerprints) + [
+            column,
+            str(self.point_size),
+            self.image_format
+        ]
+
+        return hashlib.sha256("\n".join(parts).encode('utf-8')).hexdigest()
+
+    def load(self, path, loader, fingerprint=None):
+        """
+        loader(path), kept until the file's fingerprint changes.
+        """
+        if(fingerprint is None):
+            fingerprint = file_fingerprint(path)
+
+        loaded = self._loaded.get(path)
+        if(loaded is not None and loaded[0] == fingerprint):
+            return loaded[1]
+
+        value = loader(path)
+        self._loaded[path] = (fingerprint, value)
+
+        return value
+
+    def metadata(self, fingerprint=None):
+        from scripts.qiime2_helper.metadata_helper import load_metadata
+
+        return self.load(self.metadata_path, load_metadata, fingerprint)
+
+    def ordination(self, metric, fingerprint=None):
+        return self.load(self.ordination_path(metric), load_ordination, fingerprint)
+
+    def image(self, metric, column):
+        """
+        Path of the image of a metric (image directory name, e.g.
+        'bray_curtis') coloured by a metadata column; rendered if not
+        cached.
+        """
+        if(metric not in METRIC_DIRS.values()):
+            raise AXIOME3Error("Unknown PCoA metric '{}'".format(metric))
+        if(column not in self.columns()):
+            raise AXIOME3Error("Unknown metadata column '{}'".format(column))
+        if not(os.path.isfile(self.ordination_path(metric))):
+            raise AXIOME3Error("No ordination coordinates for '{}'".format(metric))
+
+        # The image is rendered from the files the key was made of
+        ordination_fingerprint, metadata_fingerprint = fingerprints = self.fingerprints(metric)
+        key = self.image_key(metric, column, fingerprints)
+        path = self.cache.get(key, self.image_format)
+        if(path is not None):
+            return path
+
+        with self._render_lock:
+            # Rendered by another request meanwhile
+            path = self.cache.get(key, self.image_format)
+            if(path is not None):
+                return path
+
+            from scripts.qiime2_helper.generate_pcoa import generate_pcoa_plot
+
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=self.cache.cache_dir)
+            os.close(fd)
+            try:
+                render_spec(PlotSpec(
+                    generate_pcoa_plot,
+                    kwargs={
+                        'pcoa': self.ordination(metric, ordination_fingerprint),
+                        'metadata': self.metadata(metadata_fingerprint),
+                        'colouring_variable': column,
+                        'shape_variable': None,
+                        'point_size': self.point_size
+                    },
+                    images=[(tmp_path, self.image_format)]))
+
+                return self.cache.put(key, self.image_format, tmp_path)
+            finally:
+                if(os.path.exists(tmp_path)):
+                    os.remove(tmp_path)
+
+class PCoAImageHandler(BaseHTTPRequestHandler):
+    """
+    GET /pcoa_columns.json and GET /<metric>/<column>.<format>
+    """
+    service = None
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path, content_type):
+        with open(path, 'rb') as fh:
+            self.send_body(fh.read(), content_type)
+
+    def read_image(self, metric, column):
+        """
+        Bytes of an image; None if it was evicted from the cache (by
+        another request) every time before it could be read.
+        """
+        for _ in range(IMAGE_READ_ATTEMPTS):
+            image_path = self.service.image(metric, column)
+            try:
+                with open(image_path, 'rb') as fh:
+                    return fh.read()
+            except FileNotFoundError:
+                logger.info("PCoA image " + image_path + " evicted before it was sent")
+
+        return None
+
+    def do_GET(self):
+        path = unquote(self.path.split('?')[0]).lstrip('/')
+
+        if(path == INDEX_FILE):
+            self.send_file(self.service.index_path(), "application/json")
+            return
+
+        metric, _, filename = path.partition('/')
+        column, _, image_format = filename.rpartition('.')
+        if(image_format != self.service.image_format or column == ""):
+            self.send_error(404)
+            return
+
+        try:
+            body = self.read_image(metric, column)
+        except AXIOME3Error as err:
+            self.send_error(404, str(err))
+            return
+        except Exception as err:
+            logger.exception("Failed to render PCoA image " + path)
+            self.send_error(500, str(err))
+            return
+
+        if(body is None):
+            self.send_error(503, "PCoA image cache is full; try again")
+            return
+
+        self.send_body(body, IMAGE_CONTENT_TYPES.get(image_format, "application/octet-stream"))
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+def make_server(service, host="127.0.0.1", port=8000):
+    """
+    HTTP server for a PCoAImageService (port 0 picks a free port).
+    """
+    handler = type("BoundPCoAImageHandler", (PCoAImageHandler,), {'service': service})
+
+    return ThreadingHTTPServer((host, port), handler)
+
+if __name__ == "__main__":
+    parser = args_parse()
+
+    # Print help messages if no arguments are supplied
+    if( len(sys.argv) < 2):
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    cache = ImageCache(args.cache_dir, int(args.max_size_mb * 1024 ** 2))
+    service = PCoAImageService(args.pcoa_dir, args.metadata, cache)
+
+    server = make_server(service, args.host, args.port)
+    print("Serving PCoA images on http://{host}:{port}/".format(
+        host=server.server_address[0],
+        port=server.server_address[1]))
+    server.serve_forever()
@@ -0,0 +1,47 @@
+"""
+Stored PCoA coordinates, rendered into images on request by
+pcoa_image_service.
+
+The pipeline (lazy mode) saves the coordinates of each metric as
+<metric dir>/ordination.pickle.
+"""
+import os
+import pickle
+
+# Image directory of each PCoA artifact of Core_Metrics_Phylogeny
+METRIC_DIRS = {
+    'unweighted_unifrac_pcoa': "unweighted_unifrac",
+    'weighted_unifrac_pcoa': "weighted_unifrac",
+    'bray_curtis_pcoa': "bray_curtis",
+    'jaccard_pcoa': "jaccard"
+}
+ORDINATION_FILE = "ordination.pickle"
+
+class Ordination(object):
+    """
+    Coordinates of an ordination; what generate_pcoa_plot() uses of skbio
+    OrdinationResults.
+    """
+    def __init__(self, samples, proportion_explained):
+        self.samples = samples
+        self.proportion_explained = proportion_explained
+
+def save_ordination(pcoa, path):
+    """
+    Save the coordinates of a PCoA (from convert_qiime2_2_skbio()).
+    """
+    data = {
+        'samples': pcoa.samples,
+        'proportion_explained': pcoa.proportion_explained
+    }
+
+    tmp_path = path + ".{}.tmp".format(os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_ordination(path):
+    with open(path, 'rb') as fh:
+        data = pickle.load(fh)
+
+    return Ordination(data['samples'], data['proportion_explained'])
@@ -0,0 +1,170 @@
+"""
+Render batches of plots in worker processes.
+
+A plot is described by a PlotSpec: a module-level function making a
+plotnine ggplot, its keyword arguments, and the files to save it in (image
+files, and optionally a page of a multi-page pdf file). Specs are sent to a
+process pool; each worker makes and draws its plot once and saves its images
+from the figure. Figures of pdf pages are sent back (pickled) and added to
+their pdf files by this process, in spec order, while the workers draw the
+next plots. A figure that cannot be pickled is drawn again here.
+
+With a single worker, plots are rendered in this process.
+"""
+import pickle
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+logger = logging.getLogger(__name__)
+
+# Figure size units accepted by ggplot.save()
+UNITS_PER_INCH = {
+    'in': 1.0,
+    'cm': 2.54,
+    'mm': 25.4
+}
+
+def figure_size(width, height, units='mm'):
+    """
+    (width, height) in inches, for PlotSpec.
+    """
+    if(units not in UNITS_PER_INCH):
+        raise ValueError("units must be one of {}, not '{}'".format(
+            ", ".join(UNITS_PER_INCH), units))
+
+    return (width / UNITS_PER_INCH[units], height / UNITS_PER_INCH[units])
+
+class PlotSpec(object):
+    """
+    Plot to make and the files to save it in.
+
+    Input:
+        - make_plot: module-level function returning a plotnine ggplot
+        - kwargs: keyword arguments of make_plot
+        - images: list of (path, file format) to save the plot as
+        - pdf_path: multi-page pdf file to add the plot to (as a page, in
+            spec order); None if the plot is not part of a pdf file
+        - size: (width, height) in inches (see figure_size); None to keep
+            the theme's figure size
+    """
+    def __init__(self, make_plot, kwargs=None, images=(), pdf_path=None, size=None):
+        self.make_plot = make_plot
+        self.kwargs = dict(kwargs or {})
+        self.images = list(images)
+        self.pdf_path = pdf_path
+        self.size = size
+
+def draw(spec):
+    """
+    Make the plot of a spec and draw its matplotlib figure.
+    """
+    plot = spec.make_plot(**spec.kwargs)
+
+    if(spec.size is not None):
+        from plotnine import theme
+        plot = plot + theme(figure_size=spec.size)
+
+    return plot.draw()
+
+def save_figure(figure, path, file_format):
+    # Same settings as ggplot.save()
+    figure.savefig(path, format=file_format, bbox_inches='tight')
+
+def render_spec(spec):
+    """
+    Draw one plot and save its images.
+    """
+    figure = draw(spec)
+    try:
+        for path, file_format in spec.images:
+            save_figure(figure, path, file_format)
+    finally:
+        plt.close(figure)
+
+def render_figure(spec):
+    """
+    Draw one plot and save its images (in a worker process).
+
+    Returns:
+        - the pickled figure if the plot is a pdf page (None if it cannot
+            be pickled), otherwise None
+    """
+    figure = draw(spec)
+    try:
+        pickled = None
+        if(spec.pdf_path is not None):
+            # Before saving: saved legends hold unpicklable closures
+            try:
+                pickled = pickle.dumps(figure, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as err:
+                logger.debug("Cannot pickle figure; drawing it again: {}".format(err))
+
+        for path, file_format in spec.images:
+            save_figure(figure, path, file_format)
+
+        return pickled
+    finally:
+        plt.close(figure)
+
+def add_page(pdfs, pdf_path, figure):
+    """
+    Add a figure to a pdf file (opened on its first page).
+    """
+    if(pdf_path not in pdfs):
+        pdfs[pdf_path] = PdfPages(pdf_path)
+    pdfs[pdf_path].savefig(figure, bbox_inches='tight')
+
+def render_serial(specs):
+    """
+    Render plots one after the other in this process.
+    """
+    pdfs = OrderedDict()
+    try:
+        for spec in specs:
+            figure = draw(spec)
+            try:
+                for path, file_format in spec.images:
+                    save_figure(figure, path, file_format)
+                if(spec.pdf_path is not None):
+                    add_page(pdfs, spec.pdf_path, figure)
+            finally:
+                plt.close(figure)
+    finally:
+        for pdf in pdfs.values():
+            pdf.close()
+
+def render_plots(specs, workers=1):
+    """
+    Render plots, in parallel worker processes if workers > 1.
+
+    Input:
+        - specs: list of PlotSpec
+        - workers: number of worker processes
+    """
+    specs = list(specs)
+    workers = min(int(workers), len(specs))
+
+    if(workers <= 1):
+        render_serial(specs)
+        return
+
+    pdfs = OrderedDict()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Results in spec order, as workers finish them
+            for spec, pickled in zip(specs, pool.map(render_figure, specs)):
+                if(spec.pdf_path is None):
+                    continue
+
+                figure = pickle.loads(pickled) if pickled is not None else draw(spec)
+                try:
+                    add_page(pdfs, spec.pdf_path, figure)
+                finally:
+                    plt.close(figure)
+    finally:
+        for pdf in pdfs.values():
+            pdf.close()
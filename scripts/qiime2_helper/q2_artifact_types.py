@@ -1,5 +1,7 @@
 ARTIFACT_TYPES = {
 	"pcoa": "PCoAResults",
 	"feature_table": "FeatureTable[Frequency]",
-	"taxonomy": "FeatureData[Taxonomy]"
-}
\ No newline at end of file
+	"taxonomy": "FeatureData[Taxonomy]",
+	"rep_seqs": "FeatureData[Sequence]",
+	"classifier": "TaxonomicClassifier"
+}
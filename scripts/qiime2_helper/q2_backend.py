@@ -0,0 +1,325 @@
+"""
+In-process execution backend for QIIME2 commands.
+
+Commands are given in the same form as for the qiime CLI, e.g.
+
+    ['qiime', 'taxa', 'collapse', '--i-table', 'table.qza', ...]
+
+and are dispatched to the plugin action through the QIIME2 Artifact API
+instead of a new qiime process. Plugins are loaded once per process and
+input artifacts are kept in memory, so a long-lived worker only pays the
+plugin manager startup and .qza loading once.
+"""
+import os
+import io
+import logging
+import contextlib
+
+from exceptions.exception import AXIOME3Error
+
+logger = logging.getLogger(__name__)
+
+# qiime tools actions that have an in-process equivalent
+SUPPORTED_TOOLS = ('import', 'export')
+
+# Loaded once per process
+_plugin_manager = None
+
+# {abs path: (mtime, Artifact)}
+_artifact_cache = {}
+
+# {abs path: (mtime, Metadata)}
+_metadata_cache = {}
+
+def get_plugin_manager():
+    """
+    Returns QIIME2 plugin manager, loading plugins on first use.
+    """
+    global _plugin_manager
+
+    if(_plugin_manager is None):
+        from qiime2.sdk import PluginManager
+
+        logger.info("Loading QIIME2 plugins")
+        _plugin_manager = PluginManager()
+
+    return _plugin_manager
+
+def _cache_get(cache, path):
+    abs_path = os.path.abspath(path)
+    mtime = os.path.getmtime(abs_path)
+
+    cached = cache.get(abs_path)
+    if(cached is not None and cached[0] == mtime):
+        return cached[1]
+
+    return None
+
+def _cache_put(cache, path, obj):
+    abs_path = os.path.abspath(path)
+    cache[abs_path] = (os.path.getmtime(abs_path), obj)
+
+def load_artifact(path):
+    """
+    Load QIIME2 artifact, reusing the in-memory copy if the file is unchanged.
+    """
+    artifact = _cache_get(_artifact_cache, path)
+
+    if(artifact is None):
+        from qiime2 import Artifact
+
+        artifact = Artifact.load(path)
+        _cache_put(_artifact_cache, path, artifact)
+
+    return artifact
+
+def load_metadata(path):
+    """
+    Load QIIME2 metadata from a metadata file or a viewable artifact.
+    """
+    metadata = _cache_get(_metadata_cache, path)
+
+    if(metadata is None):
+        from qiime2 import Metadata
+
+        if(path.endswith('.qza')):
+            metadata = load_artifact(path).view(Metadata)
+        else:
+            metadata = Metadata.load(path)
+        _cache_put(_metadata_cache, path, metadata)
+
+    return metadata
+
+def clear_cache():
+    _artifact_cache.clear()
+    _metadata_cache.clear()
+
+def parse_qiime_cmd(cmd):
+    """
+    Parse qiime CLI command.
+
+    Input:
+        - cmd: list of command line tokens, starting with 'qiime'
+
+    Returns:
+        - dictionary with plugin and action names and the '--i-', '--p-',
+        '--m-' and '--o-' options as well as any other options.
+        Repeated options are collected as lists. Options without
+        values (flags) are set to None.
+    """
+    if(len(cmd) < 3 or cmd[0] != 'qiime'):
+        raise AXIOME3Error("Not a qiime command: {}".format(cmd))
+
+    parsed = {
+        "plugin": cmd[1],
+        "action": cmd[2],
+        "inputs": {},
+        "parameters": {},
+        "metadata": {},
+        "outputs": {},
+        "options": {}
+    }
+    groups = {
+        "i": "inputs",
+        "p": "parameters",
+        "m": "metadata",
+        "o": "outputs"
+    }
+
+    tokens = [str(t) for t in cmd[3:]]
+    i = 0
+    while(i < len(tokens)):
+        token = tokens[i]
+        if not(token.startswith('--')):
+            raise AXIOME3Error("Unexpected argument '{}' in {}".format(token, cmd))
+
+        name = token[2:]
+        # Flag if there is no value following it
+        if(i + 1 < len(tokens) and not tokens[i+1].startswith('--')):
+            value = tokens[i+1]
+            i = i + 2
+        else:
+            value = None
+            i = i + 1
+
+        prefix = name.split('-', 1)[0]
+        if(prefix in groups and '-' in name):
+            group = parsed[groups[prefix]]
+            name = name.split('-', 1)[1]
+        else:
+            group = parsed["options"]
+
+        if(name in group):
+            if not(isinstance(group[name], list)):
+                group[name] = [group[name]]
+            group[name].append(value)
+        else:
+            group[name] = value
+
+    return parsed
+
+def is_supported(cmd):
+    """
+    Checks whether the command can be run in-process.
+    """
+    try:
+        parsed = parse_qiime_cmd(cmd)
+    except AXIOME3Error:
+        return False
+
+    if(parsed["plugin"] == "tools"):
+        return (parsed["action"] in SUPPORTED_TOOLS and
+                "output-format" not in parsed["options"])
+
+    # Directory outputs are left to the CLI
+    if("output-dir" in parsed["options"]):
+        return False
+
+    return True
+
+def _get_action(plugin_name, action_name):
+    plugins = get_plugin_manager().plugins
+
+    for name in (plugin_name, plugin_name.replace('-', '_')):
+        if(name in plugins):
+            plugin = plugins[name]
+            break
+    else:
+        raise AXIOME3Error("QIIME2 plugin '{}' is not installed".format(plugin_name))
+
+    action_id = action_name.replace('-', '_')
+    if(action_id not in plugin.actions):
+        raise AXIOME3Error("'{plugin}' has no action '{action}'".format(
+            plugin=plugin_name,
+            action=action_name))
+
+    return plugin.actions[action_id]
+
+def _is_collection(qiime_type):
+    type_expr = str(qiime_type)
+
+    return type_expr.startswith('List') or type_expr.startswith('Set')
+
+def _coerce_primitive(value, qiime_type):
+    """
+    Convert CLI string to the primitive expected by the action parameter.
+    """
+    if(isinstance(value, list)):
+        return [_coerce_primitive(v, qiime_type) for v in value]
+
+    type_expr = str(qiime_type)
+
+    if(type_expr.startswith('Bool') and value.lower() in ('true', 'false')):
+        return value.lower() == 'true'
+    if('Int' in type_expr):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    if('Float' in type_expr):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+    return value
+
+def _build_arguments(action, parsed):
+    signature = action.signature
+    arguments = {}
+
+    for name, value in parsed["inputs"].items():
+        name = name.replace('-', '_')
+        if(isinstance(value, list)):
+            arguments[name] = [load_artifact(v) for v in value]
+        elif(name in signature.inputs and _is_collection(signature.inputs[name].qiime_type)):
+            arguments[name] = [load_artifact(value)]
+        else:
+            arguments[name] = load_artifact(value)
+
+    for name, value in parsed["parameters"].items():
+        name = name.replace('-', '_')
+
+        # Boolean flags (--p-name / --p-no-name)
+        if(value is None):
+            if(name in signature.parameters):
+                arguments[name] = True
+            elif(name.startswith('no_') and name[3:] in signature.parameters):
+                arguments[name[3:]] = False
+            else:
+                raise AXIOME3Error("Unknown flag '--p-{}'".format(name))
+            continue
+
+        if(name not in signature.parameters):
+            raise AXIOME3Error("Unknown parameter '--p-{}'".format(name))
+
+        qiime_type = signature.parameters[name].qiime_type
+        if(_is_collection(qiime_type) and not isinstance(value, list)):
+            value = [value]
+        arguments[name] = _coerce_primitive(value, qiime_type)
+
+    # --m-<name>-file and optional --m-<name>-column
+    metadata_columns = {}
+    for key, value in parsed["metadata"].items():
+        name, _, kind = key.rpartition('-')
+        name = name.replace('-', '_')
+        if(kind == 'file'):
+            files = value if isinstance(value, list) else [value]
+            metadata = [load_metadata(f) for f in files]
+            arguments[name] = metadata[0].merge(*metadata[1:]) if len(metadata) > 1 else metadata[0]
+        elif(kind == 'column'):
+            metadata_columns[name] = value
+        else:
+            raise AXIOME3Error("Unknown metadata option '--m-{}'".format(key))
+
+    for name, column in metadata_columns.items():
+        arguments[name] = arguments[name].get_column(column)
+
+    return arguments
+
+def _run_tools(parsed):
+    options = parsed["options"]
+
+    if(parsed["action"] == "import"):
+        from qiime2 import Artifact
+
+        artifact = Artifact.import_data(
+                options["type"],
+                options["input-path"],
+                view_type=options.get("input-format"))
+        saved = artifact.save(options["output-path"])
+        _cache_put(_artifact_cache, saved, artifact)
+    elif(parsed["action"] == "export"):
+        load_artifact(options["input-path"]).export_data(options["output-path"])
+
+def execute(cmd):
+    """
+    Run qiime CLI command in the current process.
+
+    Input:
+        - cmd: list of command line tokens, starting with 'qiime'
+
+    Returns:
+        - captured standard output and error (bytes), similar to the CLI
+    """
+    parsed = parse_qiime_cmd(cmd)
+    captured = io.StringIO()
+
+    with contextlib.redirect_stdout(captured), contextlib.redirect_stderr(captured):
+        if(parsed["plugin"] == "tools"):
+            _run_tools(parsed)
+        else:
+            action = _get_action(parsed["plugin"], parsed["action"])
+            arguments = _build_arguments(action, parsed)
+
+            results = action(**arguments)
+
+            for name, path in parsed["outputs"].items():
+                result = getattr(results, name.replace('-', '_'))
+                saved = result.save(path)
+
+                # Downstream steps reuse the in-memory result
+                if(saved.endswith('.qza')):
+                    _cache_put(_artifact_cache, saved, result)
+
+    return captured.getvalue().encode('utf-8')
@@ -0,0 +1,88 @@
+"""
+Jobs and set up of R session pool workers (see r_session_pool).
+
+The pool pickles jobs by reference, so the process sending them imports
+this module too. rpy2 (which starts embedded R) is imported inside the
+functions; only the workers running them start R.
+"""
+import numpy as np
+import pandas as pd
+
+# R packages loaded ahead of jobs in R session pool workers
+R_PACKAGES = ("stats", "vegan")
+
+# R packages loaded in this process
+_r_packages = {}
+
+def r_package(name):
+    """
+    R package (rpy2 importr), loaded once per process.
+    """
+    if(name not in _r_packages):
+        from rpy2.robjects.packages import importr
+        _r_packages[name] = importr(name)
+
+    return _r_packages[name]
+
+def load_r_packages():
+    """
+    Load R_PACKAGES (R session pool initializer).
+    """
+    for name in R_PACKAGES:
+        r_package(name)
+
+def r_session_health():
+    """
+    True if the embedded R session evaluates expressions (R session pool
+    health check).
+    """
+    import rpy2.robjects as ro
+
+    return ro.r("1 + 1")[0] == 2
+
+def triplot_ordination(feature_table_df, abundance_df, env_metadata_df,
+        dissmilarity_index, k, PC_axis_one, PC_axis_two):
+    """
+    Ordination part of pcoa_triplot.R, run in the embedded R session.
+
+    Inputs:
+        - feature_table_df: samples as rows, taxa/ASV as columns
+        - abundance_df: samples as rows, taxa as columns
+        - env_metadata_df: numeric environmental variables (samples as rows)
+        - dissmilarity_index: vegan vegdist method (e.g. 'bray')
+        - k: number of PCoA dimensions
+        - PC_axis_one, PC_axis_two: axes to fit environmental vectors onto
+
+    Returns:
+        - pcoa_df: PCoA coordinates (samples as rows, 'Axis 1'... as columns)
+        - eig: numpy array of eigenvalues
+        - wascores_df: taxa weighted averages (taxa as rows)
+        - projection_df: environmental vectors ('Dim<axis>' unit arrow
+            coordinates, 'R2' and 'pvals' as columns)
+    """
+    import rpy2.robjects as ro
+    from scripts.qiime2_helper.rpy2_helper import convert_pd_df_to_r
+
+    vegan = r_package("vegan")
+    stats = r_package("stats")
+
+    dissimilarity = vegan.vegdist(convert_pd_df_to_r(feature_table_df), method=dissmilarity_index)
+    pcoa = stats.cmdscale(dissimilarity, k=k, eig=True)
+    points = pcoa.rx2("points")
+
+    wascores = vegan.wascores(points, convert_pd_df_to_r(abundance_df))
+    projection = vegan.envfit(pcoa, convert_pd_df_to_r(env_metadata_df),
+        choices=ro.IntVector([PC_axis_one, PC_axis_two]))
+    vectors = projection.rx2("vectors")
+
+    points_array = np.asarray(points)
+    axis_names = ["Axis " + str(i) for i in range(1, points_array.shape[1] + 1)]
+    pcoa_df = pd.DataFrame(points_array, index=feature_table_df.index, columns=axis_names)
+    wascores_df = pd.DataFrame(np.asarray(wascores), index=abundance_df.columns, columns=axis_names)
+
+    projection_df = pd.DataFrame(np.asarray(vectors.rx2("arrows")), index=env_metadata_df.columns,
+        columns=["Dim" + str(PC_axis_one), "Dim" + str(PC_axis_two)])
+    projection_df["R2"] = np.asarray(vectors.rx2("r"))
+    projection_df["pvals"] = np.asarray(vectors.rx2("pvals"))
+
+    return pcoa_df, np.asarray(pcoa.rx2("eig")), wascores_df, projection_df
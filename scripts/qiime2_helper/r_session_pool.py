@@ -0,0 +1,298 @@
+"""
+Pool of worker processes, each with an embedded R session (rpy2).
+
+Starting R and loading vegan takes longer than most triplot computations,
+and embedded R can only run one job at a time per process. The pool keeps
+a few worker processes with R already started (and packages loaded by the
+initializer), and dispatches jobs to idle workers:
+    - jobs are module-level functions; arguments and results (e.g. pandas
+      DataFrames) are pickled between processes,
+    - a worker is health checked before it gets a job, and replaced if it
+      exited or does not answer,
+    - a worker is replaced after max_jobs jobs, so memory held by R is
+      given back.
+
+    pool = RSessionPool(size=2, initializer=load_r_packages,
+        health_check=r_session_health)
+    result = pool.run(triplot_ordination, feature_table_df, ...)
+"""
+import atexit
+import logging
+import threading
+import traceback
+import multiprocessing
+from queue import Queue
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_JOBS = 50
+# Seconds; starting R and loading packages
+STARTUP_TIMEOUT = 300
+# Seconds
+HEALTH_TIMEOUT = 10
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def _worker_main(conn, initializer, health_check):
+    """
+    Worker process loop. Messages are
+        - None: exit
+        - ('ping',): health check
+        - ('job', func, args, kwargs)
+    and answers are ('ok', result) or ('error', traceback).
+    """
+    try:
+        if(initializer is not None):
+            initializer()
+        conn.send(('ok', None))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if(message is None):
+            return
+
+        try:
+            if(message[0] == 'ping'):
+                result = health_check() if health_check is not None else True
+            else:
+                _, func, args, kwargs = message
+                result = func(*args, **kwargs)
+            answer = ('ok', result)
+        except Exception:
+            answer = ('error', traceback.format_exc())
+
+        conn.send(answer)
+
+class RSessionWorker(object):
+    """
+    A worker process and the parent's end of its pipe.
+    """
+    def __init__(self, context, initializer=None, health_check=None):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, initializer, health_check),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.jobs = 0
+
+    def receive(self, timeout=None):
+        """
+        Next answer of the worker.
+
+        Raises EOFError if the worker exited, TimeoutError if it did not
+        answer within timeout seconds.
+        """
+        if(timeout is not None and not self.conn.poll(timeout)):
+            raise TimeoutError("R session worker did not answer within {} seconds".format(timeout))
+
+        return self.conn.recv()
+
+    def call(self, message, timeout=None):
+        self.conn.send(message)
+
+        return self.receive(timeout)
+
+    def healthy(self, timeout=HEALTH_TIMEOUT):
+        if not(self.process.is_alive()):
+            return False
+
+        try:
+            status, result = self.call(('ping',), timeout)
+        except (EOFError, OSError, TimeoutError):
+            return False
+
+        return status == 'ok' and bool(result)
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+
+        self.process.join(timeout)
+        if(self.process.is_alive()):
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+class RSessionPool(object):
+    """
+    Input:
+        - size: number of worker processes
+        - max_jobs: jobs a worker runs before it is replaced
+        - initializer: module-level function run once in each worker
+            (e.g. loading R packages)
+        - health_check: module-level function run in a worker before it
+            gets a job; the worker is replaced unless it returns True
+        - start_method: multiprocessing start method. Default 'spawn'
+            (workers do not inherit the parent's state)
+        - startup_timeout: seconds to wait for a worker to start
+        - health_timeout: seconds to wait for a health check
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_jobs=DEFAULT_MAX_JOBS,
+            initializer=None, health_check=None, start_method='spawn',
+            startup_timeout=STARTUP_TIMEOUT, health_timeout=HEALTH_TIMEOUT):
+        if(int(size) < 1):
+            raise AXIOME3Error("R session pool size must be at least 1")
+        if(int(max_jobs) < 1):
+            raise AXIOME3Error("Jobs per R session worker must be at least 1")
+
+        self.size = int(size)
+        self.max_jobs = int(max_jobs)
+        self.initializer = initializer
+        self.health_check = health_check
+        self.context = multiprocessing.get_context(start_method)
+        self.startup_timeout = startup_timeout
+        self.health_timeout = health_timeout
+
+        # Idle workers; None is a slot whose worker has to be (re)started
+        self._idle = Queue()
+        self._closed = False
+
+        # Start all workers before waiting for any of them
+        workers = [self._launch_worker() for _ in range(self.size)]
+        for worker in workers:
+            try:
+                self._wait_for_startup(worker)
+            except AXIOME3Error:
+                for other in workers:
+                    other.stop()
+                raise
+        for worker in workers:
+            self._idle.put(worker)
+
+    def _launch_worker(self):
+        return RSessionWorker(self.context, self.initializer, self.health_check)
+
+    def _wait_for_startup(self, worker):
+        try:
+            status, result = worker.receive(self.startup_timeout)
+        except (EOFError, OSError, TimeoutError) as err:
+            worker.stop()
+            raise AXIOME3Error("R session worker failed to start: " + str(err))
+
+        if(status != 'ok'):
+            worker.stop()
+            raise AXIOME3Error("R session worker failed to start:\n" + result)
+
+    def _start_worker(self):
+        worker = self._launch_worker()
+        self._wait_for_startup(worker)
+
+        return worker
+
+    def _replace(self, worker):
+        """
+        Stop a worker and put a new one in the idle queue (in the
+        background, so the caller does not wait for R to start).
+        """
+        def restart():
+            worker.stop()
+            replacement = None
+            if not(self._closed):
+                try:
+                    replacement = self._start_worker()
+                except AXIOME3Error:
+                    logger.exception("Failed to restart R session worker")
+            self._idle.put(replacement)
+
+        threading.Thread(target=restart, daemon=True).start()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in an idle worker and return its result.
+        Blocks until a worker is idle.
+
+        Raises AXIOME3Error if the job fails (with the worker's traceback)
+        or the worker exits while running it.
+        """
+        if(self._closed):
+            raise AXIOME3Error("R session pool is closed")
+
+        worker = self._idle.get()
+        try:
+            if(worker is not None and not worker.healthy(self.health_timeout)):
+                logger.warning("Replacing unresponsive R session worker")
+                worker.stop()
+                worker = None
+            if(worker is None):
+                worker = self._start_worker()
+
+            try:
+                status, result = worker.call(('job', func, args, kwargs))
+            except (EOFError, OSError):
+                worker.stop()
+                worker = None
+                raise AXIOME3Error("R session worker exited while running a job")
+        except BaseException:
+            # Interrupted mid-job, the worker may still send an answer
+            if(worker is not None):
+                worker.stop()
+            self._idle.put(None)
+            raise
+
+        worker.jobs = worker.jobs + 1
+        if(self._closed):
+            worker.stop()
+        elif(worker.jobs >= self.max_jobs):
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+
+        if(status != 'ok'):
+            raise AXIOME3Error("R error:\n" + result)
+
+        return result
+
+    def close(self):
+        """
+        Stop idle workers. Workers running a job are stopped when returned
+        to the pool by run().
+        """
+        self._closed = True
+        while not(self._idle.empty()):
+            worker = self._idle.get()
+            if(worker is not None):
+                worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def default_pool(size=DEFAULT_POOL_SIZE, max_jobs=DEFAULT_MAX_JOBS):
+    """
+    R session pool shared by the triplot requests of this process, with
+    vegan and stats loaded. Created on first use; size and max_jobs only
+    apply then.
+    """
+    global _default_pool
+
+    with _default_pool_lock:
+        if(_default_pool is None):
+            from scripts.qiime2_helper.r_session_jobs import (
+                load_r_packages,
+                r_session_health
+            )
+
+            _default_pool = RSessionPool(size, max_jobs,
+                initializer=load_r_packages,
+                health_check=r_session_health)
+            atexit.register(_default_pool.close)
+
+    return _default_pool
@@ -0,0 +1,265 @@
+"""
+Rarefaction (subsampling without replacement) of feature tables.
+
+A rarefied sample is a random subsample of its reads. Rarefaction curves
+need many depths and iterations per sample; for each iteration the reads
+of a sample are drawn once, in random order, up to the deepest depth, and
+every shallower subsample is a prefix of that draw (a uniform subsample of
+a uniform subsample is a uniform subsample).
+
+Alpha diversity (observed features, Shannon) is computed for all depths
+and iterations of a sample together. The curves are then used to suggest
+a sampling depth from a sample retention target. Simpler depth strategies
+(select_sampling_depth) only need the total count of each sample.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+
+DEFAULT_ITERATIONS = 10
+DEFAULT_STEPS = 10
+METRICS = ("observed_features", "shannon")
+# Sampling depth strategies answered from sample totals
+DEPTH_STRATEGIES = ("min", "retention", "max_reads")
+
+def sample_reads(counts):
+    """
+    Feature index of each read of a sample.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+
+    return np.repeat(np.arange(len(counts)), counts)
+
+def subsample(counts, depth, rng, size=None):
+    """
+    Counts of a random subsample of depth reads (without replacement).
+
+    Input:
+        - counts: feature counts of a sample (integers)
+        - depth: number of reads to keep
+        - rng: numpy Generator
+        - size: number of independent subsamples; None for one
+
+    Returns:
+        - numpy array of counts (size x features if size is given)
+    """
+    reads = sample_reads(counts)
+    n_draws = 1 if size is None else int(size)
+
+    draws = np.empty((n_draws, len(counts)), dtype=np.int64)
+    for i in range(n_draws):
+        kept = reads[rng.choice(len(reads), int(depth), replace=False)]
+        draws[i] = np.bincount(kept, minlength=len(counts))
+
+    return draws[0] if size is None else draws
+
+def nested_subsamples(counts, depths, iterations, rng):
+    """
+    Subsamples of a sample at each depth, for each iteration.
+
+    Input:
+        - counts: feature counts of a sample (integers)
+        - depths: ascending depths, at most the sample total
+        - iterations: number of iterations
+        - rng: numpy Generator
+
+    Returns:
+        - (iterations x depths x features) numpy array of counts
+    """
+    draws = np.empty((iterations, len(depths), len(counts)), dtype=np.int64)
+    if(len(depths) == 0):
+        return draws
+
+    reads = sample_reads(counts)
+    for i in range(iterations):
+        # Reads in random order; the first depth reads are a subsample
+        ordered = reads[rng.choice(len(reads), int(depths[-1]), replace=False)]
+        for j, depth in enumerate(depths):
+            draws[i, j] = np.bincount(ordered[:depth], minlength=len(counts))
+
+    return draws
+
+def observed_features(counts):
+    """
+    Number of features with non-zero counts (along the last axis).
+    """
+    return (counts > 0).sum(axis=-1)
+
+def shannon(counts):
+    """
+    Shannon diversity in bits (as QIIME2 'shannon'), along the last axis.
+    """
+    totals = counts.sum(axis=-1, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportions = counts / totals
+        terms = np.where(counts > 0, proportions * np.log2(proportions), 0)
+
+    return -terms.sum(axis=-1)
+
+def rarefaction_depths(max_depth, steps=DEFAULT_STEPS, min_depth=1):
+    """
+    Depths of a rarefaction curve: steps evenly spaced integers from
+    min_depth to max_depth (as 'qiime diversity alpha-rarefaction').
+    """
+    if(int(max_depth) < int(min_depth)):
+        raise AXIOME3Error("Maximum rarefaction depth must be at least {}".format(min_depth))
+
+    depths = np.linspace(int(min_depth), int(max_depth), int(steps)).astype(int)
+
+    return sorted(set(int(depth) for depth in depths))
+
+def alpha_rarefaction(table, depths, iterations=DEFAULT_ITERATIONS, seed=None):
+    """
+    Alpha diversity along rarefaction curves.
+
+    Input:
+        - table: biom table (integer counts)
+        - depths: rarefaction depths
+        - iterations: subsamples per sample and depth
+        - seed: random seed
+
+    Returns:
+        - pd.DataFrame with 'sample-id', 'depth', 'iteration' and one
+            column per metric (METRICS); a sample is left out at depths
+            above its total count
+    """
+    rng = np.random.default_rng(seed)
+    depths = np.array(sorted(set(int(depth) for depth in depths)))
+    # Samples are columns
+    matrix = table.matrix_data.tocsc()
+
+    curves = []
+    for j, sample_id in enumerate(table.ids(axis='sample')):
+        counts = matrix.data[matrix.indptr[j]:matrix.indptr[j+1]].astype(np.int64)
+        sample_depths = depths[depths <= counts.sum()]
+        if(len(sample_depths) == 0):
+            continue
+
+        draws = nested_subsamples(counts, sample_depths, iterations, rng)
+
+        # Iteration major, as draws
+        curves.append(pd.DataFrame({
+            'sample-id': sample_id,
+            'depth': np.tile(sample_depths, iterations),
+            'iteration': np.repeat(np.arange(1, iterations + 1), len(sample_depths)),
+            'observed_features': observed_features(draws).ravel(),
+            'shannon': shannon(draws).ravel()
+        }))
+
+    if(len(curves) == 0):
+        raise AXIOME3Error("No sample has at least {} counts".format(depths.min()))
+
+    return pd.concat(curves, ignore_index=True)
+
+def curve_summary(curves):
+    """
+    Mean of each metric per sample and depth.
+
+    Returns:
+        - pd.DataFrame indexed by ('sample-id', 'depth')
+    """
+    return curves.groupby(['sample-id', 'depth'])[list(METRICS)].mean()
+
+def retention_depth(totals, retention):
+    """
+    Largest depth that keeps at least a share of the samples.
+
+    Input:
+        - totals: total count of each sample
+        - retention: share of samples to keep (0 to 1)
+    """
+    if not(0 < float(retention) <= 1):
+        raise AXIOME3Error("Sample retention must be between 0 and 1, not {}".format(retention))
+
+    ordered = np.sort(np.asarray(totals, dtype=float))[::-1]
+    if(len(ordered) == 0):
+        raise AXIOME3Error("Feature table has no samples")
+    n_kept = max(1, math.ceil(float(retention) * len(ordered) - 1e-9))
+
+    return int(ordered[n_kept - 1])
+
+def max_reads_depth(totals):
+    """
+    Depth that keeps the most reads after rarefaction: depth times the
+    number of samples with at least depth counts. On ties, the depth
+    keeping more samples.
+
+    Input:
+        - totals: total count of each sample
+    """
+    ordered = np.sort(np.asarray(totals, dtype=float))[::-1]
+    if(len(ordered) == 0):
+        raise AXIOME3Error("Feature table has no samples")
+
+    # Rarefied to ordered[i], the i+1 largest samples are kept
+    kept_reads = ordered * np.arange(1, len(ordered) + 1)
+    best = len(kept_reads) - 1 - int(np.argmax(kept_reads[::-1]))
+
+    return int(ordered[best])
+
+def select_sampling_depth(totals, strategy="min", retention=0.9):
+    """
+    Sampling depth from sample totals.
+
+    Input:
+        - totals: total count of each sample
+        - strategy: one of DEPTH_STRATEGIES
+            - 'min': smallest sample total (keeps every sample)
+            - 'retention': largest depth keeping at least retention of
+                the samples
+            - 'max_reads': depth keeping the most reads (max_reads_depth)
+        - retention: share of samples to keep (0 to 1; 'retention' only)
+
+    Returns:
+        - sampling depth (int; at least 1)
+    """
+    if(strategy == "min"):
+        depth = retention_depth(totals, 1)
+    elif(strategy == "retention"):
+        depth = retention_depth(totals, retention)
+    elif(strategy == "max_reads"):
+        depth = max_reads_depth(totals)
+    else:
+        raise AXIOME3Error("Unknown sampling depth strategy '{}'; expected one of {}".format(
+            strategy, ", ".join(DEPTH_STRATEGIES)))
+
+    return max(1, depth)
+
+def suggest_sampling_depth(curves, totals, retention=0.9, saturation=0.95):
+    """
+    Sampling depth from rarefaction curves and a sample retention target.
+
+    Depths keeping at least retention of the samples are candidates. The
+    suggestion is the smallest candidate at which the median sample has
+    reached saturation of the observed features it has at the largest
+    candidate; deeper sampling would drop samples for little gain.
+
+    Input:
+        - curves: alpha_rarefaction() output
+        - totals: total count of each sample (pd.Series)
+        - retention: share of samples to keep (0 to 1)
+        - saturation: share of observed features to reach (0 to 1)
+
+    Returns:
+        - sampling depth (int)
+    """
+    totals = pd.Series(totals, dtype=float)
+    depths = np.array(sorted(curves['depth'].unique()))
+    kept = np.array([(totals >= depth).mean() for depth in depths])
+
+    candidates = depths[kept >= float(retention) - 1e-9]
+    if(len(candidates) == 0):
+        raise AXIOME3Error("No rarefaction depth keeps {:.0%} of samples".format(float(retention)))
+    limit = candidates.max()
+
+    observed = curve_summary(curves)['observed_features'].unstack('depth')
+    at_limit = observed[limit].dropna()
+    ratios = observed.loc[at_limit.index, candidates].div(at_limit, axis=0)
+    median_ratio = ratios.median()
+
+    return int(median_ratio.index[median_ratio >= float(saturation) - 1e-9].min())
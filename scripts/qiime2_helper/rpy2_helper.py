@@ -39,4 +39,4 @@ def convert_r_df_to_pd_df(r_df):
 	with localconverter(ro.default_converter + pandas2ri.converter):
 		pd_df = ro.conversion.rpy2py(r_df)
 
-	return pd_df
\ No newline at end of file
+	return pd_df
@@ -0,0 +1,175 @@
+"""
+In-memory cache of loaded inputs and intermediate results for the
+interactive plots (bubbleplot, triplot, PCoA).
+
+While a user adjusts a plot in the web UI, the same artifacts and
+metadata are loaded again and again. Loading a QIIME2 artifact unzips
+the .qza, and viewing it deserializes the data. This cache keeps, per
+process,
+    - loaded artifacts and metadata, keyed by file path, mtime, size and
+      artifact UUID (a changed file gets a new key),
+    - deserialized views (DataFrame, OrdinationResults, biom.Table), and
+    - intermediate results (e.g. rarefied and collapsed tables of a
+      triplot; see triplot.collapse_taxa).
+Entries are evicted, least recently used first, when the estimated memory
+use exceeds the cache's budget.
+"""
+import os
+import sys
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import biom
+
+from scripts.qiime2_helper.artifact_cache import artifact_uuid
+from scripts.qiime2_helper.artifact_helper import check_artifact_type
+from scripts.qiime2_helper.metadata_helper import (
+    load_metadata,
+    load_env_metadata
+)
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of the shared cache
+MAX_BYTES = 1024 * 1024 * 1024
+
+def estimate_size(value, depth=2):
+    """
+    Approximate memory use of a cached value in bytes.
+    """
+    if(isinstance(value, pd.DataFrame)):
+        return int(value.memory_usage(deep=True).sum())
+    if(isinstance(value, pd.Series)):
+        return int(value.memory_usage(deep=True))
+    if(isinstance(value, np.ndarray)):
+        return value.nbytes
+    if(isinstance(value, biom.Table)):
+        matrix = value.matrix_data
+        ids = value.ids(axis='observation').nbytes + value.ids(axis='sample').nbytes
+
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + ids
+    if(depth > 0 and isinstance(value, (tuple, list))):
+        return sum(estimate_size(item, depth - 1) for item in value)
+    # e.g. skbio OrdinationResults
+    if(depth > 0 and hasattr(value, '__dict__')):
+        return sum(estimate_size(item, depth - 1) for item in vars(value).values())
+
+    return sys.getsizeof(value)
+
+def file_key(path):
+    """
+    Identity of an input file; changes when the file is replaced or
+    modified.
+    """
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+
+    return (abs_path, stat.st_mtime_ns, stat.st_size, artifact_uuid(abs_path))
+
+class SessionCache(object):
+    """
+    Least recently used cache with a memory budget.
+
+    Input:
+        - max_bytes: memory budget (estimated with estimate_size)
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+
+        # key -> (value, size)
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, size=None):
+        """
+        Cached value of key; compute() is called (outside the lock) and its
+        result stored if the key is not cached.
+
+        Input:
+            - key: hashable key
+            - compute: function returning the value
+            - size: memory use of the value; estimated if None
+        """
+        with self._lock:
+            if(key in self._entries):
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        value = compute()
+        value_size = estimate_size(value) if size is None else size
+
+        # Not worth evicting everything else for
+        if(value_size > self.max_bytes):
+            logger.info("Not caching {}; larger than the cache budget".format(key[0]))
+            return value
+
+        with self._lock:
+            if(key in self._entries):
+                self._total_bytes = self._total_bytes - self._entries[key][1]
+            self._entries[key] = (value, value_size)
+            self._entries.move_to_end(key)
+            self._total_bytes = self._total_bytes + value_size
+
+            while(self._total_bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes = self._total_bytes - evicted_size
+
+        return value
+
+    def total_bytes(self):
+        return self._total_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+# Shared by the requests of this process
+shared_cache = SessionCache()
+
+def load_artifact(artifact_path, artifact_type, cache=shared_cache):
+    """
+    check_artifact_type(), cached. The artifact's data stays in its
+    extracted archive on disk, so it counts as the size of the .qza.
+    """
+    key = ("artifact", artifact_type) + file_key(artifact_path)
+
+    return cache.get(key,
+        lambda: check_artifact_type(artifact_path, artifact_type),
+        size=os.path.getsize(artifact_path))
+
+def artifact_view(artifact_path, artifact_type, view_type, cache=shared_cache):
+    """
+    Artifact viewed as view_type (e.g. pd.DataFrame), cached. The view is
+    shared between callers; do not modify it.
+    """
+    key = ("view", artifact_type, view_type.__module__ + "." + view_type.__name__) + file_key(artifact_path)
+
+    return cache.get(key,
+        lambda: load_artifact(artifact_path, artifact_type, cache).view(view_type))
+
+def cached_metadata(metadata_path, cache=shared_cache):
+    """
+    load_metadata(), cached. Returns a copy; callers may modify it.
+    """
+    key = ("metadata",) + file_key(metadata_path)
+
+    return cache.get(key, lambda: load_metadata(metadata_path)).copy()
+
+def cached_env_metadata(env_metadata_path, cache=shared_cache):
+    """
+    load_env_metadata(), cached. Returns a copy; callers may modify it.
+    """
+    key = ("env_metadata",) + file_key(env_metadata_path)
+
+    return cache.get(key, lambda: load_env_metadata(env_metadata_path)).copy()
@@ -0,0 +1,207 @@
+"""
+Sparse feature table operations.
+
+Feature tables are kept as biom tables (scipy sparse matrix, features as
+observations and samples as columns). Sums, percent abundance, filtering
+and collapsing work on the sparse matrix directly; dense pandas dataframes
+are only created when the result is written or plotted.
+"""
+import numpy as np
+import pandas as pd
+import biom
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.artifact_helper import check_artifact_type
+from scripts.qiime2_helper.taxa_collapse import indicator_matrix
+from scripts.qiime2_helper.rarefaction import subsample
+from scripts.qiime2_helper.abundance import (
+    COLUMN_AXIS,
+    ROW_AXIS,
+    sparse_proportions
+)
+
+# biom axis names
+SAMPLE_AXIS = "sample"
+FEATURE_AXIS = "observation"
+
+def load_feature_table(feature_table_artifact_path):
+    """
+    Load FeatureTable[Frequency] artifact as biom table.
+    """
+    artifact = check_artifact_type(feature_table_artifact_path, "feature_table")
+
+    return artifact.view(biom.Table)
+
+def sample_totals(table):
+    """
+    Total count of each sample.
+
+    Returns:
+        - pd.Series indexed by sample ID
+    """
+    return pd.Series(table.sum(axis=SAMPLE_AXIS), index=table.ids(axis=SAMPLE_AXIS))
+
+def feature_totals(table):
+    """
+    Total count of each feature across all samples.
+
+    Returns:
+        - pd.Series indexed by feature ID
+    """
+    return pd.Series(table.sum(axis=FEATURE_AXIS), index=table.ids(axis=FEATURE_AXIS))
+
+def rarefy(table, sampling_depth, seed=None):
+    """
+    Subsample each sample to sampling_depth counts without replacement, as
+    'qiime feature-table rarefy'.
+
+    Samples with fewer counts than sampling_depth, and features left with
+    zero counts, are dropped.
+
+    Input:
+        - table: biom table of integer counts
+        - sampling_depth: number of counts to keep per sample
+        - seed: random seed; the same seed gives the same table
+
+    Returns:
+        - biom table
+    """
+    if(sampling_depth <= 0):
+        raise AXIOME3Error("Sampling depth must be a positive number!")
+
+    totals = sample_totals(table)
+    sample_ids = totals.index[totals >= sampling_depth]
+    if(len(sample_ids) == 0):
+        raise AXIOME3Error("No samples or features left after rarefying at {}".format(sampling_depth))
+
+    kept = table.filter(set(sample_ids), axis=SAMPLE_AXIS, inplace=False)
+    # Samples are columns
+    matrix = kept.matrix_data.tocsc(copy=True)
+    rng = np.random.default_rng(seed)
+
+    for j in range(matrix.shape[1]):
+        start, end = matrix.indptr[j], matrix.indptr[j+1]
+        matrix.data[start:end] = subsample(matrix.data[start:end], sampling_depth, rng)
+
+    matrix.eliminate_zeros()
+    rarefied = biom.Table(matrix, observation_ids=kept.ids(axis=FEATURE_AXIS),
+            sample_ids=kept.ids(axis=SAMPLE_AXIS))
+
+    nonzero = feature_totals(rarefied) > 0
+    if not(nonzero.any()):
+        raise AXIOME3Error("No samples or features left after rarefying at {}".format(sampling_depth))
+
+    return rarefied.filter(set(nonzero.index[nonzero]), axis=FEATURE_AXIS, inplace=False)
+
+def percent_abundance(table, axis=SAMPLE_AXIS):
+    """
+    Relative abundance of each entry (value / sample (feature) sum).
+
+    Samples (or features) with zero total stay at zero.
+
+    Input:
+        - table: biom table
+        - axis: 'sample' to normalize each sample, 'observation' to normalize
+            each feature
+
+    Returns:
+        - biom table of proportions (0 to 1)
+    """
+    # Samples are columns, features are rows
+    if(axis == SAMPLE_AXIS):
+        scaled = sparse_proportions(table.matrix_data, COLUMN_AXIS)
+    elif(axis == FEATURE_AXIS):
+        scaled = sparse_proportions(table.matrix_data, ROW_AXIS)
+    else:
+        raise AXIOME3Error("Unknown axis '{}'".format(axis))
+
+    return biom.Table(scaled,
+            observation_ids=table.ids(axis=FEATURE_AXIS),
+            sample_ids=table.ids(axis=SAMPLE_AXIS))
+
+def abundant_features(table, abundance_threshold):
+    """
+    Features with % abundance >= threshold in at least one sample.
+
+    Input:
+        - table: biom table
+        - abundance_threshold: % value threshold (0: 0% cutoff, 1: 100% cutoff)
+
+    Returns:
+        - boolean numpy array, one value per feature (in table order)
+    """
+    if(abundance_threshold <= 0):
+        return np.ones(len(table.ids(axis=FEATURE_AXIS)), dtype=bool)
+
+    # Column (sample) proportions; rows are features
+    percent = sparse_proportions(table.matrix_data, COLUMN_AXIS)
+    max_percent = np.asarray(percent.max(axis=1).todense()).ravel()
+
+    return max_percent >= abundance_threshold
+
+def filter_by_abundance(table, abundance_threshold=0.1):
+    """
+    Keep features if at least one of the samples has % abundance >= threshold.
+
+    Same as artifact_helper.filter_by_abundance, on a biom table.
+
+    Input:
+        - table: biom table
+        - abundance_threshold: % value threshold (0: 0% cutoff, 1: 100% cutoff)
+    """
+    to_keep = abundant_features(table, abundance_threshold)
+
+    # Raise error if no entries after filtering
+    if(to_keep.any() == False):
+        raise AXIOME3Error("Zero entries after filtering by abundance at {} threshold".format(abundance_threshold))
+
+    ids_to_keep = set(table.ids(axis=FEATURE_AXIS)[to_keep])
+
+    return table.filter(ids_to_keep, axis=FEATURE_AXIS, inplace=False)
+
+def collapse(table, labels):
+    """
+    Sum features that share the same label.
+
+    Input:
+        - table: biom table
+        - labels: dictionary (or pd.Series) mapping feature ID to label
+
+    Returns:
+        - biom table with labels as observation IDs, ordered by first
+            appearance
+    """
+    feature_ids = table.ids(axis=FEATURE_AXIS)
+    missing = [f for f in feature_ids if f not in labels]
+    if(len(missing) > 0):
+        raise AXIOME3Error("No label for {} features: {}".format(len(missing), missing[:5]))
+
+    indicator, groups = indicator_matrix([labels[f] for f in feature_ids])
+    collapsed = (indicator.T @ table.matrix_data.tocsr()).tocsr()
+
+    return biom.Table(collapsed, observation_ids=groups,
+            sample_ids=table.ids(axis=SAMPLE_AXIS))
+
+def to_dataframe(table, samples_as_rows=True):
+    """
+    Dense dataframe for output.
+
+    Input:
+        - table: biom table
+        - samples_as_rows: True gives the same layout as viewing a
+            FeatureTable artifact as pd.DataFrame (samples as rows,
+            features as columns); False gives features as rows.
+    """
+    matrix = table.matrix_data
+
+    if(samples_as_rows):
+        df = pd.DataFrame(matrix.T.toarray(),
+                index=table.ids(axis=SAMPLE_AXIS),
+                columns=table.ids(axis=FEATURE_AXIS))
+    else:
+        df = pd.DataFrame(matrix.toarray(),
+                index=table.ids(axis=FEATURE_AXIS),
+                columns=table.ids(axis=SAMPLE_AXIS))
+
+    return df.astype(float)
@@ -8,6 +8,7 @@ import sys
 import os
 import time
 import logging
+import hashlib
 import argparse
 
 import pandas as pd
@@ -43,6 +44,41 @@ def split_manifest(manifest_path, output_dir):
         if(single_run_table.shape[0] != 0):
             pd.DataFrame.to_csv(single_run_table, output_filepath, index = False)
 
+def get_run_manifest(manifest_df, run_ID):
+    """
+    Rows of a single run, without the run_ID column.
+
+    Input:
+        - manifest_df: manifest file as pandas dataframe
+        - run_ID: run to select
+    """
+    if ('run_ID' not in manifest_df.columns):
+        raise AXIOME3Error("'run_ID' column must exist in the manifes file!")
+
+    single_run_table = manifest_df[manifest_df['run_ID'].astype(str) == str(run_ID)]
+    if(single_run_table.shape[0] == 0):
+        raise AXIOME3Error("Run '{}' is not in the manifest file".format(run_ID))
+
+    return single_run_table.drop(['run_ID'], axis=1)
+
+def run_manifest_checksum(manifest_path, run_ID):
+    """
+    Checksum of the manifest rows of a single run; changes only if the rows
+    of that run change.
+    """
+    manifest_df = pd.read_csv(manifest_path)
+    run_csv = get_run_manifest(manifest_df, run_ID).to_csv(index=False)
+
+    return hashlib.sha256(run_csv.encode('utf-8')).hexdigest()
+
+def write_run_manifest(manifest_path, run_ID, output_path):
+    """
+    Write manifest file of a single run.
+    """
+    manifest_df = pd.read_csv(manifest_path)
+    single_run_table = get_run_manifest(manifest_df, run_ID)
+
+    pd.DataFrame.to_csv(single_run_table, output_path, index = False)
 
 def main(args):
     # Set user variables
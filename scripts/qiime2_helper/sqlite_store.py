@@ -0,0 +1,88 @@
+"""
+Persistent key-value tables in SQLite, shared between pipeline runs.
+
+A table maps (scope, key) to one or more text values; the scope is e.g.
+the classifier or reference database the values were computed with.
+"""
+import os
+import sqlite3
+
+# Maximum number of parameters in a single SQLite query
+QUERY_CHUNK_SIZE = 500
+
+class SQLiteStore(object):
+    """
+    SQLite table of (scope, key) -> values.
+
+    Input:
+        - db_path: path to SQLite database (created if missing)
+        - table: table name
+        - key_columns: (scope column, key column) names
+        - value_columns: value column names
+    """
+    def __init__(self, db_path, table, key_columns, value_columns):
+        parent = os.path.dirname(db_path)
+        if(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        self.table = table
+        self.scope_column, self.key_column = key_columns
+        self.value_columns = tuple(value_columns)
+
+        columns = [self.scope_column, self.key_column] + list(self.value_columns)
+
+        # Shared between concurrent pipelines; wait for locks instead of failing
+        self.connection = sqlite3.connect(db_path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS {table} ({columns}, "
+            "PRIMARY KEY ({scope}, {key}))".format(
+                table=table,
+                columns=", ".join(column + " TEXT NOT NULL" for column in columns),
+                scope=self.scope_column,
+                key=self.key_column))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, scope, keys):
+        """
+        Stored values of the keys.
+
+        Returns:
+            - dictionary of key to tuple of values; unseen keys are left out
+        """
+        keys = list(keys)
+        found = {}
+
+        for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+            chunk = keys[i:i+QUERY_CHUNK_SIZE]
+            query = ("SELECT {key}, {values} FROM {table} "
+                    "WHERE {scope} = ? AND {key} IN ({params})".format(
+                        key=self.key_column,
+                        values=", ".join(self.value_columns),
+                        table=self.table,
+                        scope=self.scope_column,
+                        params=",".join("?" * len(chunk))))
+
+            for row in self.connection.execute(query, [scope] + chunk):
+                found[row[0]] = tuple(row[1:])
+
+        return found
+
+    def store(self, scope, values):
+        """
+        Add (or replace) values.
+
+        Input:
+            - scope: scope of the keys
+            - values: dictionary of key to tuple of values
+        """
+        rows = [(scope, key) + tuple(key_values) for key, key_values in values.items()]
+        statement = "INSERT OR REPLACE INTO {table} VALUES ({params})".format(
+                table=self.table,
+                params=", ".join("?" * (2 + len(self.value_columns))))
+
+        with self.connection:
+            self.connection.executemany(statement, rows)
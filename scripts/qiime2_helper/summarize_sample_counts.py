@@ -8,29 +8,38 @@
 # Imports
 import sys
 import os
+import json
 import time
 import logging
 import argparse
 
 import pandas as pd
+import biom
 # To import QIIME2 Artifacts into Python
 from qiime2 import Artifact
 
+from scripts.qiime2_helper.artifact_cache import artifact_uuid
+from scripts.qiime2_helper.sparse_table import sample_totals
+
 # GLOBAL variables
 SCRIPT_VERSION = '0.8.1'
+# Sample totals are cached next to the feature table artifact
+TOTALS_SUFFIX = '.sample_totals.json'
 
 # Set up the logger
 logging.basicConfig(format="[ %(asctime)s UTC ]: %(levelname)s: %(message)s")
 logging.Formatter.converter = time.gmtime
 logger = logging.getLogger(__name__)
 
-def load_qiime2_artifact(feature_table):
+def load_qiime2_artifact(feature_table, sparse=False):
     """
     Load the output of QIIME2 DADA2 (QIIME2 feature table artifact) into Python
 
     ** Will throw errors if the artifact type is NOT FeatureTable[Frequency] **
     You may check Artifact type by checking the "type" property of the Artifact
     object after loading the artifact via 'Artifact.load(artifact)'
+
+    Returns biom table instead of pandas dataframe if sparse is True.
     """
     # Make sure input actually exists
     if not(os.path.isfile(feature_table)):
@@ -46,6 +55,9 @@ def load_qiime2_artifact(feature_table):
             msg = "Input QIIME2 Artifact is not of the type 'FeatureTable[Frequency]'!"
             raise ValueError(msg)
 
+        if(sparse):
+            return feature_table_artifact.view(biom.Table)
+
         feature_table_df = feature_table_artifact.view(pd.DataFrame)
 
         return feature_table_df
@@ -56,14 +68,92 @@ def load_qiime2_artifact(feature_table):
         logger.error(err)
         raise
 
+def totals_sidecar_path(feature_table):
+    return feature_table + TOTALS_SUFFIX
+
+def read_totals_sidecar(feature_table, uuid):
+    """
+    Sample totals cached next to the feature table, or None if there are
+    none for this artifact (by UUID).
+    """
+    try:
+        with open(totals_sidecar_path(feature_table)) as fh:
+            sidecar = json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+    if(sidecar.get('uuid') != uuid):
+        return None
+
+    totals = pd.Series(sidecar['totals'], dtype=float)
+    totals.index = totals.index.astype(str)
+
+    return totals
+
+def write_totals_sidecar(feature_table, uuid, totals):
+    path = totals_sidecar_path(feature_table)
+    sidecar = {
+        'uuid': uuid,
+        'totals': {str(sample): float(count) for sample, count in totals.items()}
+    }
+
+    # Written to a temporary file first so readers never see a partial file
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp_path, 'w') as fh:
+            json.dump(sidecar, fh)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        logger.warning("Cannot cache sample totals to {f}: {err}".format(
+                f=path, err=err))
+        if(os.path.exists(tmp_path)):
+            os.remove(tmp_path)
+
+def cached_sample_totals(feature_table):
+    """
+    Total count of each sample of a feature table artifact.
+
+    Totals are summed from the sparse table once, and cached in a small
+    JSON file next to the artifact (TOTALS_SUFFIX). The cache belongs to
+    the artifact's UUID; a replaced artifact is summed again.
+
+    Input:
+        - feature_table: path to feature table QIIME2 artifact.
+
+    Returns:
+        - pd.Series indexed by sample ID
+    """
+    uuid = artifact_uuid(feature_table)
+    if(uuid is not None):
+        totals = read_totals_sidecar(feature_table, uuid)
+        if(totals is not None):
+            return totals
+
+    totals = sample_totals(load_qiime2_artifact(feature_table, sparse=True))
+
+    if(uuid is not None):
+        write_totals_sidecar(feature_table, uuid, totals)
+
+    return totals
+
 def generate_sample_count(feature_table_df):
     """
     Generate sample counts given feature table dataframe.
     It sums up counts from each "feature"
+
+    If biom table or sample totals (pd.Series) are given, only the 'Count'
+    column is returned; the table is summed without densifying it.
     """
-    # By default, feature table dataframe stores samples as rows, and features
-    # as columns.
-    feature_table_df['Count'] = feature_table_df.sum(axis=1)
+    if(isinstance(feature_table_df, pd.Series)):
+        feature_table_df = pd.DataFrame({'Count': feature_table_df})
+    elif(isinstance(feature_table_df, biom.Table)):
+        feature_table_df = pd.DataFrame(
+                {'Count': feature_table_df.sum(axis='sample')},
+                index=feature_table_df.ids(axis='sample'))
+    else:
+        # By default, feature table dataframe stores samples as rows, and
+        # features as columns.
+        feature_table_df['Count'] = feature_table_df.sum(axis=1)
 
     # Sort 'Count' column in ascending order
     feature_table_df = feature_table_df.sort_values(by=['Count'])
@@ -142,11 +232,11 @@ def get_sample_count(feature_table_filepath, tsv_output_path, json_output_path):
     """
     logger.info("Running summarize_sample_counts.py")
 
-    # Load feature table as pandas dataframe
-    feature_table_df = load_qiime2_artifact(feature_table_filepath)
+    # Sample totals (summed once per artifact)
+    totals = cached_sample_totals(feature_table_filepath)
 
     # Generate sample counts
-    sample_count_df = generate_sample_count(feature_table_df)
+    sample_count_df = generate_sample_count(totals)
 
     # Write output
     write_output(sample_count_df, tsv_output_path)
@@ -177,8 +267,8 @@ def main(args):
     logger.info("Min count filepath: " + str(min_count_filepath))
     logger.info("Verbose logging: " + str(verbose))
 
-    # Load feature table as pandas dataframe
-    feature_table_df = load_qiime2_artifact(input_filepath)
+    # Load feature table as biom table
+    feature_table_df = load_qiime2_artifact(input_filepath, sparse=True)
 
     # Generate sample counts
     sample_count_df = generate_sample_count(feature_table_df)
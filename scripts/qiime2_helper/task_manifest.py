@@ -0,0 +1,103 @@
+"""
+Manifests recording what produced the outputs of a pipeline task.
+
+A task is fingerprinted by
+    - the task name,
+    - the parameters (and configuration values) that affect its outputs,
+    - fingerprints of input files that are not produced by another task
+      (e.g. metadata file, classifier) and
+    - the fingerprints of the tasks it requires.
+When the task succeeds, its fingerprint is written to a manifest next to
+its outputs. The outputs are up to date only if the manifest matches the
+current fingerprint, so changing a parameter invalidates the task using it
+and every task downstream of it, while upstream outputs are kept.
+"""
+import os
+import json
+import time
+import hashlib
+
+from scripts.qiime2_helper.artifact_cache import file_fingerprint
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+def manifest_path(output_path):
+    """
+    Manifest location for an output; a hidden file in the same directory.
+    """
+    directory, name = os.path.split(output_path)
+
+    return os.path.join(directory, "." + name + MANIFEST_SUFFIX)
+
+def input_file_fingerprint(path):
+    """
+    Fingerprint of an input file; unset or missing files are identified by
+    their path.
+    """
+    if(path and os.path.exists(path)):
+        return file_fingerprint(path)
+
+    return "missing:" + str(path)
+
+def describe(step, params, files, upstream):
+    """
+    Description of a task execution.
+
+    Input:
+        - step: step (task) name
+        - params: dictionary of parameters affecting the outputs
+        - files: dictionary of input file paths not produced by another task
+        - upstream: list of fingerprints of the required tasks
+    """
+    return {
+        "step": step,
+        "params": {str(k): str(v) for k, v in params.items()},
+        "files": {str(k): input_file_fingerprint(v) for k, v in files.items()},
+        "upstream": sorted(upstream)
+    }
+
+def compute_fingerprint(description):
+    encoded = json.dumps(description, sort_keys=True).encode('utf-8')
+
+    return hashlib.sha256(encoded).hexdigest()
+
+def read_fingerprint(path):
+    """
+    Fingerprint stored in a manifest; None if there is no readable manifest.
+    """
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh).get("fingerprint")
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(path, fingerprint, description, output_paths):
+    """
+    Write manifest atomically so that an interrupted write never leaves a
+    valid-looking manifest behind.
+    """
+    manifest = {
+        "fingerprint": fingerprint,
+        "created": time.time(),
+        "outputs": sorted(output_paths),
+        "description": description
+    }
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def is_up_to_date(output_paths, path, fingerprint):
+    """
+    Checks that all outputs exist and were produced with the fingerprint.
+
+    Input:
+        - output_paths: list of output paths
+        - path: manifest path
+        - fingerprint: current fingerprint of the task
+    """
+    if not(all(os.path.exists(p) for p in output_paths)):
+        return False
+
+    return read_fingerprint(path) == fingerprint
@@ -0,0 +1,161 @@
+"""
+Collapse a feature table to every taxonomic level in a single pass.
+
+Equivalent to running 'qiime taxa collapse' once per level, but the feature
+table and taxonomy are loaded once. Each level is computed from the level
+below it with a sparse taxon indicator matrix, so the table is never
+densified.
+"""
+import numpy as np
+import pandas as pd
+import biom
+from scipy import sparse
+
+from qiime2 import Artifact
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.artifact_helper import (
+    VALID_COLLAPSE_LEVELS,
+    check_artifact_type
+)
+
+# Taxonomic levels written by Taxa_Collapse (1=domain, 7=species)
+TAXA_LEVELS = ["domain", "phylum", "class", "order", "family", "genus",
+        "species"]
+
+# Filler used by q2-taxa for missing levels
+PAD_LABEL = "__"
+
+def split_lineages(taxonomy):
+    """
+    Split lineages into levels, padding short lineages like q2-taxa does.
+
+    Input:
+        - taxonomy: pandas series; taxonomy strings indexed by feature ID
+
+    Returns:
+        - list of lineages (list of levels) in the order of the series
+        - maximum number of levels in the taxonomy
+    """
+    split = [[level.strip() for level in str(lineage).split(';')]
+            for lineage in taxonomy]
+    max_level = max([len(lineage) for lineage in split]) if split else 0
+
+    padded = [lineage + [PAD_LABEL] * (max_level - len(lineage))
+            for lineage in split]
+
+    return padded, max_level
+
+def indicator_matrix(labels):
+    """
+    Sparse indicator matrix mapping each label to its unique group.
+
+    Groups are ordered by first appearance, which is the order biom uses
+    when collapsing.
+
+    Input:
+        - labels: list of group labels
+
+    Returns:
+        - scipy CSR matrix (n labels x n groups)
+        - list of unique group labels
+    """
+    codes, groups = pd.factorize(pd.Series(labels, dtype=object), sort=False)
+    n_labels = len(labels)
+
+    indicator = sparse.csr_matrix(
+            (np.ones(n_labels), (np.arange(n_labels), codes)),
+            shape=(n_labels, len(groups)))
+
+    return indicator, list(groups)
+
+def collapse_table_all_levels(table, taxonomy, levels=TAXA_LEVELS):
+    """
+    Collapse feature table to multiple taxonomic levels.
+
+    Input:
+        - table: biom table; features as observations
+        - taxonomy: pandas series; taxonomy strings indexed by feature ID
+        - levels: taxonomic level names (keys of VALID_COLLAPSE_LEVELS)
+
+    Returns:
+        - dictionary of biom tables keyed by level name
+    """
+    feature_ids = table.ids(axis='observation')
+    missing = set(feature_ids).difference(taxonomy.index)
+    if(len(missing) > 0):
+        raise AXIOME3Error("Feature IDs found in the table are missing in the taxonomy: {}".format(missing))
+
+    # Maximum level is determined from the whole taxonomy, as in q2-taxa
+    _, max_level = split_lineages(taxonomy)
+    lineages, _ = split_lineages(taxonomy.reindex(feature_ids))
+
+    level_numbers = {}
+    for level in levels:
+        if(level not in VALID_COLLAPSE_LEVELS or VALID_COLLAPSE_LEVELS[level] > max_level):
+            raise AXIOME3Error("Cannot collapse taxonomy to '{level}' (maximum level: {max_level})".format(
+                level=level,
+                max_level=max_level))
+        level_numbers[level] = VALID_COLLAPSE_LEVELS[level]
+
+    # features x samples
+    counts = table.matrix_data.tocsr()
+    sample_ids = table.ids(axis='sample')
+
+    # Work from the deepest level up; each level collapses the one below it
+    collapsed = {}
+    members = lineages
+    for level in sorted(level_numbers, key=level_numbers.get, reverse=True):
+        n = level_numbers[level]
+        labels = [';'.join(lineage[:n]) for lineage in members]
+        indicator, taxa = indicator_matrix(labels)
+
+        counts = (indicator.T @ counts).tocsr()
+        members = [taxon.split(';') for taxon in taxa]
+
+        collapsed[level] = biom.Table(counts, observation_ids=taxa,
+                sample_ids=sample_ids)
+
+    return collapsed
+
+def collapsed_table_to_df(table):
+    """
+    Dense dataframe with samples as rows and taxa as columns, as given by
+    viewing the collapsed artifact as pd.DataFrame.
+    """
+    df = table.to_dataframe(dense=True).T.astype(float)
+    df.index.name = None
+    df.columns.name = None
+
+    return df
+
+def collapse_taxa_all_levels(feature_table_artifact_path, taxonomy_artifact_path,
+        output_paths):
+    """
+    Collapse feature table artifact to each taxonomic level and save the
+    collapsed tables as both QIIME2 artifact and tsv.
+
+    Input:
+        - feature_table_artifact_path: path to FeatureTable[Frequency] artifact
+        - taxonomy_artifact_path: path to FeatureData[Taxonomy] artifact
+        - output_paths: dictionary of {"qza": path, "tsv": path} keyed by
+            level name
+    """
+    table_artifact = check_artifact_type(feature_table_artifact_path, "feature_table")
+    taxonomy_artifact = check_artifact_type(taxonomy_artifact_path, "taxonomy")
+
+    table = table_artifact.view(biom.Table)
+    taxonomy = taxonomy_artifact.view(pd.DataFrame)["Taxon"]
+
+    collapsed = collapse_table_all_levels(table, taxonomy, list(output_paths))
+
+    for level, paths in output_paths.items():
+        collapsed_table = collapsed[level]
+
+        collapsed_artifact = Artifact.import_data("FeatureTable[Frequency]",
+                collapsed_table)
+        collapsed_artifact.save(paths["qza"])
+
+        collapsed_df = collapsed_table_to_df(collapsed_table)
+        collapsed_df.to_csv(paths["tsv"], sep="\t", index_label="SampleID")
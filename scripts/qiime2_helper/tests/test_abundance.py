@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from scripts.qiime2_helper.abundance import (
+    proportions,
+    series_proportions
+)
+
+
+def apply_percent_value(df, axis=0):
+    # Previous DataFrame.apply implementation
+    def percent_value_operation(x):
+        series_sum = x.sum()
+        return x / series_sum if series_sum != 0 else x * 0.0
+
+    return df.apply(percent_value_operation, axis=axis)
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'Sample1': [1, 2, 3, 4],
+        'Sample2': [0, 0, 0, 0],
+        'Sample3': [1, 9, 10, 80]
+    }, index=['f1', 'f2', 'f3', 'f4'])
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+def test_dataframe_matches_apply(df, axis):
+    observed = proportions(df, axis)
+
+    pd.testing.assert_frame_equal(observed, apply_percent_value(df.astype(float), axis))
+
+
+def test_zero_sum_column(df):
+    observed = proportions(df)
+
+    assert list(observed['Sample2']) == [0.0, 0.0, 0.0, 0.0]
+    assert list(observed['Sample1']) == [0.1, 0.2, 0.3, 0.4]
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+def test_sparse_matches_dense(df, axis):
+    observed = proportions(sparse.csc_matrix(df.values), axis)
+
+    assert sparse.issparse(observed)
+    np.testing.assert_array_equal(observed.toarray(), proportions(df.values, axis))
+
+
+def test_float32(df):
+    observed = proportions(df, dtype=np.float32)
+
+    assert (observed.dtypes == np.float32).all()
+    np.testing.assert_allclose(observed.values, proportions(df).values, rtol=1e-6)
+
+
+def test_series_proportions():
+    observed = series_proportions(pd.Series([0, 0], index=['a', 'b']))
+
+    pd.testing.assert_series_equal(observed, pd.Series([0.0, 0.0], index=['a', 'b']))
+
+
+def test_invalid_axis(df):
+    with pytest.raises(ValueError):
+        proportions(df, axis=2)
@@ -0,0 +1,82 @@
+import os
+import zipfile
+
+import pytest
+
+from scripts.qiime2_helper.artifact_cache import (
+    ArtifactCache,
+    artifact_uuid,
+    file_fingerprint,
+    cache_key
+)
+
+
+def make_artifact(path, uuid):
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr(uuid + '/metadata.yaml', 'uuid: ' + uuid)
+
+
+def write(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def test_artifact_uuid(tmp_path):
+    artifact = str(tmp_path / 'table.qza')
+    make_artifact(artifact, '1234-abcd')
+
+    assert artifact_uuid(artifact) == '1234-abcd'
+    assert file_fingerprint(artifact) == 'uuid:1234-abcd'
+
+
+def test_cache_key(tmp_path):
+    artifact = str(tmp_path / 'table.qza')
+    make_artifact(artifact, '1234-abcd')
+    copied = str(tmp_path / 'copy.qza')
+    make_artifact(copied, '1234-abcd')
+
+    key = cache_key('Denoise_Run', [artifact], {'trunc_len_f': '250'}, '2019.10')
+
+    # Same artifact under another path
+    assert key == cache_key('Denoise_Run', [copied], {'trunc_len_f': '250'}, '2019.10')
+    assert key != cache_key('Denoise_Run', [artifact], {'trunc_len_f': '240'}, '2019.10')
+    assert key != cache_key('Denoise_Run', [artifact], {'trunc_len_f': '250'}, '2020.2')
+
+
+def test_store_and_restore(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'), 10 ** 6)
+
+    out = tmp_path / 'run1'
+    out.mkdir()
+    write(str(out / 'table.qza'), 'table')
+    write(str(out / 'seqs.qza'), 'seqs')
+    outputs = {'table': str(out / 'table.qza'), 'rep_seqs': str(out / 'seqs.qza')}
+
+    cache.store('abcdef', outputs)
+
+    new_outputs = {
+        'table': str(tmp_path / 'run2' / 'table.qza'),
+        'rep_seqs': str(tmp_path / 'run2' / 'seqs.qza')
+    }
+    assert cache.restore('abcdef', new_outputs)
+    assert open(new_outputs['table']).read() == 'table'
+    assert open(new_outputs['rep_seqs']).read() == 'seqs'
+
+    assert not cache.restore('000000', new_outputs)
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'), 2500)
+
+    for i, key in enumerate(['aa1111', 'bb2222', 'cc3333']):
+        path = str(tmp_path / (key + '.qza'))
+        write(path, 'x' * 1000)
+        cache.store(key, {'table': path})
+        # Make usage order explicit
+        entry = os.path.join(cache.cache_dir, key[:2], key, 'entry.json')
+        os.utime(entry, (i, i))
+
+    cache.evict()
+
+    remaining = sorted(os.path.basename(entry_dir) for _, _, entry_dir in cache.entries())
+    assert remaining == ['bb2222', 'cc3333']
@@ -0,0 +1,67 @@
+import pandas as pd
+import pytest
+
+from scripts.qiime2_helper.classification_cache import (
+    ClassificationCache,
+    classify_sequences,
+    sequence_hash
+)
+
+
+def fake_classifier(calls):
+    def classify(batch):
+        calls.append(list(batch.index))
+        return pd.DataFrame({
+            "Taxon": ["k__Bacteria; " + seq for seq in batch],
+            "Confidence": ["0.99"] * len(batch)
+        }, index=batch.index)
+
+    return classify
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ClassificationCache(str(tmp_path / 'cache' / 'classification.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_store_and_lookup(cache):
+    cache.store('uuid:classifier', {'h1': ('k__Bacteria', '0.9')})
+
+    assert cache.lookup('uuid:classifier', ['h1', 'h2']) == {'h1': ('k__Bacteria', '0.9')}
+    # Same sequence, other classifier
+    assert cache.lookup('uuid:other', ['h1']) == {}
+
+
+def test_lookup_many(cache):
+    classifications = {str(i): ('t' + str(i), '1.0') for i in range(1200)}
+    cache.store('c', classifications)
+
+    assert cache.lookup('c', list(classifications)) == classifications
+
+
+def test_classify_only_unseen_sequences(cache):
+    calls = []
+    classify = fake_classifier(calls)
+    first = pd.Series(['ACGT', 'GGCC', 'TTAA'], index=['f1', 'f2', 'f3'])
+
+    taxonomy = classify_sequences(first, 'c', cache, classify, batch_size=2)
+
+    assert calls == [['f1', 'f2'], ['f3']]
+    assert list(taxonomy.index) == ['f1', 'f2', 'f3']
+    assert taxonomy.index.name == 'Feature ID'
+    assert list(taxonomy['Taxon']) == ['k__Bacteria; ACGT', 'k__Bacteria; GGCC', 'k__Bacteria; TTAA']
+
+    # Second project shares two sequences (under different feature IDs)
+    calls.clear()
+    second = pd.Series(['GGCC', 'CCCC', 'acgt', 'CCCC'], index=['a', 'b', 'c', 'd'])
+
+    taxonomy = classify_sequences(second, 'c', cache, classify, batch_size=2)
+
+    assert calls == [['b']]
+    assert list(taxonomy.index) == ['a', 'b', 'c', 'd']
+    assert list(taxonomy['Taxon']) == ['k__Bacteria; GGCC', 'k__Bacteria; CCCC',
+        'k__Bacteria; ACGT', 'k__Bacteria; CCCC']
+    assert cache.lookup('c', [sequence_hash('CCCC')]) == \
+        {sequence_hash('CCCC'): ('k__Bacteria; CCCC', '0.99')}
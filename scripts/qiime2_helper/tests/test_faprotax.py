@@ -0,0 +1,144 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.faprotax import (
+    _numeric_column,
+    _to_float,
+    LabelIndex,
+    LineageMemo,
+    assign_records_to_groups,
+    collapse_table,
+    compile_expression,
+    database_version,
+    find_word_matches,
+    load_groups,
+    read_groups,
+    shell_command
+)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data", "faprotax")
+FAPROTAX_DB = os.path.join(os.path.dirname(__file__), "..", "..", "..",
+        "FAPROTAX", "FAPROTAX.txt")
+
+# Time stamp in the expected reports (replaced after running collapse_table.py)
+REPORT_DATE = "2020.01.01 00:00:00"
+
+def read_bytes(path):
+    with open(path, "rb") as fh:
+        return fh.read()
+
+@pytest.mark.parametrize("case,table,groups", [
+    ("standard", "ASV_abundance_filtered.tsv", FAPROTAX_DB),
+    ("set_operations", "table.tsv", os.path.join(DATA_DIR, "set_operations", "groups.txt")),
+])
+def test_collapse_table_matches_collapse_table_py(case, table, groups, tmp_path, monkeypatch):
+    # Expected outputs were written by python2 FAPROTAX/collapse_table.py
+    # with the pipeline's options, run in a directory with the same files
+    case_dir = os.path.join(DATA_DIR, case)
+    shutil.copy(os.path.join(case_dir, table), str(tmp_path))
+    shutil.copy(groups, str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+
+    collapse_table(table, os.path.basename(groups), "functional_table.tsv",
+            "report.txt", date=REPORT_DATE)
+
+    for output in ["functional_table.tsv", "report.txt"]:
+        assert read_bytes(output) == read_bytes(os.path.join(case_dir, output))
+
+@pytest.fixture
+def non_ascii_digits():
+    # Python 3 float() parses these; python2 collapse_table.py does not
+    return ["\uff11\uff12", "\u0663", "1\u00a0", "\u0967.5"]
+
+def test_to_float_non_ascii_digits(non_ascii_digits):
+    assert _to_float(" 1.5e3 ") == 1500
+
+    for text in non_ascii_digits + ["1_000"]:
+        with pytest.raises(ValueError):
+            _to_float(text)
+
+def test_numeric_column_non_ascii_digits(non_ascii_digits):
+    values, non_numeric = _numeric_column(["2", "nan"] + non_ascii_digits)
+
+    assert values[0] == 2
+    assert np.isnan(values[1:]).all()
+    assert list(non_numeric) == [False, False] + [True] * len(non_ascii_digits)
+
+def test_find_word_matches():
+    labels = [
+        "bacteria;nitrosomonas;nitrosomonas europaea",
+        "bacteria;nitrosomonas-like",
+        "bacteria;pseudonitrosomonas",
+        "bacteria;nitrosomonas_x",
+    ]
+
+    assert find_word_matches("*nitrosomonas*", labels) == [0, 3]
+    assert find_word_matches("*bacteria*europaea*", labels) == [0]
+    assert find_word_matches("*europaea*bacteria*", labels) == []
+
+def test_label_index_matches_scan():
+    labels = [
+        "d_0__bacteria;d_5__nitrosomonas;d_6__nitrosomonas europaea",
+        "bacteria;nitrosomonas-like;europaea",
+        "bacteria; nitrosomonas europaea x",
+        "bacteria;nitro somonas",
+        "",
+        "bacteria;nitrosomonas\xe9europaea",
+    ]
+    index = LabelIndex(labels)
+
+    for expression in ["*nitrosomonas*", "*bacteria*europaea*", "*nitrosomonas europaea*",
+            "*d_5__nitrosomonas*", "*nitrosomonas-like*", "*", "*-like*", "*europaea*bacteria*"]:
+        words, tokens = compile_expression(expression)
+        assert index.match(words, tokens) == find_word_matches(expression, labels)
+
+def test_load_groups_cache(tmp_path):
+    groups = tmp_path / "groups.txt"
+    groups.write_text("first\n*A*\n\nsecond\nadd_group:first\n*B*\n")
+    cache_dir = tmp_path / "cache"
+
+    parsed = load_groups(str(groups), str(cache_dir))
+    assert len(os.listdir(str(cache_dir))) == 1
+
+    cached = load_groups(str(groups), str(cache_dir))
+    assert cached.names == parsed.names == ["first", "second"]
+    assert cached.members == [[0], [(0, 0), 1]]
+    assert cached.checksum == parsed.checksum
+
+    # Edited database gets a new entry
+    groups.write_text("first\n*C*\n")
+    assert load_groups(str(groups), str(cache_dir)).member_names == ["*C*"]
+    assert len(os.listdir(str(cache_dir))) == 2
+
+def test_assign_records_to_groups_memo(tmp_path):
+    groups_path = tmp_path / "groups.txt"
+    groups_path.write_text("first\n*A*\n\nsecond\nadd_group:first\n*B*\n\nthird\n*A*\nsubtract_group:second\n")
+    groups = load_groups(str(groups_path))
+    labels = ["x;A", "x;B", "X;a ", "y;C", "x;B"]
+    expected = [{0, 2}, {0, 1, 2, 4}, set()]
+
+    memo = LineageMemo(str(tmp_path / "memo.sqlite"))
+    assert assign_records_to_groups(groups, labels) == expected
+    assert assign_records_to_groups(groups, labels, memo) == expected
+
+    # Unique lineages are stored once, and taken from the memo afterwards
+    stored = memo.lookup(database_version(groups), ["x;a", "x;b", "y;c"])
+    assert stored == {"x;a": [0, 1], "x;b": [1], "y;c": []}
+    memo.store(database_version(groups), {"y;c": [2]})
+    assert assign_records_to_groups(groups, labels, memo) == [{0, 2}, {0, 1, 2, 4}, {3}]
+    memo.close()
+
+def test_read_groups_unknown_reference(tmp_path):
+    groups = tmp_path / "groups.txt"
+    groups.write_text("first\n*A*\n\nsecond\nadd_group:third\n")
+
+    with pytest.raises(AXIOME3Error):
+        read_groups(str(groups))
+
+def test_shell_command():
+    assert shell_command(["collapse_table.py", "-c", "#", "-d", "Consensus.Lineage", "-o", ""]) == \
+            "collapse_table.py -c '#' -d Consensus.Lineage -o ''"
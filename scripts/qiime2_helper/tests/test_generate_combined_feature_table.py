@@ -0,0 +1,60 @@
+from io import StringIO
+from textwrap import dedent
+
+import numpy as np
+import biom
+
+from scripts.qiime2_helper.generate_combined_feature_table import (
+    write_combined_table,
+    write_abundance_subset
+)
+from scripts.qiime2_helper.filter_by_abundance import (
+    read_table,
+    subset_df,
+    filter_by_abundance,
+    merge_df
+)
+
+
+def test_write_combined_table():
+    table = biom.Table(np.array([[1.0, 0.0], [0.0, 25.0], [3.0, 4.0]]),
+            observation_ids=['f1', 'f2', 'f3'],
+            sample_ids=['s1', 's2'])
+    taxonomy = {'f1': 'd__Bacteria; p__Firmicutes', 'f2': 'd__Archaea'}
+    rep_seqs = {'f1': 'ACGT', 'f3': 'GGCC'}
+
+    fh = StringIO()
+    write_combined_table(table, taxonomy, rep_seqs, fh)
+
+    expected = dedent("""\
+        rowID\tFeature ID\ts1\ts2\tConsensus.Lineage\tReprSequence
+        0\tf1\t1.0\t0.0\td__Bacteria; p__Firmicutes\tACGT
+        1\tf2\t0.0\t25.0\td__Archaea\t
+        2\tf3\t3.0\t4.0\t\tGGCC
+        """)
+
+    assert fh.getvalue() == expected
+
+def test_write_abundance_subset_matches_filter_script(tmp_path):
+    table = biom.Table(np.array([[1.0, 0.0], [0.0, 25.0], [3.0, 4.0], [200.0, 0.0]]),
+            observation_ids=['f1', 'f2', 'f3', 'f4'],
+            sample_ids=['s1', 's2'])
+    taxonomy = {'f1': 'd__Bacteria; p__Firmicutes', 'f2': 'd__Archaea'}
+    rep_seqs = {'f1': 'ACGT', 'f3': 'GGCC'}
+
+    # Previous path: combined table, then filter_by_abundance.py
+    combined = tmp_path / "combined.tsv"
+    with open(combined, 'w', newline='') as fh:
+        write_combined_table(table, taxonomy, rep_seqs, fh)
+
+    asv_df = read_table(combined)
+    dropped, asv_subset = subset_df(asv_df, ["Feature ID", "Consensus.Lineage", "ReprSequence"])
+    filtered = filter_by_abundance(asv_subset, 0.1)
+    expected = merge_df(dropped, filtered, ["Feature ID"]).to_csv(sep="\t")
+
+    fh = StringIO()
+    write_abundance_subset(table, taxonomy, rep_seqs, 0.1, fh)
+
+    assert fh.getvalue() == expected
+    # f1 (0.5% in s1) is dropped; rowIDs refer to the full table
+    assert [line.split("\t")[0] for line in fh.getvalue().splitlines()] == ['rowID', '1', '2', '3']
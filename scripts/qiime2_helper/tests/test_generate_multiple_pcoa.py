@@ -0,0 +1,36 @@
+import os
+import json
+
+import pandas as pd
+
+from scripts.qiime2_helper.generate_multiple_pcoa import (
+    pcoa_plot_specs,
+    save_as_json
+)
+
+def test_pcoa_plot_specs():
+    metadata_df = pd.DataFrame({"Site": ["a", "b"], "Depth": [1, 2]},
+            index=pd.Index(["S1", "S2"], name="SampleID"))
+
+    specs = pcoa_plot_specs("pcoa", metadata_df, "plots.pdf", "images")
+
+    # One plot per column, saved as a pdf page and as an image; the loaded
+    # metadata is used as is
+    assert [spec.kwargs["colouring_variable"] for spec in specs] == ["Site", "Depth"]
+    assert all(spec.kwargs["metadata"] is metadata_df for spec in specs)
+    assert [spec.images for spec in specs] == [
+        [(os.path.join("images", "Site.png"), "png")],
+        [(os.path.join("images", "Depth.png"), "png")],
+    ]
+    assert all(spec.pdf_path == "plots.pdf" for spec in specs)
+
+    assert all(spec.images == [] for spec in pcoa_plot_specs("pcoa", metadata_df, pdf_path="plots.pdf"))
+    assert all(spec.pdf_path is None for spec in pcoa_plot_specs("pcoa", metadata_df, image_dir="images"))
+
+def test_save_as_json_from_dataframe(tmp_path):
+    metadata_df = pd.DataFrame({"Site": ["a"], "Depth": [1]})
+    output = tmp_path / "pcoa_columns.json"
+
+    save_as_json(metadata_df, str(output))
+
+    assert json.loads(output.read_text()) == {"Site": "Site.png", "Depth": "Depth.png"}
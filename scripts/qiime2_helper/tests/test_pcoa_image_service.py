@@ -0,0 +1,159 @@
+import os
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pandas as pd
+import pytest
+
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper import metadata_helper
+from scripts.qiime2_helper import pcoa_image_service
+from scripts.qiime2_helper.pcoa_image_service import (
+    ImageCache,
+    PCoAImageService,
+    make_server
+)
+from scripts.qiime2_helper.pcoa_ordination import (
+    Ordination,
+    load_ordination,
+    save_ordination
+)
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    pcoa_dir = tmp_path / "pcoa_plots"
+    (pcoa_dir / "bray_curtis").mkdir(parents=True)
+    (pcoa_dir / "pcoa_columns.json").write_text(json.dumps({"Site": "Site.png", "Depth": "Depth.png"}))
+    samples = pd.DataFrame({"Axis 1": [0.1, -0.1], "Axis 2": [0.2, 0.0]},
+            index=pd.Index(["S1", "S2"], name="SampleID"))
+    save_ordination(Ordination(samples, pd.Series([0.6, 0.3])),
+            str(pcoa_dir / "bray_curtis" / "ordination.pickle"))
+    metadata = tmp_path / "metadata.tsv"
+    metadata.write_text("SampleID\tSite\tDepth\nS1\ta\t1\nS2\tb\t2\n")
+
+    renders = []
+    renders_metadata = []
+    loads = []
+
+    def fake_load_metadata(path):
+        loads.append(path)
+        return pd.read_csv(path, sep="\t", index_col=0)
+
+    def fake_render_spec(spec):
+        renders.append(spec.kwargs["colouring_variable"])
+        renders_metadata.append(spec.kwargs["metadata"])
+        for path, image_format in spec.images:
+            with open(path, "w") as fh:
+                fh.write("{}:{}".format(spec.kwargs["colouring_variable"], image_format))
+
+    monkeypatch.setattr(pcoa_image_service, "render_spec", fake_render_spec)
+    monkeypatch.setattr(metadata_helper, "load_metadata", fake_load_metadata)
+
+    image_service = PCoAImageService(str(pcoa_dir), str(metadata),
+            ImageCache(str(tmp_path / "cache"), 1024 ** 2))
+    image_service.renders = renders
+    image_service.renders_metadata = renders_metadata
+    image_service.loads = loads
+
+    return image_service
+
+def test_save_ordination(tmp_path):
+    samples = pd.DataFrame({"Axis 1": [0.5]}, index=["S1"])
+    path = str(tmp_path / "ordination.pickle")
+
+    save_ordination(Ordination(samples, pd.Series([0.7])), path)
+    ordination = load_ordination(path)
+
+    pd.testing.assert_frame_equal(ordination.samples, samples)
+    assert list(ordination.proportion_explained) == [0.7]
+
+def test_image_rendered_once(service):
+    path = service.image("bray_curtis", "Site")
+    assert open(path).read() == "Site:png"
+
+    assert service.image("bray_curtis", "Site") == path
+    assert service.renders == ["Site"]
+
+    with pytest.raises(AXIOME3Error):
+        service.image("bray_curtis", "Unknown")
+    with pytest.raises(AXIOME3Error):
+        service.image("jaccard", "Site")
+
+def test_image_rendered_from_updated_metadata(service):
+    first = service.image("bray_curtis", "Site")
+    service.image("bray_curtis", "Depth")
+    # Metadata loaded once for both images
+    assert len(service.loads) == 1
+
+    with open(service.metadata_path, "w") as fh:
+        fh.write("SampleID\tSite\tDepth\nS1\tc\t1\nS2\td\t2\n")
+
+    second = service.image("bray_curtis", "Site")
+    assert second != first
+    assert len(service.loads) == 2
+    assert list(service.renders_metadata[-1]["Site"]) == ["c", "d"]
+
+def test_image_cache_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path), 10)
+
+    for i, key in enumerate(["a", "b", "c"]):
+        src = tmp_path / ".tmp_{}".format(key)
+        src.write_text("12345")
+        path = cache.put(key, "png", str(src))
+        os.utime(path, (i, i))
+
+    assert cache.get("a", "png") is None
+    assert cache.get("b", "png") is not None
+    assert cache.get("c", "png") is not None
+
+def test_http_server(service):
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = "http://{}:{}/".format(*server.server_address)
+
+    try:
+        assert json.loads(urlopen(url + "pcoa_columns.json").read()) == service.columns()
+        assert urlopen(url + "bray_curtis/Depth.png").read() == b"Depth:png"
+
+        with pytest.raises(HTTPError) as err:
+            urlopen(url + "bray_curtis/Unknown.png")
+        assert err.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_http_server_image_evicted(service, monkeypatch):
+    render_image = service.image
+    evictions = {"left": 1}
+
+    def image_evicted_after_render(metric, column):
+        # Evicted by another request before it is sent
+        path = render_image(metric, column)
+        if(evictions["left"] > 0):
+            evictions["left"] -= 1
+            os.remove(path)
+        return path
+
+    monkeypatch.setattr(service, "image", image_evicted_after_render)
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = "http://{}:{}/".format(*server.server_address)
+
+    try:
+        # Rendered again
+        assert urlopen(url + "bray_curtis/Site.png").read() == b"Site:png"
+        assert service.renders == ["Site", "Site"]
+
+        evictions["left"] = 2
+        with pytest.raises(HTTPError) as err:
+            urlopen(url + "bray_curtis/Depth.png")
+        assert err.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
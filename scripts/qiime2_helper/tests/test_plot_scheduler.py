@@ -0,0 +1,82 @@
+import pytest
+
+from scripts.qiime2_helper import plot_scheduler
+from scripts.qiime2_helper.plot_scheduler import (
+    PlotSpec,
+    figure_size,
+    render_plots
+)
+
+class FakeFigure(object):
+    def __init__(self, name):
+        self.name = name
+        if(name == "unpicklable"):
+            self.callback = lambda: None
+
+    def savefig(self, path, format, bbox_inches):
+        with open(path, "w") as fh:
+            fh.write("{name}.{format}\n".format(name=self.name, format=format))
+
+class FakePlot(object):
+    def __init__(self, name):
+        self.name = name
+
+    def draw(self):
+        return FakeFigure(self.name)
+
+class FakePdfPages(object):
+    def __init__(self, path):
+        self.fh = open(path, "w")
+
+    def savefig(self, figure, bbox_inches):
+        self.fh.write("{}.pdf\n".format(figure.name))
+
+    def close(self):
+        self.fh.close()
+
+class FakePyplot(object):
+    @staticmethod
+    def close(figure):
+        pass
+
+def make_plot(name):
+    return FakePlot(name)
+
+@pytest.fixture
+def fake_matplotlib(monkeypatch):
+    monkeypatch.setattr(plot_scheduler, "plt", FakePyplot)
+    monkeypatch.setattr(plot_scheduler, "PdfPages", FakePdfPages)
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_render_plots(workers, tmp_path, fake_matplotlib):
+    names = ["a", "b", "c", "d", "e"]
+    specs = [
+        PlotSpec(make_plot, kwargs={"name": name},
+            images=[(str(tmp_path / (name + ".png")), "png")],
+            pdf_path=str(tmp_path / ("first.pdf" if i % 2 == 0 else "second.pdf")))
+        for i, name in enumerate(names)
+    ]
+
+    render_plots(specs, workers)
+
+    # Pages are in spec order, whichever process rendered them
+    assert (tmp_path / "first.pdf").read_text() == "a.pdf\nc.pdf\ne.pdf\n"
+    assert (tmp_path / "second.pdf").read_text() == "b.pdf\nd.pdf\n"
+    for name in names:
+        assert (tmp_path / (name + ".png")).read_text() == name + ".png\n"
+
+def test_render_plots_unpicklable_figure(tmp_path, fake_matplotlib):
+    # Drawn again by this process for its pdf page
+    specs = [PlotSpec(make_plot, kwargs={"name": name}, pdf_path=str(tmp_path / "plots.pdf"))
+            for name in ["a", "unpicklable", "b"]]
+
+    render_plots(specs, workers=2)
+
+    assert (tmp_path / "plots.pdf").read_text() == "a.pdf\nunpicklable.pdf\nb.pdf\n"
+
+def test_figure_size():
+    assert figure_size(254, 127, "mm") == (10, 5)
+    assert figure_size(4, 3, "in") == (4, 3)
+
+    with pytest.raises(ValueError):
+        figure_size(1, 1, "px")
@@ -0,0 +1,47 @@
+import pytest
+
+from scripts.qiime2_helper.q2_backend import (
+    parse_qiime_cmd,
+    is_supported
+)
+from exceptions.exception import AXIOME3Error
+
+
+def test_parse_qiime_cmd():
+    cmd = ['qiime', 'feature-table', 'merge',
+            '--i-tables', 'run1.qza',
+            '--i-tables', 'run2.qza',
+            '--p-overlap-method', 'sum',
+            '--p-no-verbose-flag',
+            '--m-metadata-file', 'metadata.tsv',
+            '--o-merged-table', 'merged.qza',
+            '--verbose']
+
+    parsed = parse_qiime_cmd(cmd)
+
+    assert parsed["plugin"] == 'feature-table'
+    assert parsed["action"] == 'merge'
+    assert parsed["inputs"] == {'tables': ['run1.qza', 'run2.qza']}
+    assert parsed["parameters"] == {'overlap-method': 'sum', 'no-verbose-flag': None}
+    assert parsed["metadata"] == {'metadata-file': 'metadata.tsv'}
+    assert parsed["outputs"] == {'merged-table': 'merged.qza'}
+    assert parsed["options"] == {'verbose': None}
+
+
+def test_parse_qiime_cmd_not_qiime():
+    with pytest.raises(AXIOME3Error):
+        parse_qiime_cmd(['cp', 'a', 'b'])
+
+
+@pytest.mark.parametrize(
+    ("cmd,expected"),
+    [
+        (['qiime', 'taxa', 'collapse', '--i-table', 't.qza'], True),
+        (['qiime', 'tools', 'export', '--input-path', 't.qza', '--output-path', 'out'], True),
+        (['qiime', 'tools', 'export', '--input-path', 't.qza', '--output-format', 'BIOMV210DirFmt'], False),
+        (['qiime', 'diversity', 'core-metrics', '--output-dir', 'out'], False),
+        (['qiime', 'info'], False),
+    ]
+)
+def test_is_supported(cmd, expected):
+    assert is_supported(cmd) == expected
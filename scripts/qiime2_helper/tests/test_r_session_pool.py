@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.r_session_pool import RSessionPool
+
+INITIALIZED = []
+
+def initializer():
+    INITIALIZED.append(os.getpid())
+
+def failing_initializer():
+    raise RuntimeError("there is no package called 'vegan'")
+
+def initialized_pid():
+    return INITIALIZED
+
+def add(a, b=0):
+    return a + b
+
+def pid():
+    return os.getpid()
+
+def fail():
+    raise ValueError("bad input")
+
+def crash():
+    os._exit(1)
+
+def unhealthy():
+    return False
+
+def make_pool(**kwargs):
+    kwargs.setdefault("start_method", "fork")
+    kwargs.setdefault("initializer", initializer)
+
+    return RSessionPool(**kwargs)
+
+def test_run():
+    with make_pool(size=1) as pool:
+        assert pool.run(add, 1, b=2) == 3
+        # Initializer ran once in the worker
+        assert pool.run(initialized_pid) == [pool.run(pid)]
+
+def test_job_error():
+    with make_pool(size=1) as pool:
+        with pytest.raises(AXIOME3Error) as err:
+            pool.run(fail)
+        assert "bad input" in str(err.value)
+
+        # The worker keeps running jobs
+        assert pool.run(add, 1) == 1
+
+def test_workers_recycled_after_max_jobs():
+    with make_pool(size=1, max_jobs=2) as pool:
+        pids = [pool.run(pid) for _ in range(4)]
+
+    assert pids[0] == pids[1]
+    assert pids[2] == pids[3]
+    assert pids[1] != pids[2]
+
+def test_crashed_worker_replaced():
+    with make_pool(size=1) as pool:
+        with pytest.raises(AXIOME3Error):
+            pool.run(crash)
+
+        assert pool.run(add, 2, 3) == 5
+
+def test_unhealthy_worker_replaced():
+    with make_pool(size=1, health_check=unhealthy) as pool:
+        first = pool.run(pid)
+        second = pool.run(pid)
+
+    assert first != second
+
+def test_failed_startup():
+    with pytest.raises(AXIOME3Error) as err:
+        make_pool(size=2, initializer=failing_initializer)
+    assert "vegan" in str(err.value)
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import biom
+import pytest
+
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.rarefaction import (
+    alpha_rarefaction,
+    curve_summary,
+    max_reads_depth,
+    nested_subsamples,
+    rarefaction_depths,
+    retention_depth,
+    select_sampling_depth,
+    shannon,
+    subsample,
+    suggest_sampling_depth
+)
+
+@pytest.fixture
+def table():
+    # features as rows, samples as columns
+    data = np.array([
+        [50, 0, 5],
+        [30, 10, 5],
+        [15, 10, 5],
+        [5, 10, 5]
+    ])
+
+    return biom.Table(data, observation_ids=['f1', 'f2', 'f3', 'f4'],
+            sample_ids=['s1', 's2', 's3'])
+
+def test_subsample():
+    counts = np.array([50, 0, 30, 15, 5])
+    rng = np.random.default_rng(0)
+
+    draws = subsample(counts, 20, rng, size=2000)
+
+    assert draws.shape == (2000, 5)
+    assert (draws.sum(axis=1) == 20).all()
+    assert (draws <= counts).all()
+    np.testing.assert_allclose(draws.mean(axis=0), counts * 20 / 100, atol=0.15)
+
+    assert subsample(counts, 100, rng).tolist() == counts.tolist()
+    with pytest.raises(ValueError):
+        subsample(counts, 101, rng)
+
+def test_nested_subsamples():
+    counts = np.array([50, 30, 15, 5])
+    rng = np.random.default_rng(0)
+
+    draws = nested_subsamples(counts, [10, 40, 100], 2000, rng)
+
+    assert draws.shape == (2000, 3, 4)
+    np.testing.assert_array_equal(draws.sum(axis=2), np.tile([10, 40, 100], (2000, 1)))
+    # Each depth is drawn from the one above it
+    assert (draws[:, 0] <= draws[:, 1]).all()
+    assert (draws[:, 1] <= draws[:, 2]).all()
+    # ... and is still an unbiased subsample of the sample
+    np.testing.assert_allclose(draws[:, 0].mean(axis=0), counts * 10 / 100, atol=0.15)
+
+def test_shannon():
+    counts = np.array([[5, 5, 5, 5], [20, 0, 0, 0]])
+
+    np.testing.assert_allclose(shannon(counts), [2, 0])
+
+def test_rarefaction_depths():
+    assert rarefaction_depths(100, steps=5) == [1, 25, 50, 75, 100]
+    assert rarefaction_depths(3, steps=10) == [1, 2, 3]
+
+    with pytest.raises(AXIOME3Error):
+        rarefaction_depths(0)
+
+def test_alpha_rarefaction(table):
+    curves = alpha_rarefaction(table, [10, 20, 30], iterations=3, seed=0)
+
+    assert list(curves.columns) == ['sample-id', 'depth', 'iteration', 'observed_features', 'shannon']
+    # s2 and s3 (30 and 20 counts) are left out above their totals
+    assert curves.groupby('sample-id')['depth'].max().to_dict() == {'s1': 30, 's2': 30, 's3': 20}
+    assert len(curves) == 3 * 3 + 3 * 3 + 2 * 3
+    # s3 has 5 counts of each feature; 20 reads keep all of them
+    s3 = curves[(curves['sample-id'] == 's3') & (curves['depth'] == 20)]
+    assert (s3['observed_features'] == 4).all()
+    np.testing.assert_allclose(s3['shannon'], 2)
+
+    again = alpha_rarefaction(table, [10, 20, 30], iterations=3, seed=0)
+    pd.testing.assert_frame_equal(curves, again)
+
+    summary = curve_summary(curves)
+    assert summary.loc[('s3', 20), 'observed_features'] == 4
+
+def test_retention_depth():
+    totals = [40, 10, 30, 20]
+
+    assert retention_depth(totals, 1) == 10
+    assert retention_depth(totals, 0.75) == 20
+    assert retention_depth(totals, 0.1) == 40
+
+    with pytest.raises(AXIOME3Error):
+        retention_depth(totals, 0)
+
+def test_max_reads_depth():
+    # Reads kept: 100, 2 x 50, 3 x 45, 4 x 10
+    assert max_reads_depth([100, 10, 45, 50]) == 45
+    # A tie (2 x 30 and 3 x 20) keeps more samples
+    assert max_reads_depth([40, 10, 30, 20]) == 20
+
+def test_select_sampling_depth():
+    totals = [40, 10, 30, 20, 0]
+
+    assert select_sampling_depth(totals, "min") == 1
+    assert select_sampling_depth(totals[:4], "min") == 10
+    assert select_sampling_depth(totals, "retention", 0.6) == 20
+    assert select_sampling_depth(totals, "max_reads") == 20
+
+    with pytest.raises(AXIOME3Error):
+        select_sampling_depth(totals, "median")
+
+def test_suggest_sampling_depth():
+    # Observed features level off at depth 200
+    observed = {100: 8, 200: 19, 300: 20, 400: 20}
+    curves = pd.DataFrame([
+        {'sample-id': sample, 'depth': depth, 'iteration': 1,
+            'observed_features': value, 'shannon': 1.0}
+        for sample in ['a', 'b', 'c', 'd']
+        for depth, value in observed.items()
+    ])
+    totals = pd.Series({'a': 1000, 'b': 1000, 'c': 1000, 'd': 250})
+
+    assert suggest_sampling_depth(curves, totals, retention=0.75, saturation=0.95) == 200
+    assert suggest_sampling_depth(curves, totals, retention=0.75, saturation=1) == 300
+    # Keeping every sample caps the depth at 200
+    assert suggest_sampling_depth(curves, totals, retention=1, saturation=1) == 200
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from scripts.qiime2_helper.session_cache import (
+    SessionCache,
+    estimate_size,
+    file_key
+)
+
+def test_computed_once():
+    cache = SessionCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "value"
+
+    assert cache.get("key", compute) == "value"
+    assert cache.get("key", compute) == "value"
+    assert len(calls) == 1
+
+def test_least_recently_used_evicted_over_budget():
+    cache = SessionCache(max_bytes=250)
+
+    cache.get("a", lambda: 1, size=100)
+    cache.get("b", lambda: 2, size=100)
+    # "a" becomes the most recently used
+    cache.get("a", lambda: None)
+    cache.get("c", lambda: 3, size=100)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.total_bytes() == 200
+
+    # Values larger than the budget are returned, not cached
+    assert cache.get("d", lambda: 4, size=300) == 4
+    assert "d" not in cache
+    assert len(cache) == 2
+
+def test_estimate_size():
+    df = pd.DataFrame({"x": np.zeros(1000)})
+
+    assert estimate_size(df) >= 8000
+    assert estimate_size(np.zeros(10)) == 80
+    # Attributes of objects, e.g. OrdinationResults
+    ordination = type("Ordination", (object,), {})()
+    ordination.samples = df
+    ordination.eigvals = np.zeros(10)
+    assert estimate_size(ordination) >= 8080
+
+def test_file_key_changes_with_file(tmp_path):
+    path = tmp_path / "metadata.tsv"
+    path.write_text("SampleID\tSite\nS1\ta\n")
+    key = file_key(str(path))
+
+    assert file_key(str(path)) == key
+    path.write_text("SampleID\tSite\nS1\tb\nS2\tc\n")
+    os.utime(str(path), ns=(0, 0))
+    assert file_key(str(path)) != key
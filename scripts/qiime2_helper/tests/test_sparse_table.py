@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import biom
+import pytest
+
+from scripts.qiime2_helper.sparse_table import (
+    sample_totals,
+    percent_abundance,
+    filter_by_abundance,
+    collapse,
+    rarefy,
+    to_dataframe
+)
+from exceptions.exception import AXIOME3Error
+
+
+@pytest.fixture
+def table():
+    # features as rows, samples as columns; s3 is empty
+    data = np.array([
+        [1, 0, 0],
+        [3, 5, 0],
+        [0, 95, 0],
+        [6, 0, 0]
+    ])
+
+    return biom.Table(data, observation_ids=['f1', 'f2', 'f3', 'f4'],
+            sample_ids=['s1', 's2', 's3'])
+
+
+def test_sample_totals(table):
+    totals = sample_totals(table)
+
+    assert totals.to_dict() == {'s1': 10, 's2': 100, 's3': 0}
+
+
+def test_percent_abundance(table):
+    result = to_dataframe(percent_abundance(table), samples_as_rows=False)
+    expected = pd.DataFrame({
+        's1': [0.1, 0.3, 0.0, 0.6],
+        's2': [0.0, 0.05, 0.95, 0.0],
+        's3': [0.0, 0.0, 0.0, 0.0]
+    }, index=['f1', 'f2', 'f3', 'f4'])
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_percent_abundance_features(table):
+    result = to_dataframe(percent_abundance(table, axis='observation'), samples_as_rows=False)
+
+    np.testing.assert_allclose(result.sum(axis=1), [1, 1, 1, 1])
+
+
+def test_filter_by_abundance(table):
+    result = filter_by_abundance(table, 0.5)
+
+    # f1 (max 10%) and f2 (max 30%) are dropped
+    assert sorted(result.ids(axis='observation')) == ['f3', 'f4']
+
+
+def test_filter_by_abundance_empty(table):
+    with pytest.raises(AXIOME3Error):
+        filter_by_abundance(table, 1.5)
+
+
+def test_collapse(table):
+    labels = {'f1': 'A', 'f2': 'B', 'f3': 'A', 'f4': 'B'}
+    result = to_dataframe(collapse(table, labels), samples_as_rows=False)
+
+    assert list(result.index) == ['A', 'B']
+    assert result.loc['A'].tolist() == [1, 95, 0]
+    assert result.loc['B'].tolist() == [9, 5, 0]
+
+
+def test_to_dataframe_orientation(table):
+    df = to_dataframe(table)
+
+    assert list(df.index) == ['s1', 's2', 's3']
+    assert list(df.columns) == ['f1', 'f2', 'f3', 'f4']
+
+
+def test_rarefy(table):
+    rarefied = rarefy(table, 10, seed=0)
+
+    # s3 (0 counts) is dropped; s1 has exactly 10 counts
+    assert list(rarefied.ids(axis='sample')) == ['s1', 's2']
+    assert sample_totals(rarefied).to_dict() == {'s1': 10, 's2': 10}
+    assert rarefied.get_value_by_ids('f4', 's1') == 6
+    # No feature gains counts; empty features are dropped
+    original = to_dataframe(table)
+    result = to_dataframe(rarefied)
+    assert (result <= original.loc[result.index, result.columns]).all().all()
+    assert (result.sum() > 0).all()
+
+    again = rarefy(table, 10, seed=0)
+    pd.testing.assert_frame_equal(to_dataframe(again), result)
+
+
+def test_rarefy_too_deep(table):
+    with pytest.raises(AXIOME3Error):
+        rarefy(table, 101)
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.split_manifest_file_by_run_ID import (
+    get_run_manifest,
+    run_manifest_checksum,
+    write_run_manifest
+)
+
+
+MANIFEST = (
+    "sample-id,absolute-filepath,direction,run_ID\n"
+    "s1,/data/s1_R1.fastq.gz,forward,1\n"
+    "s2,/data/s2_R1.fastq.gz,forward,2\n"
+)
+
+
+def write(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def test_get_run_manifest():
+    manifest_df = pd.DataFrame({
+        'sample-id': ['s1', 's2', 's3'],
+        'run_ID': [1, 2, 1]
+    })
+
+    run_df = get_run_manifest(manifest_df, '1')
+
+    assert list(run_df.columns) == ['sample-id']
+    assert list(run_df['sample-id']) == ['s1', 's3']
+
+    with pytest.raises(AXIOME3Error):
+        get_run_manifest(manifest_df, '3')
+
+
+def test_run_checksum_only_changes_with_its_run(tmp_path):
+    manifest = str(tmp_path / 'manifest.csv')
+    write(manifest, MANIFEST)
+    run1 = run_manifest_checksum(manifest, '1')
+    run2 = run_manifest_checksum(manifest, '2')
+
+    # New run appended
+    write(manifest, MANIFEST + "s3,/data/s3_R1.fastq.gz,forward,3\n")
+    assert run_manifest_checksum(manifest, '1') == run1
+    assert run_manifest_checksum(manifest, '2') == run2
+
+    # Sample added to run 2
+    write(manifest, MANIFEST + "s4,/data/s4_R1.fastq.gz,forward,2\n")
+    assert run_manifest_checksum(manifest, '1') == run1
+    assert run_manifest_checksum(manifest, '2') != run2
+
+
+def test_write_run_manifest(tmp_path):
+    manifest = str(tmp_path / 'manifest.csv')
+    output = str(tmp_path / 'manifest_2.csv')
+    write(manifest, MANIFEST)
+
+    write_run_manifest(manifest, '2', output)
+
+    with open(output) as fh:
+        assert fh.read() == "sample-id,absolute-filepath,direction\ns2,/data/s2_R1.fastq.gz,forward\n"
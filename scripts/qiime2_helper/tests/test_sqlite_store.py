@@ -0,0 +1,25 @@
+from scripts.qiime2_helper.sqlite_store import (
+    QUERY_CHUNK_SIZE,
+    SQLiteStore
+)
+
+def test_sqlite_store(tmp_path):
+    db_path = str(tmp_path / "cache" / "store.sqlite")
+    store = SQLiteStore(db_path, "items", ("scope", "item"), ("a", "b"))
+
+    # More keys than fit in one query
+    keys = ["k{}".format(i) for i in range(QUERY_CHUNK_SIZE * 2 + 1)]
+    store.store("x", {key: (key + "a", key + "b") for key in keys})
+    store.store("y", {"k0": ("other", "scope")})
+    store.close()
+
+    # Persists between connections
+    store = SQLiteStore(db_path, "items", ("scope", "item"), ("a", "b"))
+    found = store.lookup("x", keys + ["unseen"])
+    assert len(found) == len(keys)
+    assert found["k1000"] == ("k1000a", "k1000b")
+    assert store.lookup("y", ["k0", "k1"]) == {"k0": ("other", "scope")}
+
+    store.store("x", {"k0": ("new", "values")})
+    assert store.lookup("x", ["k0"]) == {"k0": ("new", "values")}
+    store.close()
@@ -0,0 +1,60 @@
+import os
+import zipfile
+
+import numpy as np
+import biom
+import pytest
+
+from scripts.qiime2_helper import summarize_sample_counts
+from scripts.qiime2_helper.summarize_sample_counts import (
+    TOTALS_SUFFIX,
+    cached_sample_totals,
+    generate_sample_count
+)
+
+def make_artifact(path, uuid):
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr(uuid + '/metadata.yaml', 'uuid: ' + uuid)
+
+@pytest.fixture
+def loads(monkeypatch):
+    table = biom.Table(np.array([[5, 0, 1], [10, 2, 1]]),
+            observation_ids=['f1', 'f2'], sample_ids=['s1', 's2', 's3'])
+    calls = []
+
+    def load(feature_table, sparse=False):
+        calls.append(feature_table)
+        return table
+
+    monkeypatch.setattr(summarize_sample_counts, 'load_qiime2_artifact', load)
+
+    return calls
+
+def test_cached_sample_totals(tmpdir, loads):
+    artifact = str(tmpdir.join('table.qza'))
+    make_artifact(artifact, 'uuid-1')
+
+    totals = cached_sample_totals(artifact)
+    assert totals.to_dict() == {'s1': 15, 's2': 2, 's3': 2}
+    assert os.path.isfile(artifact + TOTALS_SUFFIX)
+
+    # Answered from the sidecar
+    again = cached_sample_totals(artifact)
+    assert again.to_dict() == totals.to_dict()
+    assert list(again.index) == ['s1', 's2', 's3']
+    assert len(loads) == 1
+
+    # A new artifact at the same path is summed again
+    make_artifact(artifact, 'uuid-2')
+    cached_sample_totals(artifact)
+    assert len(loads) == 2
+
+def test_generate_sample_count_from_totals(tmpdir, loads):
+    artifact = str(tmpdir.join('table.qza'))
+    make_artifact(artifact, 'uuid-1')
+
+    sample_count_df = generate_sample_count(cached_sample_totals(artifact))
+
+    assert list(sample_count_df.columns) == ['Count']
+    assert list(sample_count_df['Count']) == [2, 2, 15]
+    assert sample_count_df.index.name == 'SampleID'
@@ -0,0 +1,66 @@
+import os
+
+from scripts.qiime2_helper.task_manifest import (
+    manifest_path,
+    describe,
+    compute_fingerprint,
+    read_fingerprint,
+    write_manifest,
+    is_up_to_date
+)
+
+
+def write(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def test_manifest_path():
+    assert manifest_path('/out/denoise/dada2_table.qza') == \
+        '/out/denoise/.dada2_table.qza.manifest.json'
+
+
+def test_fingerprint_changes_with_params_and_upstream():
+    base = compute_fingerprint(describe('Denoise_Run', {'trunc_len_f': '250'}, {}, ['a']))
+
+    assert base == compute_fingerprint(describe('Denoise_Run', {'trunc_len_f': '250'}, {}, ['a']))
+    assert base != compute_fingerprint(describe('Denoise_Run', {'trunc_len_f': '240'}, {}, ['a']))
+    assert base != compute_fingerprint(describe('Denoise_Run', {'trunc_len_f': '250'}, {}, ['b']))
+    # Order of upstream tasks does not matter
+    assert compute_fingerprint(describe('Merge_Denoise', {}, {}, ['a', 'b'])) == \
+        compute_fingerprint(describe('Merge_Denoise', {}, {}, ['b', 'a']))
+
+
+def test_fingerprint_follows_file_content(tmp_path):
+    metadata = str(tmp_path / 'metadata.tsv')
+    write(metadata, 'SampleID\tGroup\nS1\tA\n')
+    before = compute_fingerprint(describe('Filter_Feature_Table', {}, {'metadata_file': metadata}, []))
+
+    write(metadata, 'SampleID\tGroup\nS1\tB\n')
+    after = compute_fingerprint(describe('Filter_Feature_Table', {}, {'metadata_file': metadata}, []))
+
+    assert before != after
+    assert describe('Filter_Feature_Table', {}, {'metadata_file': ''}, [])['files'] == \
+        {'metadata_file': 'missing:'}
+
+
+def test_is_up_to_date(tmp_path):
+    output = str(tmp_path / 'table.qza')
+    manifest = manifest_path(output)
+    description = describe('Rarefy', {'sampling_depth': '1000'}, {}, [])
+    fingerprint = compute_fingerprint(description)
+
+    # Missing output
+    assert not is_up_to_date([output], manifest, fingerprint)
+
+    # Output without manifest
+    write(output, 'table')
+    assert read_fingerprint(manifest) is None
+    assert not is_up_to_date([output], manifest, fingerprint)
+
+    write_manifest(manifest, fingerprint, description, [output])
+    assert is_up_to_date([output], manifest, fingerprint)
+    assert not is_up_to_date([output], manifest, 'other')
+
+    os.remove(output)
+    assert not is_up_to_date([output], manifest, fingerprint)
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import biom
+import pytest
+
+from scripts.qiime2_helper.taxa_collapse import (
+    split_lineages,
+    collapse_table_all_levels,
+    collapsed_table_to_df
+)
+from exceptions.exception import AXIOME3Error
+
+
+@pytest.fixture
+def table():
+    data = np.array([
+        [1, 0, 3],
+        [2, 5, 0],
+        [0, 1, 1],
+        [4, 0, 0]
+    ])
+
+    return biom.Table(data, observation_ids=['f1', 'f2', 'f3', 'f4'],
+            sample_ids=['s1', 's2', 's3'])
+
+
+@pytest.fixture
+def taxonomy():
+    return pd.Series({
+        'f1': 'd__Bacteria; p__Firmicutes; c__Bacilli',
+        'f2': 'd__Archaea; p__Thermoproteota',
+        'f3': 'd__Bacteria; p__Firmicutes; c__Clostridia',
+        'f4': 'd__Bacteria; p__Firmicutes; c__Bacilli',
+        'unused': 'd__Bacteria'
+    })
+
+
+def reference_collapse(table, taxonomy, level):
+    # Same as q2-taxa collapse
+    lineages, _ = split_lineages(taxonomy)
+    metadata = {feature: {'taxonomy': lineage}
+            for feature, lineage in zip(taxonomy.index, lineages)}
+    table = table.copy()
+    table.add_metadata(metadata, axis='observation')
+
+    return table.collapse(lambda id_, md: ';'.join(md['taxonomy'][:level]),
+            axis='observation', norm=False)
+
+
+def test_split_lineages(taxonomy):
+    lineages, max_level = split_lineages(taxonomy)
+
+    assert max_level == 3
+    assert lineages[1] == ['d__Archaea', 'p__Thermoproteota', '__']
+
+
+def test_collapse_table_all_levels(table, taxonomy):
+    collapsed = collapse_table_all_levels(table, taxonomy, ['domain', 'phylum', 'class'])
+
+    for level, n in [('domain', 1), ('phylum', 2), ('class', 3)]:
+        expected = collapsed_table_to_df(reference_collapse(table, taxonomy, n))
+        result = collapsed_table_to_df(collapsed[level])
+
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_collapse_table_missing_feature(table, taxonomy):
+    with pytest.raises(AXIOME3Error):
+        collapse_table_all_levels(table, taxonomy.drop('f3'), ['domain'])
+
+
+def test_collapse_table_level_too_deep(table, taxonomy):
+    with pytest.raises(AXIOME3Error):
+        collapse_table_all_levels(table, taxonomy, ['genus'])
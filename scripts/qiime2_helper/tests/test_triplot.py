@@ -1,8 +1,21 @@
+import os
+
+import numpy as np
 import pandas as pd
+import biom
 import pytest
 
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper import triplot
+from scripts.qiime2_helper import triplot_engine
+from scripts.qiime2_helper.session_cache import SessionCache
 from scripts.qiime2_helper.triplot import (
+	collapse_taxa,
+	generate_vector_arrow_df,
 	get_axis_breakpoints,
+	process_input_in_R_session,
+	process_input_natively,
+	save_plots,
 )
 
 
@@ -18,4 +31,141 @@ def test_get_axis_breakpoints(low, high, num_breaks, expected_breakpoints, expec
 	breakpoints, labels = get_axis_breakpoints(low, high, num_breaks)
 
 	assert breakpoints == expected_breakpoints
-	assert labels == expected_labels
\ No newline at end of file
+	assert labels == expected_labels
+
+def test_process_input_natively():
+	rng = np.random.default_rng(0)
+	samples = ["S{}".format(i) for i in range(12, 0, -1)]
+	feature_table_df = pd.DataFrame(rng.integers(0, 50, size=(12, 8)), index=samples,
+		columns=["ASV{}".format(i) for i in range(8)])
+	abundance_df = pd.DataFrame(rng.integers(0, 50, size=(12, 3)), index=samples,
+		columns=["Phylum A", "Phylum B", "Phylum C"])
+	sample_metadata_df = pd.DataFrame({"Site": ["x", "y"] * 6}, index=samples)
+
+	dissimilarity = triplot_engine.vegdist(feature_table_df, "bray")
+	points, _ = triplot_engine.cmdscale(dissimilarity, 10)
+	env_metadata_df = pd.DataFrame({"pH": points["Axis 1"] * 3 + 7, "noise": rng.normal(size=12)}, index=samples)
+
+	merged_df, vector_arrow_df, wascores_df, proportion_explained, projection_df = process_input_natively(
+		feature_table_df, abundance_df, sample_metadata_df, env_metadata_df,
+		"bray", R2_threshold=0.5, pval_threshold=0.05, wa_threshold=0,
+		PC_axis_one=1, PC_axis_two=3, permutations=99, seed=0)
+
+	# Axes with negative eigenvalues (non-euclidean Bray-Curtis) are dropped
+	n_axes = merged_df.shape[1] - 2
+	assert list(merged_df.columns) == ["SampleID"] + ["Axis {}".format(i) for i in range(1, n_axes + 1)] + ["Site"]
+	assert list(merged_df["SampleID"]) == sorted(samples)
+	assert list(vector_arrow_df.index) == ["pH"]
+	assert list(vector_arrow_df.columns) == ["Axis 1", "Axis 3"]
+	assert vector_arrow_df.loc["pH", "Axis 1"] == pytest.approx(1)
+	assert list(wascores_df.index) == ["Phylum A", "Phylum B", "Phylum C"]
+	assert wascores_df["abundance"].sum() == pytest.approx(1)
+	assert list(proportion_explained.index) == ["Axis {}".format(i) for i in range(1, 13)]
+	assert proportion_explained["proportion_explained"].sum() == pytest.approx(100)
+
+	# Projection is compatible with generate_vector_arrow_df
+	arrows = generate_vector_arrow_df(projection_df, 0.5, 0.05)
+	assert list(arrows.index) == ["pH"]
+
+	with pytest.raises(AXIOME3Error):
+		process_input_natively(
+			feature_table_df, abundance_df, sample_metadata_df, env_metadata_df,
+			"bray", R2_threshold=0.5, pval_threshold=0.05, wa_threshold=0,
+			PC_axis_one=1, PC_axis_two=12)
+
+class NativeSessionPool(object):
+	"""
+	Stands in for an RSessionPool; computes the job with triplot_engine.
+	"""
+	def __init__(self):
+		self.jobs = []
+
+	def run(self, func, feature_table_df, abundance_df, env_metadata_df,
+		dissmilarity_index, k, PC_axis_one, PC_axis_two):
+		self.jobs.append((func.__name__, dissmilarity_index, k))
+
+		dissimilarity = triplot_engine.vegdist(feature_table_df, dissmilarity_index)
+		points, eig = triplot_engine.cmdscale(dissimilarity, k)
+		projection_df = triplot_engine.envfit(points, env_metadata_df,
+			choices=(PC_axis_one, PC_axis_two), permutations=99, seed=0)
+
+		return points, eig, triplot_engine.wascores(points, abundance_df), projection_df
+
+def test_process_input_in_R_session():
+	rng = np.random.default_rng(1)
+	samples = ["S{}".format(i) for i in range(1, 7)]
+	feature_table_df = pd.DataFrame(rng.integers(1, 50, size=(6, 5)), index=samples)
+	abundance_df = pd.DataFrame(rng.integers(1, 50, size=(6, 2)), index=samples,
+		columns=["Phylum A", "Phylum B"])
+	sample_metadata_df = pd.DataFrame({"Site": list("xyxyxy")}, index=samples)
+	points, _ = triplot_engine.cmdscale(triplot_engine.vegdist(feature_table_df, "euclidean"), 5)
+	env_metadata_df = pd.DataFrame({"pH": points["Axis 2"] * 2 + 7}, index=samples)
+	pool = NativeSessionPool()
+
+	merged_df, vector_arrow_df, wascores_df, proportion_explained, projection_df = process_input_in_R_session(
+		feature_table_df, abundance_df, sample_metadata_df, env_metadata_df,
+		"euclidean", R2_threshold=0.5, pval_threshold=0.05, wa_threshold=0,
+		PC_axis_one=1, PC_axis_two=2, r_session_pool=pool)
+
+	# k = min(10, samples - 1)
+	assert pool.jobs == [("triplot_ordination", "euclidean", 5)]
+	assert list(vector_arrow_df.index) == ["pH"]
+	assert vector_arrow_df.loc["pH", "Axis 2"] == pytest.approx(1)
+	assert list(merged_df["SampleID"]) == samples
+
+class FakeArtifact(object):
+	def __init__(self, uuid, views):
+		self.uuid = uuid
+		self.views = views
+		self.loads = 0
+
+	def view(self, view_type):
+		self.loads = self.loads + 1
+
+		return self.views[view_type]
+
+def test_collapse_taxa_shares_rarefied_table():
+	table = biom.Table(np.array([[30, 5], [20, 40], [50, 55]]),
+		observation_ids=["f1", "f2", "f3"], sample_ids=["S1", "S2"])
+	taxonomy = pd.DataFrame({
+		"Taxon": ["d__Bacteria; p__A; c__X", "d__Bacteria; p__A; c__Y", "d__Bacteria; p__B; c__Z"],
+		"Confidence": [0.9, 0.9, 0.9]}, index=["f1", "f2", "f3"])
+	feature_table_artifact = FakeArtifact("table-uuid", {biom.Table: table})
+	taxonomy_artifact = FakeArtifact("taxonomy-uuid", {pd.DataFrame: taxonomy})
+	cache = SessionCache()
+
+	asv_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, 50, "asv", cache=cache)
+	phylum_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, 50, "phylum", cache=cache)
+
+	# Both levels are collapsed from the same rarefied table
+	assert feature_table_artifact.loads == 1
+	asv_phylum = asv_df.groupby(asv_df["Taxon"].str.split("; ").str[1])[["S1", "S2"]].sum()
+	np.testing.assert_array_equal(asv_phylum.to_numpy(), phylum_df[["S1", "S2"]].to_numpy())
+	assert list(phylum_df[["S1", "S2"]].sum()) == [50, 50]
+
+	# Repeated requests are served from the cache, as copies
+	phylum_df["Taxon"] = "modified"
+	again = collapse_taxa(feature_table_artifact, taxonomy_artifact, 50, "phylum", cache=cache)
+	assert feature_table_artifact.loads == 1
+	assert "modified" not in list(again["Taxon"])
+
+def test_save_plots(monkeypatch):
+	rendered = []
+	monkeypatch.setattr(triplot, "render_plots",
+		lambda specs, workers: rendered.append((specs, workers)))
+
+	save_plots([{"point_size": 1}, {"point_size": 2}], ["first", "second"],
+		output_dir="plots", file_format="png", width=254, height=127, workers=2)
+
+	specs, workers = rendered[0]
+	assert workers == 2
+	assert [spec.make_plot for spec in specs] == [triplot.make_triplot] * 2
+	assert [spec.kwargs for spec in specs] == [{"point_size": 1}, {"point_size": 2}]
+	assert [spec.images for spec in specs] == [
+		[(os.path.join("plots", "first.png"), "png")],
+		[(os.path.join("plots", "second.png"), "png")],
+	]
+	assert specs[0].size == (10, 5)
+
+	with pytest.raises(AXIOME3Error):
+		save_plots([{}], ["first", "second"])
@@ -0,0 +1,210 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from exceptions.exception import AXIOME3Error
+from scripts.qiime2_helper.triplot_engine import (
+    NATIVE_VEGDIST_METHODS,
+    VectorFit,
+    cmdscale,
+    envfit,
+    permutation_block,
+    permutation_pvalues,
+    vegdist,
+    wascores
+)
+
+COUNTS = pd.DataFrame(
+    [[10, 0, 3, 7, 1],
+     [2, 5, 0, 9, 4],
+     [0, 8, 6, 1, 2],
+     [5, 5, 5, 0, 0],
+     [1, 0, 12, 3, 6],
+     [7, 2, 2, 2, 9]],
+    index=["S{}".format(i) for i in range(1, 7)],
+    columns=["t{}".format(i) for i in range(1, 6)],
+    dtype=float)
+
+def naive_vegdist(x, method):
+    # Pair by pair, following the vegan documentation
+    n = x.shape[0]
+    if(method == "gower"):
+        x = (x - x.min(axis=0)) / np.maximum(x.max(axis=0) - x.min(axis=0), np.finfo(float).eps)
+
+    d = np.zeros((n, n))
+    for j in range(n):
+        for k in range(n):
+            a, b = x[j], x[k]
+            if(method == "bray"):
+                d[j, k] = np.abs(a - b).sum() / (a + b).sum()
+            elif(method == "jaccard"):
+                bray = np.abs(a - b).sum() / (a + b).sum()
+                d[j, k] = 2 * bray / (1 + bray)
+            elif(method == "manhattan"):
+                d[j, k] = np.abs(a - b).sum()
+            elif(method == "euclidean"):
+                d[j, k] = np.sqrt(((a - b) ** 2).sum())
+            elif(method == "canberra"):
+                nz = (a + b) > 0
+                d[j, k] = (np.abs(a - b)[nz] / (a + b)[nz]).sum() / nz.sum()
+            elif(method == "kulczynski"):
+                m = np.minimum(a, b).sum()
+                d[j, k] = 1 - 0.5 * (m / a.sum() + m / b.sum())
+            elif(method == "gower"):
+                d[j, k] = np.abs(a - b).sum() / len(a)
+            elif(method == "altGower"):
+                nz = (a + b) > 0
+                d[j, k] = np.abs(a - b).sum() / nz.sum()
+            elif(method in ("morisita", "horn")):
+                if(method == "morisita"):
+                    la = (a * (a - 1)).sum() / (a.sum() * (a.sum() - 1))
+                    lb = (b * (b - 1)).sum() / (b.sum() * (b.sum() - 1))
+                else:
+                    la = (a ** 2).sum() / a.sum() ** 2
+                    lb = (b ** 2).sum() / b.sum() ** 2
+                d[j, k] = max(0, 1 - 2 * (a * b).sum() / ((la + lb) * a.sum() * b.sum()))
+            elif(method == "binomial"):
+                total = 0
+                for xa, xb in zip(a, b):
+                    ni = xa + xb
+                    if(ni == 0):
+                        continue
+                    ta = xa * np.log(xa / ni) if xa > 0 else 0
+                    tb = xb * np.log(xb / ni) if xb > 0 else 0
+                    total += (ta + tb - ni * np.log(0.5)) / ni
+                d[j, k] = total
+    np.fill_diagonal(d, 0)
+
+    return d
+
+@pytest.mark.parametrize("method", [m for m in NATIVE_VEGDIST_METHODS if m != "mahalanobis"])
+def test_vegdist(method):
+    observed = vegdist(COUNTS, method)
+
+    assert list(observed.index) == list(COUNTS.index)
+    np.testing.assert_allclose(observed.to_numpy(), naive_vegdist(COUNTS.to_numpy(), method), atol=1e-12)
+
+def test_vegdist_mahalanobis():
+    x = COUNTS.iloc[:, :3]
+    centred = x - x.mean()
+    inverse = np.linalg.inv(np.cov(centred.to_numpy(), rowvar=False))
+    diff = centred.to_numpy()[0] - centred.to_numpy()[1]
+
+    observed = vegdist(x, "mahalanobis")
+
+    assert observed.iloc[0, 1] == pytest.approx(np.sqrt(diff @ inverse @ diff))
+
+def test_vegdist_unsupported():
+    with pytest.raises(AXIOME3Error):
+        vegdist(COUNTS, "chao")
+
+def test_cmdscale_recovers_euclidean_configuration():
+    distances = vegdist(COUNTS, "euclidean")
+
+    points, eig = cmdscale(distances, k=5)
+
+    # Full-rank PCoA of euclidean distances reproduces the distances
+    recovered = vegdist(points, "euclidean")
+    np.testing.assert_allclose(recovered.to_numpy(), distances.to_numpy(), atol=1e-9)
+    assert list(points.columns) == ["Axis {}".format(i) for i in range(1, 6)]
+    assert len(eig) == 6
+    assert np.all(np.diff(eig) <= 1e-12)
+    # Axes are centred and ordered by variance
+    np.testing.assert_allclose(points.mean().to_numpy(), 0, atol=1e-9)
+    np.testing.assert_allclose((points ** 2).sum().to_numpy(), eig[:5], rtol=1e-9)
+
+def test_wascores():
+    points = pd.DataFrame({"Axis 1": [1.0, -1.0, 3.0]}, index=["a", "b", "c"])
+    abundance = pd.DataFrame({"x": [1, 1, 0], "y": [0, 1, 3], "z": [0, 0, 0]}, index=["a", "b", "c"])
+
+    observed = wascores(points, abundance)
+
+    assert observed.loc["x", "Axis 1"] == 0
+    assert observed.loc["y", "Axis 1"] == pytest.approx(2.0)
+    assert np.isnan(observed.loc["z", "Axis 1"])
+
+def test_envfit():
+    rng = np.random.default_rng(1)
+    points = pd.DataFrame(rng.normal(size=(30, 3)), columns=["Axis 1", "Axis 2", "Axis 3"])
+    env = pd.DataFrame({
+        "along_axis_two": 2 * points["Axis 2"] + 5,
+        "noise": rng.normal(size=30),
+        "constant": np.ones(30)
+    })
+
+    projection = envfit(points, env, choices=(1, 2), permutations=199, seed=0)
+
+    assert list(projection.columns) == ["Dim1", "Dim2", "R2", "pvals"]
+    assert projection.loc["along_axis_two", "R2"] == pytest.approx(1)
+    np.testing.assert_allclose(projection.loc["along_axis_two", ["Dim1", "Dim2"]].to_numpy(), [0, 1], atol=1e-9)
+    assert projection.loc["along_axis_two", "pvals"] == pytest.approx(1 / 200)
+    assert projection.loc["noise", "pvals"] > 0.01
+    assert projection.loc["constant", "R2"] == 0
+    assert projection.loc["constant", "pvals"] == 1
+
+    # Same seed, same p-values
+    again = envfit(points, env, choices=(1, 2), permutations=199, seed=0)
+    pd.testing.assert_frame_equal(projection, again)
+
+def test_permuted_r_squared_matches_loop():
+    rng = np.random.default_rng(2)
+    fit = VectorFit(rng.normal(size=(12, 2)), rng.normal(size=(12, 4)))
+    permutations = permutation_block(12, 25, seed=3)
+
+    observed = fit.permuted_r_squared(permutations)
+
+    # One regression per permutation
+    expected = np.array([fit.r_squared(fit.env[perm]) for perm in permutations])
+    assert observed.shape == (25, 4)
+    np.testing.assert_allclose(observed, expected, atol=1e-12)
+    assert all(sorted(perm) == list(range(12)) for perm in permutations)
+
+def test_permutation_pvalues_independent_of_workers():
+    rng = np.random.default_rng(4)
+    fit = VectorFit(rng.normal(size=(20, 2)), rng.normal(size=(20, 3)))
+    r2 = fit.r_squared(fit.env)
+
+    serial = permutation_pvalues(fit, r2, permutations=250, seed=5, block_size=60)
+    parallel = permutation_pvalues(fit, r2, permutations=250, seed=5, block_size=60, workers=2)
+
+    np.testing.assert_array_equal(serial, parallel)
+    assert np.all((serial >= 1 / 251) & (serial <= 1))
+
+def has_vegan():
+    if(shutil.which("Rscript") is None):
+        return False
+    proc = subprocess.run(["Rscript", "-e", "library(vegan)"], capture_output=True)
+
+    return proc.returncode == 0
+
+@pytest.mark.skipif(not has_vegan(), reason="R with vegan is not installed")
+@pytest.mark.parametrize("method", NATIVE_VEGDIST_METHODS)
+def test_matches_vegan(method, tmp_path):
+    counts_path = str(tmp_path / "counts.csv")
+    distances_path = str(tmp_path / "distances.csv")
+    points_path = str(tmp_path / "points.csv")
+    COUNTS.to_csv(counts_path)
+
+    script = """
+        suppressMessages(library(vegan))
+        x <- read.csv("{counts}", row.names=1)
+        d <- vegdist(x, method="{method}")
+        write.csv(as.matrix(d), "{distances}")
+        write.csv(cmdscale(d, k=3, eig=TRUE)$points, "{points}")
+    """.format(counts=counts_path, method=method, distances=distances_path, points=points_path)
+    subprocess.run(["Rscript", "-e", script], check=True)
+
+    distances = vegdist(COUNTS, method)
+    expected = pd.read_csv(distances_path, index_col=0).to_numpy()
+    np.testing.assert_allclose(distances.to_numpy(), expected, atol=1e-9)
+
+    # Axes are defined up to sign
+    points, _ = cmdscale(distances, k=3)
+    expected_points = pd.read_csv(points_path, index_col=0).to_numpy()
+    n_axes = min(points.shape[1], expected_points.shape[1])
+    np.testing.assert_allclose(np.abs(points.to_numpy()[:, :n_axes]),
+            np.abs(expected_points[:, :n_axes]), atol=1e-8)
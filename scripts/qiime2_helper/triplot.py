@@ -2,18 +2,18 @@ from typing import List, Union
 
 import os
 import subprocess
+import importlib.util
 import math
 from textwrap import dedent
 import pandas as pd
 import numpy as np
+import biom
 from plotnine import *
 
 from qiime2 import (
 	Artifact,
 	Metadata
 )
-from qiime2.plugins.taxa.methods import collapse
-from qiime2.plugins.feature_table.methods import rarefy
 
 from scripts.qiime2_helper.metadata_helper import (
 	load_metadata,
@@ -28,10 +28,31 @@ from scripts.qiime2_helper.artifact_helper import (
 	rename_taxa
 )
 
+from scripts.qiime2_helper.taxa_collapse import collapse_table_all_levels
+from scripts.qiime2_helper import triplot_engine
+from scripts.qiime2_helper.r_session_pool import default_pool
+from scripts.qiime2_helper.r_session_jobs import triplot_ordination
+from scripts.qiime2_helper.sparse_table import (
+	rarefy,
+	to_dataframe
+)
+from scripts.qiime2_helper.session_cache import (
+	cached_env_metadata,
+	cached_metadata,
+	load_artifact,
+	shared_cache
+)
+
 from scripts.qiime2_helper.plotnine_helper import (
 		add_fill_colours_from_users
 )
 
+from scripts.qiime2_helper.plot_scheduler import (
+	PlotSpec,
+	figure_size,
+	render_plots
+)
+
 # Custom exception
 from exceptions.exception import AXIOME3Error
 
@@ -52,12 +73,49 @@ VEGDIST_OPTIONS = {
 	"Mahalanobis":"mahalanobis"
 }
 
-def collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth=0, collapse_level="asv"):
+def rarefied_table(feature_table_artifact, sampling_depth=0, seed=None, cache=None):
+	"""
+	Feature table rarefied to sampling_depth (not rarefied if 0).
+
+	Input:
+		- feature_table_artifact: QIIME2 artifact of type FeatureTable[Frequency]
+		- sampling_depth: rarefaction depth
+		- seed: rarefaction random seed
+		- cache: SessionCache to share the rarefied table; None to always
+			rarefy
+
+	Returns:
+		- biom.Table
+	"""
+	# Rarefy the table to user specified sampling depth
+	if(sampling_depth < 0):
+		raise AXIOME3Error("Sampling depth cannot be a negative number!")
+
+	def compute():
+		feature_table = feature_table_artifact.view(biom.Table)
+		# don't rarefy is sampling depth equals 0
+		if(sampling_depth > 0):
+			feature_table = rarefy(feature_table, sampling_depth, seed)
+
+		return feature_table
+
+	if(cache is None):
+		return compute()
+
+	key = ("rarefied", str(feature_table_artifact.uuid), sampling_depth, seed)
+
+	return cache.get(key, compute)
+
+def collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth=0, collapse_level="asv",
+	seed=None, cache=None):
 	"""
 	Collapse feature table to user specified taxa level (ASV by default).
 
 	Input:
 		- QIIME2 artifact of type FeatureData[Taxonomy]
+		- seed: rarefaction random seed
+		- cache: SessionCache; results are keyed on artifact UUIDs, depth,
+			seed and level. None to always compute
 
 	Returns:
 		- pd.DataFrame
@@ -68,24 +126,28 @@ def collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth=0, c
 	if(collapse_level not in VALID_COLLAPSE_LEVELS):
 		raise AXIOME3Error("Specified collapse level, {collapse_level}, is NOT valid!".format(collapse_level=collapse_level))
 
-	# Rarefy the table to user specified sampling depth
-	if(sampling_depth < 0):
-		raise AXIOME3Error("Sampling depth cannot be a negative number!")
-	# don't rarefy is sampling depth equals 0
-	if(sampling_depth > 0):
-		try:
-			rarefied = rarefy(feature_table_artifact, sampling_depth=sampling_depth)
-		except ValueError:
-			raise AXIOME3Error("No samples or features left after rarefying at {}".format(sampling_depth))
-		feature_table_artifact = rarefied.rarefied_table
+	# Work on sparse table; dense dataframe is only made for the output
+	feature_table = rarefied_table(feature_table_artifact, sampling_depth, seed, cache)
+
+	if(cache is None):
+		return collapse_table_to_df(feature_table, taxonomy_artifact, collapse_level)
+
+	key = ("collapsed", str(feature_table_artifact.uuid), str(taxonomy_artifact.uuid),
+		sampling_depth, seed, collapse_level)
+	collapsed_df = cache.get(key,
+		lambda: collapse_table_to_df(feature_table, taxonomy_artifact, collapse_level))
+
+	# Callers modify the dataframe
+	return collapsed_df.copy()
 
+def collapse_table_to_df(feature_table, taxonomy_artifact, collapse_level):
+	"""
+	collapse_taxa on a (rarefied) biom table.
+	"""
 	# handle ASV case
 	if(collapse_level == "asv"):
-		# By default, feature table has samples as rows, and ASV as columns
-		feature_table_df = feature_table_artifact.view(pd.DataFrame)
-
-		# Transpose feature table
-		feature_table_df_T = feature_table_df.T
+		# ASV as rows, samples as columns
+		feature_table_df_T = to_dataframe(feature_table, samples_as_rows=False)
 
 		# By default, taxonomy has ASV as rows, and metadata as columns
 		taxonomy_df = taxonomy_artifact.view(pd.DataFrame)
@@ -101,16 +163,14 @@ def collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth=0, c
 
 		return final_df
 
+	taxonomy = taxonomy_artifact.view(pd.DataFrame)["Taxon"]
 	try:
-		table_artifact = collapse(table=feature_table_artifact, taxonomy=taxonomy_artifact, level=VALID_COLLAPSE_LEVELS[collapse_level])
-	except ValueError:
+		collapsed_table = collapse_table_all_levels(feature_table, taxonomy, [collapse_level])[collapse_level]
+	except AXIOME3Error:
 		raise AXIOME3Error("No data to process. Please check if 1. input feature table is empty, 2. input taxonomy is empty, 3. input feature table and taxonomy share common features.")
 
-	# By default, it has samples as rows, and taxa as columns
-	collapsed_df = table_artifact.collapsed_table.view(pd.DataFrame)
-
-	# Transpose
-	collapsed_df_T = collapsed_df.T
+	# Taxa as rows, samples as columns
+	collapsed_df_T = to_dataframe(collapsed_table, samples_as_rows=False)
 
 	# Append "Taxon" column
 	collapsed_df_T["Taxon"] = collapsed_df_T.index
@@ -390,20 +450,41 @@ def normalize_env_arrow_against_pcoa(pcoa_df: pd.DataFrame, env_arrow_df: pd.Dat
 def prep_triplot_input(sample_metadata_path, env_metadata_path, feature_table_artifact_path,
 	taxonomy_artifact_path, sampling_depth=0, ordination_collapse_level="asv", 
 	wascores_collapse_level="phylum", dissmilarity_index="Bray-Curtis", R2_threshold=0.1, 
-	pval_threshold=0.05, wa_threshold=0.1, PC_axis_one=1, PC_axis_two=2, output_dir='.'):
+	pval_threshold=0.05, wa_threshold=0.1, PC_axis_one=1, PC_axis_two=2, output_dir='.',
+	engine="python", permutations=999, seed=None, permutation_workers=1,
+	r_session_pool=None, rarefaction_seed=None):
+	"""
+	Ordination, taxa weighted averages and environmental vectors of a triplot.
+
+	engine
+		- "python" computes them with triplot_engine; dissimilarity indices
+			the native engine does not support fall back to "R" (or to
+			"Rscript" if rpy2 is not installed)
+		- "R" runs vegan in a warm embedded R session of r_session_pool
+			(the shared default pool if None)
+		- "Rscript" runs pcoa_triplot.R in a new R process
+	permutations, seed and permutation_workers only apply to the native
+	engine (envfit p-values).
+
+	Both collapse levels use the same rarefied table (rarefaction_seed
+	makes it reproducible). Inputs, rarefied and collapsed tables are kept
+	in the session cache for repeated requests.
+	"""
 
 	# Load sample metadata
-	sample_metadata_df = load_metadata(sample_metadata_path)
+	sample_metadata_df = cached_metadata(sample_metadata_path)
 	# Load environmental metadata
 	# and drop rows with missing values (WARN users?)
-	env_metadata_df = load_env_metadata(env_metadata_path)
+	env_metadata_df = cached_env_metadata(env_metadata_path)
 	env_metadata_df = env_metadata_df.dropna()
 
 	# Load feature table and collapse
-	feature_table_artifact = check_artifact_type(feature_table_artifact_path, "feature_table")
-	taxonomy_artifact = check_artifact_type(taxonomy_artifact_path, "taxonomy")
-	ordination_collapsed_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth, ordination_collapse_level)
-	abundance_collapsed_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth, wascores_collapse_level)
+	feature_table_artifact = load_artifact(feature_table_artifact_path, "feature_table")
+	taxonomy_artifact = load_artifact(taxonomy_artifact_path, "taxonomy")
+	ordination_collapsed_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth,
+		ordination_collapse_level, rarefaction_seed, shared_cache)
+	abundance_collapsed_df = collapse_taxa(feature_table_artifact, taxonomy_artifact, sampling_depth,
+		wascores_collapse_level, rarefaction_seed, shared_cache)
 
 	# Rename taxa for wascores collapsed df
 	original_taxa = pd.Series(abundance_collapsed_df["Taxon"])
@@ -429,9 +510,34 @@ def prep_triplot_input(sample_metadata_path, env_metadata_path, feature_table_ar
 		env_metadata_df
 	)
 
+	vegdist_method = VEGDIST_OPTIONS[dissmilarity_index]
+	if(engine == "python" and vegdist_method in triplot_engine.NATIVE_VEGDIST_METHODS):
+		merged_df, renamed_vector_arrow_df, filtered_wascores_df, proportion_explained, projection_df = process_input_natively(
+			intersection_feature_table_df, intersection_abundance_df,
+			intersection_sample_metadata_df, intersection_environmental_metadata_df,
+			vegdist_method, R2_threshold, pval_threshold, wa_threshold,
+			PC_axis_one, PC_axis_two, permutations, seed, permutation_workers)
+
+		return merged_df, renamed_vector_arrow_df, filtered_wascores_df, proportion_explained, projection_df, sample_summary
+
+	if(engine == "python"):
+		engine = "R" if r_sessions_available() else "Rscript"
+
+	if(engine == "R"):
+		merged_df, renamed_vector_arrow_df, filtered_wascores_df, proportion_explained, projection_df = process_input_in_R_session(
+			intersection_feature_table_df, intersection_abundance_df,
+			intersection_sample_metadata_df, intersection_environmental_metadata_df,
+			vegdist_method, R2_threshold, pval_threshold, wa_threshold,
+			PC_axis_one, PC_axis_two, r_session_pool)
+
+		return merged_df, renamed_vector_arrow_df, filtered_wascores_df, proportion_explained, projection_df, sample_summary
+
+	if(engine != "Rscript"):
+		raise AXIOME3Error("Unknown triplot engine, {}".format(engine))
+
 	process_input_with_R(intersection_feature_table_df, intersection_abundance_df,
 		intersection_sample_metadata_df, intersection_environmental_metadata_df,
-		VEGDIST_OPTIONS[dissmilarity_index], R2_threshold, pval_threshold, wa_threshold,
+		vegdist_method, R2_threshold, pval_threshold, wa_threshold,
 		PC_axis_one, PC_axis_two, output_dir)
 
 	# After successful subprocess call, there should be intermediate output files...
@@ -451,6 +557,166 @@ def prep_triplot_input(sample_metadata_path, env_metadata_path, feature_table_ar
 
 	return merged_df, renamed_vector_arrow_df, filtered_wascores_df, proportion_explained, projection_df, sample_summary
 
+def r_sessions_available():
+	"""
+	True if embedded R sessions can be used (rpy2 is installed).
+	"""
+	return importlib.util.find_spec("rpy2") is not None
+
+def check_triplot_input(intersection_feature_table_df, intersection_abundance_df,
+	intersection_sample_metadata_df, intersection_environmental_metadata_df,
+	PC_axis_one, PC_axis_two):
+	"""
+	Input checks of pcoa_triplot.R.
+
+	Returns:
+		- number of PCoA dimensions to compute
+	"""
+	inputs = [
+		(intersection_feature_table_df, "feature table"),
+		(intersection_abundance_df, "taxonomy file"),
+		(intersection_sample_metadata_df, "metadata file"),
+		(intersection_environmental_metadata_df, "environmental metadata file")
+	]
+	for df, name in inputs:
+		if(df.shape[0] == 0):
+			raise AXIOME3Error("{name} is empty or has no common samples with other inputs.".format(name=name))
+
+	# k is bounded by [1, min(num.samples-1, 10)]
+	num_samples = intersection_feature_table_df.shape[0]
+	k = min(10, num_samples - 1)
+
+	if(max(PC_axis_one, PC_axis_two) > k):
+		raise AXIOME3Error("Specified PC axis is greater than the maximum allowed value, {}".format(k))
+
+	return k
+
+def check_positive_axes(pcoa_df, PC_axis_one, PC_axis_two):
+	"""
+	Axes with negative eigenvalues are dropped by cmdscale.
+	"""
+	if(max(PC_axis_one, PC_axis_two) > pcoa_df.shape[1]):
+		raise AXIOME3Error("Specified PC axis has a negative eigenvalue; only {} PC axes can be used".format(pcoa_df.shape[1]))
+
+def process_input_natively(intersection_feature_table_df, intersection_abundance_df,
+	intersection_sample_metadata_df, intersection_environmental_metadata_df,
+	dissmilarity_index, R2_threshold, pval_threshold, wa_threshold,
+	PC_axis_one, PC_axis_two, permutations=999, seed=None, permutation_workers=1):
+	"""
+	Same computation as pcoa_triplot.R (see process_input_with_R), with
+	triplot_engine instead of R. Dataframes are returned instead of written
+	to CSV files.
+
+	Inputs:
+		- dissmilarity_index: vegan vegdist method (e.g. 'bray')
+		- permutations: number of permutations for envfit p-values
+		- seed: random seed for the permutations
+		- permutation_workers: number of worker processes for the permutations
+
+	Returns:
+		- merged_df: PCoA coordinates merged with sample metadata
+		- vector_arrow_df: environmental vectors passing the thresholds
+		- wascores_df: taxa weighted averages passing the abundance threshold
+		- proportion_explained: proportion explained (%) per PCoA axis
+		- projection_df: environmental vectors with R2 and p-values
+	"""
+	k = check_triplot_input(intersection_feature_table_df, intersection_abundance_df,
+		intersection_sample_metadata_df, intersection_environmental_metadata_df,
+		PC_axis_one, PC_axis_two)
+
+	dissimilarity_df = triplot_engine.vegdist(intersection_feature_table_df, dissmilarity_index)
+	pcoa_df, eig = triplot_engine.cmdscale(dissimilarity_df, k)
+	check_positive_axes(pcoa_df, PC_axis_one, PC_axis_two)
+
+	wascores_df = triplot_engine.wascores(pcoa_df, intersection_abundance_df)
+
+	projection_df = triplot_engine.envfit(pcoa_df, intersection_environmental_metadata_df,
+		choices=(PC_axis_one, PC_axis_two), permutations=permutations, seed=seed,
+		workers=permutation_workers)
+
+	return summarize_ordination(pcoa_df, eig, wascores_df, projection_df,
+		intersection_abundance_df, intersection_sample_metadata_df,
+		R2_threshold, pval_threshold, wa_threshold, PC_axis_one, PC_axis_two)
+
+def process_input_in_R_session(intersection_feature_table_df, intersection_abundance_df,
+	intersection_sample_metadata_df, intersection_environmental_metadata_df,
+	dissmilarity_index, R2_threshold, pval_threshold, wa_threshold,
+	PC_axis_one, PC_axis_two, r_session_pool=None):
+	"""
+	Same computation as pcoa_triplot.R, run by a warm embedded R session
+	(see r_session_pool). Dataframes are passed to R with the pandas2ri
+	converters instead of CSV files.
+
+	Inputs:
+		- dissmilarity_index: vegan vegdist method (e.g. 'bray')
+		- r_session_pool: RSessionPool with vegan loaded; the shared
+			default pool if None
+
+	Returns:
+		same as process_input_natively
+	"""
+	k = check_triplot_input(intersection_feature_table_df, intersection_abundance_df,
+		intersection_sample_metadata_df, intersection_environmental_metadata_df,
+		PC_axis_one, PC_axis_two)
+
+
+	if(r_session_pool is None):
+		r_session_pool = default_pool()
+
+	pcoa_df, eig, wascores_df, projection_df = r_session_pool.run(triplot_ordination,
+		intersection_feature_table_df, intersection_abundance_df,
+		intersection_environmental_metadata_df, dissmilarity_index, k,
+		PC_axis_one, PC_axis_two)
+	check_positive_axes(pcoa_df, PC_axis_one, PC_axis_two)
+
+	return summarize_ordination(pcoa_df, eig, wascores_df, projection_df,
+		intersection_abundance_df, intersection_sample_metadata_df,
+		R2_threshold, pval_threshold, wa_threshold, PC_axis_one, PC_axis_two)
+
+def summarize_ordination(pcoa_df, eig, wascores_df, projection_df,
+	intersection_abundance_df, intersection_sample_metadata_df,
+	R2_threshold, pval_threshold, wa_threshold, PC_axis_one, PC_axis_two):
+	"""
+	Thresholds and merges of pcoa_triplot.R, applied to an ordination.
+
+	Returns:
+		same as process_input_natively
+	"""
+	# Filter vector projection based on R2 value and pval
+	pval_filtered = projection_df['pvals'] < pval_threshold
+	if not(pval_filtered.any()):
+		raise AXIOME3Error("No samples remaining after filtering by specified p-value threshold, {}".format(pval_threshold))
+
+	r2_filtered = projection_df['R2'] > R2_threshold
+	if not(r2_filtered.any()):
+		raise AXIOME3Error("No samples remaining after filtering by specified R2 threshold, {}".format(R2_threshold))
+
+	filtered = pval_filtered & r2_filtered
+	if not(filtered.any()):
+		raise AXIOME3Error("No samples remaining after filtering by specified p-value and R2 thresholds")
+
+	arrow_cols = projection_df.columns.drop(['R2', 'pvals'])
+	vector_arrow_df = projection_df.loc[filtered, arrow_cols].mul(
+		np.sqrt(projection_df.loc[filtered, 'R2']), axis=0)
+	vector_arrow_df.columns = ['Axis ' + str(PC_axis_one), 'Axis ' + str(PC_axis_two)]
+
+	# Taxa weighted averages with normalized total abundance
+	wascores_df = normalized_taxa_total_abundance(wascores_df, intersection_abundance_df)
+	filtered_wascores_df = filter_by_wascore_threshold(wascores_df, wa_threshold)
+
+	# Merge metadata with PCoA coordinates
+	merged_df = pd.merge(
+		pcoa_df.rename_axis('SampleID').reset_index(),
+		intersection_sample_metadata_df.rename_axis('SampleID').reset_index(),
+		on='SampleID',
+		sort=True)
+
+	proportion_explained = pd.DataFrame(
+		{'proportion_explained': eig / eig.sum() * 100},
+		index=['Axis ' + str(i) for i in range(1, len(eig) + 1)])
+
+	return merged_df, vector_arrow_df, filtered_wascores_df, proportion_explained, projection_df
+
 def process_input_with_R(intersection_feature_table_df, intersection_abundance_df,
 	intersection_sample_metadata_df, intersection_environmental_metadata_df,
 	dissmilarity_index, R2_threshold, pval_threshold, wa_threshold,
@@ -657,6 +923,32 @@ def save_plot(plot, filename, output_dir='.',
 		units=units
 	)
 
+def save_plots(plot_kwargs, filenames, output_dir='.',
+		file_format='pdf', width=100, height=100, units='mm', workers=1):
+	"""
+	Make and save several triplots (see save_plot), in parallel worker
+	processes.
+
+	Input:
+		- plot_kwargs: list of make_triplot keyword arguments, one per plot
+		- filenames: list of file names (without extension), one per plot
+		- workers: number of rendering processes
+	"""
+	if(len(plot_kwargs) != len(filenames)):
+		raise AXIOME3Error("Number of plots and file names must be equal!")
+
+	specs = [
+		PlotSpec(
+			make_triplot,
+			kwargs=kwargs,
+			images=[(os.path.join(output_dir, filename + "." + file_format), file_format)],
+			size=figure_size(width, height, units)
+		)
+		for kwargs, filename in zip(plot_kwargs, filenames)
+	]
+
+	render_plots(specs, workers)
+
 #feature_table_artifact_path = "/output/test/merged_table.qza"
 #taxonomy_artifact_path = "/output/test/taxonomy.qza"
 #sample_metadata_path = "/output/test/metadata.tsv"
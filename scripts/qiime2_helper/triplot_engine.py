@@ -0,0 +1,367 @@
+"""
+Triplot ordination computed with NumPy/SciPy (no R).
+
+Implements the parts of R's vegan/stats used by pcoa_triplot.R:
+	- vegdist: dissimilarity matrix (vegan method names)
+	- cmdscale: classical multidimensional scaling (PCoA)
+	- wascores: weighted average scores of taxa
+	- envfit: environmental vectors fitted onto the ordination, with
+		permutation p-values
+Results are pandas DataFrames. Definitions follow vegan (version 2.5);
+p-values come from random permutations, so they agree with R's only up to
+permutation noise. Permutations are evaluated in blocks: all environmental
+variables are regressed against a block of permutations with one matrix
+product, and blocks may be spread over worker processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist, squareform
+
+# Custom exception
+from exceptions.exception import AXIOME3Error
+
+# vegdist methods computed natively (all but 'chao' and 'cao')
+NATIVE_VEGDIST_METHODS = (
+	"manhattan", "euclidean", "canberra", "bray", "kulczynski", "jaccard",
+	"gower", "altGower", "morisita", "horn", "binomial", "mahalanobis"
+)
+
+# Permutation statistic tolerance (as vegan)
+EPS = np.sqrt(np.finfo(float).eps)
+# Permutations evaluated together (one matrix product per block)
+PERMUTATION_BLOCK_SIZE = 500
+
+def _pairwise(x, pair_distance):
+	"""
+	Condensed distance matrix; pair_distance(row, rows) returns distances
+	between one row and each of the rows (vectorized over rows).
+	"""
+	n = x.shape[0]
+	condensed = np.empty(n * (n - 1) // 2)
+
+	start = 0
+	for i in range(n - 1):
+		distances = pair_distance(x[i], x[i+1:])
+		condensed[start:start + len(distances)] = distances
+		start = start + len(distances)
+
+	return condensed
+
+def _canberra(a, b):
+	total = a + b
+	nonzero = (a != 0) | (b != 0)
+	terms = np.divide(np.abs(a - b), total, out=np.zeros_like(b), where=nonzero)
+	count = nonzero.sum(axis=1)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(count > 0, terms.sum(axis=1) / count, np.nan)
+
+def _kulczynski(a, b):
+	shared = np.minimum(a, b).sum(axis=1)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return 1 - shared / a.sum() / 2 - shared / b.sum(axis=1) / 2
+
+def _gower(a, b):
+	return np.abs(a - b).sum(axis=1) / a.shape[0]
+
+def _alt_gower(a, b):
+	nonzero = (a != 0) | (b != 0)
+	count = nonzero.sum(axis=1)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(count > 0, np.abs(a - b).sum(axis=1) / count, np.nan)
+
+def _morisita(a, b):
+	shared = (a * b).sum(axis=1)
+	a_total = a.sum()
+	b_total = b.sum(axis=1)
+	a_lambda = (a * (a - 1)).sum() / a_total / (a_total - 1)
+	b_lambda = (b * (b - 1)).sum(axis=1) / b_total / (b_total - 1)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		dist = 1 - 2 * shared / (a_lambda + b_lambda) / a_total / b_total
+
+	return np.maximum(dist, 0)
+
+def _horn(a, b):
+	shared = (a * b).sum(axis=1)
+	a_total = a.sum()
+	b_total = b.sum(axis=1)
+	a_lambda = (a ** 2).sum() / a_total / a_total
+	b_lambda = (b ** 2).sum(axis=1) / b_total / b_total
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return 1 - 2 * shared / (a_lambda + b_lambda) / a_total / b_total
+
+def _binomial(a, b):
+	total = a + b
+	nonzero = total > 0
+	with np.errstate(invalid='ignore', divide='ignore'):
+		a_term = np.where(a > 0, a * np.log(a / total), 0)
+		b_term = np.where(b > 0, b * np.log(b / total), 0)
+		terms = (a_term + b_term + total * np.log(2)) / total
+
+	return np.where(nonzero, terms, 0).sum(axis=1)
+
+def _mahalanobis_transform(x, tol=1e-8):
+	"""
+	Centred data times the inverse square root of its covariance matrix
+	(vegan's veganMahatrans).
+	"""
+	x = x - x.mean(axis=0)
+	covariance = np.atleast_2d(np.cov(x, rowvar=False))
+	values, vectors = np.linalg.eigh(covariance)
+	values, vectors = values[::-1], vectors[:, ::-1]
+
+	keep = values > max(tol, tol * values[0])
+	inverse_sqrt = vectors[:, keep] @ (np.sqrt(1 / values[keep])[:, None] * vectors[:, keep].T)
+
+	return x @ inverse_sqrt
+
+_PAIR_DISTANCES = {
+	"canberra": _canberra,
+	"kulczynski": _kulczynski,
+	"gower": _gower,
+	"altGower": _alt_gower,
+	"morisita": _morisita,
+	"horn": _horn,
+	"binomial": _binomial
+}
+
+def vegdist(feature_table_df, method="bray"):
+	"""
+	Dissimilarity between samples, as vegan's vegdist.
+
+	Input:
+		- feature_table_df: pandas DataFrame (samples as rows, taxa/ASV as columns)
+		- method: vegan method name (see NATIVE_VEGDIST_METHODS)
+
+	Returns:
+		- pandas DataFrame; square dissimilarity matrix with samples as
+			rows and columns
+	"""
+	if(method not in NATIVE_VEGDIST_METHODS):
+		raise AXIOME3Error("Dissimilarity method, {method}, is not supported by the native engine!".format(method=method))
+
+	x = feature_table_df.to_numpy(dtype=float)
+
+	if(method == "euclidean"):
+		condensed = pdist(x, "euclidean")
+	elif(method == "manhattan"):
+		condensed = pdist(x, "cityblock")
+	elif(method == "mahalanobis"):
+		condensed = pdist(_mahalanobis_transform(x), "euclidean")
+	elif(method in ("bray", "jaccard")):
+		# Quantitative Jaccard is derived from Bray-Curtis
+		with np.errstate(invalid='ignore', divide='ignore'):
+			condensed = pdist(x, "braycurtis")
+		if(method == "jaccard"):
+			condensed = 2 * condensed / (1 + condensed)
+	else:
+		if(method == "gower"):
+			# Range-standardize each taxon (vegan decostand 'range')
+			low = x.min(axis=0)
+			value_range = np.maximum(x.max(axis=0) - low, np.finfo(float).eps)
+			x = (x - low) / value_range
+		condensed = _pairwise(x, _PAIR_DISTANCES[method])
+
+	return pd.DataFrame(squareform(condensed, checks=False),
+		index=feature_table_df.index, columns=feature_table_df.index)
+
+def cmdscale(dissimilarity_df, k=2):
+	"""
+	Classical multidimensional scaling (PCoA), as R's cmdscale(eig=TRUE).
+
+	Input:
+		- dissimilarity_df: square dissimilarity matrix (pandas DataFrame)
+		- k: number of dimensions
+
+	Returns:
+		- points: pandas DataFrame (samples as rows, 'Axis 1'... as columns);
+			axes with non-positive eigenvalues are dropped
+		- eig: numpy array of all eigenvalues, in decreasing order
+	"""
+	d = dissimilarity_df.to_numpy(dtype=float)
+	n = d.shape[0]
+
+	if(k < 1 or k > n - 1):
+		raise AXIOME3Error("Number of PCoA dimensions must be between 1 and {}".format(n - 1))
+
+	# Double centring of -d^2/2
+	b = -0.5 * d ** 2
+	b = b - b.mean(axis=0) - b.mean(axis=1)[:, None] + b.mean()
+
+	values, vectors = np.linalg.eigh(b)
+	values, vectors = values[::-1], vectors[:, ::-1]
+
+	ev = values[:k]
+	positive = ev > 0
+	points = vectors[:, :k][:, positive] * np.sqrt(ev[positive])
+
+	points_df = pd.DataFrame(points, index=dissimilarity_df.index,
+		columns=['Axis ' + str(i) for i in range(1, points.shape[1] + 1)])
+
+	return points_df, values
+
+def wascores(points_df, abundance_df):
+	"""
+	Weighted average scores of taxa (vegan's wascores): ordination scores
+	averaged over samples, weighted by taxa abundance.
+
+	Input:
+		- points_df: sample scores (samples as rows, axes as columns)
+		- abundance_df: abundance (samples as rows, taxa as columns)
+
+	Returns:
+		- pandas DataFrame (taxa as rows, axes as columns)
+	"""
+	w = abundance_df.loc[points_df.index].to_numpy(dtype=float)
+	x = points_df.to_numpy(dtype=float)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		scores = (w.T @ x) / w.sum(axis=0)[:, None]
+
+	return pd.DataFrame(scores, index=abundance_df.columns, columns=points_df.columns)
+
+class VectorFit(object):
+	"""
+	Least squares fit of centred environmental variables onto centred
+	ordination scores.
+	"""
+	def __init__(self, scores, env):
+		self.scores = scores - scores.mean(axis=0)
+		self.env = env - env.mean(axis=0)
+
+		# Orthonormal basis of the ordination axes
+		self.basis, _ = np.linalg.qr(self.scores)
+		self.env_ss = (self.env ** 2).sum(axis=0)
+
+	def r_squared(self, env):
+		"""
+		Squared correlation of each (centred) variable with its fitted
+		values.
+		"""
+		fitted_ss = ((self.basis.T @ env) ** 2).sum(axis=0)
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+			r2 = fitted_ss / self.env_ss
+
+		return np.where(self.env_ss > 0, r2, np.nan)
+
+	def permuted_r_squared(self, permutations):
+		"""
+		r_squared of the variables with samples permuted, for a block of
+		permutations at once.
+
+		Input:
+			- permutations: (permutations x samples) array of sample indices
+
+		Returns:
+			- (permutations x variables) array
+		"""
+		# basis' env[p] == basis[inverse of p]' env, so each permutation
+		# only moves the (samples x axes) basis
+		inverse = np.argsort(permutations, axis=1)
+		permuted_basis = self.basis[inverse]
+		fitted_ss = (np.matmul(permuted_basis.transpose(0, 2, 1), self.env) ** 2).sum(axis=1)
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+			r2 = fitted_ss / self.env_ss
+
+		return np.where(self.env_ss > 0, r2, np.nan)
+
+	def arrows(self):
+		"""
+		Unit length direction of each variable (variables as rows).
+		"""
+		coef, _, _, _ = np.linalg.lstsq(self.scores, self.env, rcond=None)
+		norm = np.maximum(np.sqrt((coef ** 2).sum(axis=0)), np.finfo(float).eps)
+
+		return (coef / norm).T
+
+def permutation_block(n_samples, n_permutations, seed):
+	"""
+	(n_permutations x n_samples) array of random permutations of sample
+	indices.
+	"""
+	rng = np.random.default_rng(seed)
+
+	return np.argsort(rng.random((n_permutations, n_samples)), axis=1)
+
+def _block_exceedances(fit, r2, n_permutations, seed):
+	"""
+	Number of permutations of a block with R2 at least the observed one.
+	"""
+	permutations = permutation_block(fit.env.shape[0], n_permutations, seed)
+
+	return (fit.permuted_r_squared(permutations) >= r2 - EPS).sum(axis=0)
+
+def permutation_pvalues(fit, r2, permutations=999, seed=None,
+	block_size=PERMUTATION_BLOCK_SIZE, workers=1):
+	"""
+	Share of random sample permutations giving an R2 at least as high as
+	the observed one, as vegan: (count + 1) / (permutations + 1).
+
+	Input:
+		- fit: VectorFit
+		- r2: observed R2 of each variable
+		- permutations: number of permutations
+		- seed: random seed; each block gets its own stream, so p-values
+			do not depend on the number of workers
+		- block_size: permutations evaluated together
+		- workers: number of worker processes
+
+	Returns:
+		- numpy array of p-values; 1 for constant variables
+	"""
+	block_size = max(1, int(block_size))
+	sizes = [min(block_size, permutations - start) for start in range(0, permutations, block_size)]
+	seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+	if(int(workers) > 1 and len(sizes) > 1):
+		with ProcessPoolExecutor(max_workers=min(int(workers), len(sizes))) as pool:
+			counts = list(pool.map(_block_exceedances,
+				[fit] * len(sizes), [r2] * len(sizes), sizes, seeds))
+	else:
+		counts = [_block_exceedances(fit, r2, size, block_seed)
+			for size, block_seed in zip(sizes, seeds)]
+
+	exceed = np.sum(counts, axis=0) if len(counts) > 0 else np.zeros(len(r2))
+
+	return np.where(np.isnan(r2), 1.0, (exceed + 1) / (permutations + 1))
+
+def envfit(points_df, env_metadata_df, choices=(1, 2), permutations=999, seed=None,
+	block_size=PERMUTATION_BLOCK_SIZE, workers=1):
+	"""
+	Fit environmental vectors onto an ordination (vegan's envfit with
+	numeric variables).
+
+	Input:
+		- points_df: sample scores (samples as rows, 'Axis 1'... as columns)
+		- env_metadata_df: numeric environmental variables (samples as rows)
+		- choices: ordination axes to fit onto (1-based)
+		- permutations: number of permutations for p-values
+		- seed: random seed for the permutations
+		- block_size: permutations evaluated together
+		- workers: number of worker processes for the permutations
+
+	Returns:
+		- pandas DataFrame (variables as rows; 'Dim<axis>' unit arrow
+			coordinates, 'R2' and 'pvals' as columns)
+	"""
+	scores = points_df[['Axis ' + str(axis) for axis in choices]].to_numpy(dtype=float)
+	env = env_metadata_df.loc[points_df.index].to_numpy(dtype=float)
+
+	fit = VectorFit(scores, env)
+	r2 = fit.r_squared(fit.env)
+	pvals = permutation_pvalues(fit, r2, permutations, seed, block_size, workers)
+
+	projection_df = pd.DataFrame(fit.arrows(), index=env_metadata_df.columns,
+		columns=['Dim' + str(axis) for axis in choices])
+	projection_df['R2'] = np.nan_to_num(r2)
+	projection_df['pvals'] = pvals
+
+	return projection_df